@@ -0,0 +1,120 @@
+import logging
+import threading
+from contextlib import nullcontext
+from flask import has_app_context
+from database import db, User, Orders
+
+
+"""
+Keeps the account websockets of accounts with open orders connected, so the
+fills and cancels of their orders reach the execution recorder and the order
+reconciler also while no request uses the websocket.
+
+"""
+
+# order statuses of BitMEX that can still change
+OPEN_STATUSES = ("New", "PartiallyFilled")
+
+
+class AccountFeeds:
+    """ Holds a reference to the account websocket of every account that has
+        open orders in the database, so the manager never reaps it. Every
+        interval seconds the accounts are looked up again: the feeds of
+        accounts without open orders are given back, the manager closes
+        them once they are idle, and feeds the server has closed are
+        reopened. The refresh thread is started with the first hold() or
+        start(), so after a restart the feeds are opened by the first
+        request that asks for one and the refresh that follows it.
+    """
+
+    def __init__(self, app, manager, endpoint, interval=30):
+        self.app = app
+        self.manager = manager
+        self.endpoint = endpoint
+        self.interval = interval
+        self.logger = logging.getLogger(__name__)
+        # api_public -> websocket held
+        self._held = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def hold(self, api_key, api_secret):
+        """ Returns the account websocket of the key, connecting it first if
+            it isn't held yet or has been closed. Raises like
+            WebsocketManager.acquire if it can't be opened.
+        """
+        self.start()
+        with self._lock:
+            ws = self._held.get(api_key)
+            if ws is not None and not ws.exited:
+                return ws
+        # connecting can take a while, other accounts don't wait for it
+        ws = self.manager.acquire(self.endpoint, "", api_key=api_key, api_secret=api_secret)
+        with self._lock:
+            # the closed one, or the same one if another thread got it meanwhile
+            old = self._held.get(api_key)
+            self._held[api_key] = ws
+        if old is not None:
+            self.manager.release(old)
+        return ws
+
+    def drop(self, api_key):
+        """ Gives the account websocket of the key back to the manager """
+        with self._lock:
+            ws = self._held.pop(api_key, None)
+        if ws is not None:
+            self.manager.release(ws)
+
+    def held(self):
+        """ Returns the api keys whose websockets are held """
+        with self._lock:
+            return set(self._held)
+
+    def refresh(self):
+        """ Holds the feeds of the accounts with open orders and drops the
+            others, returns the number of feeds held
+        """
+        with self._context():
+            accounts = (db.session.query(User.api_public, User.api_secret).join(Orders)
+                        .filter(Orders.order_status.in_(OPEN_STATUSES)).distinct().all())
+        open_keys = set()
+        for api_key, api_secret in accounts:
+            open_keys.add(api_key)
+            try:
+                self.hold(api_key, api_secret)
+            except Exception:
+                self.logger.exception("Opening the account websocket of %s failed", api_key)
+        for api_key in self.held() - open_keys:
+            self.drop(api_key)
+        return len(self.held())
+
+    def close(self):
+        """ Stops the refresh thread and gives back every feed """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for api_key in self.held():
+            self.drop(api_key)
+
+    def start(self):
+        """ Starts the refresh thread if it isn't running """
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="account-feeds")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception:
+                self.logger.exception("Refreshing the account websockets failed")
+
+    def _context(self):
+        # see ExecutionRecorder._context
+        return nullcontext() if has_app_context() else self.app.app_context()
@@ -1,7 +1,18 @@
 import pytest
+import logging
 import tempfile
 import os
-from app import app
+import app as app_module
+from app import app, ws_manager, orderbook_cache, account_cache
+from bars import BarAggregator
+from trade_tape import TradeTape
+from rest_client import BitMEXRestClient
+from rest_client_test import StubBitMEX
+from order_queue import OrderQueue
+from rate_limit import RateLimiter
+from ws_store import TableStore
+from bitmex_websocket import WebSocketRejected
+import websocket
 from database import User, Orders, db
 from sqlalchemy.engine import Engine
 from sqlalchemy import event
@@ -28,6 +39,8 @@ def client():
     app.config["TESTING"] = True
     app.config["DEBUG"] = False
     db.init_app(app)
+    # records of the previous test's database must not be served
+    account_cache.clear()
 
     with app.app_context():
         db.create_all()
@@ -171,6 +184,17 @@ def _get_leverage_json():
     return {"leverage": 2}
 
 
+def test_href_templates():
+    """ Tests that hrefs made from templates are the ones url_for builds """
+    cases = [(app_module.Accounts, {}), (app_module.Account, {"apikey": "79z47uUikMoPe2eADqfJzRBu"}),
+             (app_module.OrderResource, {"apikey": "a b/c", "orderid": "\u00e4%?#"}),
+             (app_module.Position, {"apikey": "key", "symbol": ".XBT"})]
+    for base_url in ("http://localhost/", "http://localhost/mounted/"):
+        with app.test_request_context(base_url=base_url):
+            for resource, values in cases:
+                assert app_module.href(resource, **values) == app_module.api.url_for(resource, **values)
+
+
 class TestAccounts(object):
 
     RESOURCE_URL = "/accounts/"
@@ -194,6 +218,25 @@ class TestAccounts(object):
             assert "accountname" in item
             assert "api_public" in item
 
+    def test_pagination(self, client):
+        """
+        Tests that following the next controls lists every account once and
+        that a bad limit or cursor gives 400
+        """
+        names = []
+        body = json.loads(client.get(self.RESOURCE_URL + "?limit=3").data)
+        names += [item["accountname"] for item in body["items"]]
+        assert len(names) == 3
+        body = json.loads(client.get(body["@controls"]["next"]["href"]).data)
+        names += [item["accountname"] for item in body["items"]]
+        assert "next" not in body["@controls"]
+        assert len(set(names)) == 4
+        _check_control_post_method("add-account", client, body)
+
+        for query in ("?limit=0", "?limit=x", "?after=x"):
+            resp = client.get(self.RESOURCE_URL + query)
+            assert resp.status_code == 400
+
     def test_post(self, client):
         """
         Tests the POST method. Checks all of the possible error codes, and
@@ -272,6 +315,10 @@ class TestAccount(object):
         resp = client.delete(self.RESOURCE_URL, headers=self.INVALID_API_SECRET)
         assert resp.status_code == 401
 
+        # a cached account
+        resp = client.get(self.RESOURCE_URL, headers=self.VALID_API_SECRET)
+        assert resp.status_code == 200
+
         resp = client.delete(self.RESOURCE_URL, headers=self.VALID_API_SECRET)
         assert resp.status_code == 204
         resp = client.get(self.RESOURCE_URL, headers=self.VALID_API_SECRET)
@@ -286,7 +333,7 @@ class TestOrders(object):
     VALID_API_SECRET = {"api_secret": "j9ey6Lk2xR6V-qJRfN-HqD2nfOGme0FnBddp1cxqK6k8Gbjd"}
     INVALID_API_SECRET = {"api_secret": "j9ey6Lk2xR6V-qJRfN-HqD2nfOGme0FnBddp1cxqK6k8G123"}
 
-    def test_get(self, client):
+    def test_get(self, client, market):
         """
         Tests the GET method
         """
@@ -313,7 +360,64 @@ class TestOrders(object):
             assert "side" in item
             assert "size" in item
 
-    def test_post(self, client):
+    def test_pagination(self, client, market):
+        """
+        Tests that the orders are listed in pages with next controls
+        """
+        with app.app_context():
+            user = User.query.filter_by(api_public="79z47uUikMoPe2eADqfJzRBu").first()
+            for i in range(5):
+                user.orders.append(Orders(order_id="10000000-0000-0000-0000-00000000000{}".format(i),
+                                          order_price=3500.0, order_size=1, order_side="Buy",
+                                          order_symbol="XBTUSD"))
+            db.session.commit()
+
+        ids = []
+        href = self.RESOURCE_URL + "?limit=2"
+        while href:
+            body = json.loads(client.get(href, headers=self.VALID_API_SECRET).data)
+            assert len(body["items"]) <= 2
+            ids += [item["id"] for item in body["items"]]
+            href = body["@controls"].get("next", {}).get("href")
+        assert len(ids) == 6
+        assert ids == sorted(ids)
+
+        resp = client.get(self.RESOURCE_URL + "?limit=5000", headers=self.VALID_API_SECRET)
+        assert resp.status_code == 400
+
+    def test_fills_reach_the_list(self, client, market, monkeypatch):
+        """
+        Tests that a client that only polls the orders sees their fills, the
+        account websocket stays open between the polls
+        """
+        resp = client.get(self.RESOURCE_URL, headers=self.VALID_API_SECRET)
+        assert json.loads(resp.data)["items"][0]["status"] == "New"
+        headers = dict(self.VALID_API_SECRET, **{"If-None-Match": resp.headers["ETag"]})
+        account = [feed for feed in market if feed.api_key == "79z47uUikMoPe2eADqfJzRBu"][0]
+        monkeypatch.setattr(ws_manager, "idle_timeout", 0)
+        ws_manager.reap()
+        assert not account.exited
+
+        account.apply({"table": "order", "action": "partial", "keys": ["orderID"],
+                       "data": [{"orderID": "00000000-0000-0000-0000-000000000000", "symbol": "XBTUSD",
+                                 "ordStatus": "PartiallyFilled",
+                                 "cumQty": 1, "leavesQty": 1, "orderQty": 2}]})
+        account.apply({"table": "order", "action": "update",
+                       "data": [{"orderID": "00000000-0000-0000-0000-000000000000", "symbol": "XBTUSD",
+                                 "ordStatus": "Filled", "cumQty": 2, "leavesQty": 0}]})
+        app_module.reconciler.flush()
+        resp = client.get(self.RESOURCE_URL, headers=headers)
+        assert resp.status_code == 200
+        item, = json.loads(resp.data)["items"]
+        assert (item["status"], item["filled"], item["leaves"], item["size"]) == ("Filled", 2, 0, 2)
+        body = json.loads(client.get(item["@controls"]["self"]["href"], headers=self.VALID_API_SECRET).data)
+        assert body["status"] == "Filled"
+
+        monkeypatch.setattr(ws_manager, "factory", _unavailable(websocket.WebSocketTimeoutException("Couldn't connect")))
+        account.exited = True
+        assert client.get(self.RESOURCE_URL, headers=self.VALID_API_SECRET).status_code == 503
+
+    def test_post(self, client, market):
         """
         Tests the POST method. Checks all of the possible error codes, and
         also checks that a valid request receives a 201 response with a
@@ -355,7 +459,7 @@ class TestOrder(object):
     VALID_API_SECRET = {"api_secret": "j9ey6Lk2xR6V-qJRfN-HqD2nfOGme0FnBddp1cxqK6k8Gbjd"}
     INVALID_API_SECRET = {"api_secret": "j9ey6Lk2xR6V-qJRfN-HqD2nfOGme0FnBddp1cxqK6k8G123"}
 
-    def test_get(self, client):
+    def test_get(self, client, market):
         """
         Tests the get method, first checks for correct error responses, then
         does valid request and checks if the response data has all the required
@@ -383,7 +487,7 @@ class TestOrder(object):
         _check_control_get_method("orders-all", client, body, headers=self.VALID_API_SECRET)
         _check_control_delete_method("delete", client, body, headers=self.VALID_API_SECRET)
 
-    def test_delete(self, client):
+    def test_delete(self, client, market):
         """
         Tests the delete method, first checks for correct error responses, then
         does valid request checks if the resource exist after the delete request
@@ -394,6 +498,10 @@ class TestOrder(object):
         assert resp.status_code == 401
 
         #  Send with right url and check after if the resource exists
+        # a cached account
+        resp = client.get(self.RESOURCE_URL, headers=self.VALID_API_SECRET)
+        assert resp.status_code == 200
+
         resp = client.delete(self.RESOURCE_URL, headers=self.VALID_API_SECRET)
         assert resp.status_code == 204
         resp = client.get(self.RESOURCE_URL, headers=self.VALID_API_SECRET)
@@ -425,6 +533,520 @@ class TestPriceAction(object):
         assert resp.status_code == 400
 
 
+class FakeMarket(TableStore):
+    """ Stands in for a BitMEX websocket, tables are fed by the test """
+
+    def __init__(self, endpoint, symbol, api_key=None, api_secret=None):
+        self.logger = logging.getLogger(__name__)
+        TableStore.__init__(self, symbol)
+        self.endpoint = endpoint
+        self.api_key = api_key
+        self.exited = False
+        self.apply({"table": "trade", "action": "partial", "keys": [], "data": [], "filter": {"symbol": symbol}})
+        if api_key:
+            self.apply({"table": "position", "action": "partial", "keys": ["account", "symbol"], "data": []})
+
+    def exit(self):
+        self.exited = True
+
+
+@pytest.fixture
+def market(monkeypatch, tmp_path):
+    """ Makes the app connect to FakeMarkets, returns the ones it made.
+        Trades are written to a temporary trade tape and bars of their own.
+    """
+    feeds = []
+    def factory(**kwargs):
+        feeds.append(FakeMarket(**kwargs))
+        return feeds[-1]
+    monkeypatch.setattr(ws_manager, "factory", factory)
+    tape = TradeTape(str(tmp_path))
+    monkeypatch.setattr(app_module, "tape", tape)
+    monkeypatch.setattr(app_module, "bars", BarAggregator(capacity=app.config["BAR_CAPACITY"]))
+    yield feeds
+    app_module.account_feeds.close()
+    ws_manager.close_all()
+    orderbook_cache.clear()
+    tape.close()
+
+
+def _unavailable(error):
+    """ websocket factory that fails with error """
+    def factory(**kwargs):
+        raise error
+    return factory
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    """ Makes the app call a local StubBitMEX instead of BitMEX """
+    stub = StubBitMEX()
+    monkeypatch.setattr(app_module, "bitmex", BitMEXRestClient(stub.url))
+    yield stub
+    # placing orders starts the refresh of the account websockets
+    app_module.account_feeds.close()
+    stub.close()
+
+
+class TestOrdersUpstream(object):
+    RESOURCE_URL = "/accounts/79z47uUikMoPe2eADqfJzRBu/orders/"
+    VALID_API_SECRET = {"api_secret": "j9ey6Lk2xR6V-qJRfN-HqD2nfOGme0FnBddp1cxqK6k8Gbjd"}
+
+    def test_post(self, client, upstream, market):
+        """
+        Tests that an order is placed with one signed call and stored
+        """
+        upstream.handlers[("POST", "/api/v1/order")] = lambda data: (200, {
+            "orderID": "20000000-0000-0000-0000-000000000000", "orderQty": data["orderQty"],
+            "side": data["side"], "symbol": data["symbol"], "price": data["price"]})
+        resp = client.post(self.RESOURCE_URL, json=_get_order_json(), headers=self.VALID_API_SECRET)
+        assert resp.status_code == 201
+        assert len(upstream.requests) == 1
+        assert upstream.requests[0][2]["api-key"] == "79z47uUikMoPe2eADqfJzRBu"
+        body = json.loads(client.get(resp.headers["Location"], headers=self.VALID_API_SECRET).data)
+        assert body["size"] == 20
+
+    def test_post_bulk(self, client, upstream, market):
+        """
+        Tests that a list of orders is placed with one signed call, that the
+        accepted ones are stored and that every order gets its result
+        """
+        def place(data):
+            placed = []
+            for i, order in enumerate(data["orders"]):
+                placed.append(dict(order, orderID="3000000{}-0000-0000-0000-000000000000".format(i),
+                                   ordStatus="Rejected" if order["price"] < 0 else "New",
+                                   ordRejReason="Invalid price"))
+            return 200, placed
+        upstream.handlers[("POST", "/api/v1/order/bulk")] = place
+        orders = [dict(_get_order_json(), price=3800.0 + i) for i in range(3)]
+        orders[1]["price"] = -1.0
+        with app.app_context():
+            count = Orders.query.count()
+
+        resp = client.post(self.RESOURCE_URL, json=orders, headers=self.VALID_API_SECRET)
+        assert resp.status_code == 200
+        assert len(upstream.requests) == 1
+        body = json.loads(resp.data)
+        assert [item["status"] for item in body["items"]] == [201, 400, 201]
+        assert body["items"][1]["message"] == "Invalid price"
+        _check_control_get_method("self", client, body["items"][2], headers=self.VALID_API_SECRET)
+        with app.app_context():
+            assert Orders.query.count() == count + 2
+
+        # one invalid order fails the whole list before anything is sent
+        orders[0].pop("side")
+        resp = client.post(self.RESOURCE_URL, json=orders, headers=self.VALID_API_SECRET)
+        assert resp.status_code == 400
+        assert len(upstream.requests) == 1
+
+        # errors of the whole request are passed on
+        upstream.handlers[("POST", "/api/v1/order/bulk")] = lambda data: (400, {"error": {"message": "Bad"}})
+        resp = client.post(self.RESOURCE_URL, json=[_get_order_json()], headers=self.VALID_API_SECRET)
+        assert resp.status_code == 400
+
+    def test_delete(self, client, upstream):
+        """
+        Tests that cancelling all or the matching orders is one call to
+        BitMEX and that the orders are deleted only once it succeeds
+        """
+        with app.app_context():
+            user = User.query.filter_by(api_public="79z47uUikMoPe2eADqfJzRBu").first()
+            for i, (symbol, side) in enumerate([("XBTUSD", "Buy"), ("XBTUSD", "Sell"), ("ETHUSD", "Sell")]):
+                user.orders.append(Orders(order_id="4000000{}-0000-0000-0000-000000000000".format(i),
+                                          order_price=3500.0, order_size=1, order_side=side,
+                                          order_symbol=symbol))
+            db.session.commit()
+
+        def remaining():
+            with app.app_context():
+                user = User.query.filter_by(api_public="79z47uUikMoPe2eADqfJzRBu").first()
+                return sorted((order.order_symbol, order.order_side) for order in user.orders)
+
+        resp = client.delete(self.RESOURCE_URL + "?side=Short", headers=self.VALID_API_SECRET)
+        assert resp.status_code == 400
+
+        # nothing is deleted if BitMEX refuses
+        upstream.handlers[("DELETE", "/api/v1/order/all")] = lambda data: (401, {"error": {"message": "Nope"}})
+        upstream.handlers[("DELETE", "/api/v1/order")] = lambda data: (401, {"error": {"message": "Nope"}})
+        resp = client.delete(self.RESOURCE_URL, headers=self.VALID_API_SECRET)
+        assert resp.status_code == 401
+        assert len(remaining()) == 4
+        resp = client.delete(self.RESOURCE_URL + "40000000-0000-0000-0000-000000000000/",
+                             headers=self.VALID_API_SECRET)
+        assert resp.status_code == 401
+        assert len(remaining()) == 4
+
+        upstream.handlers[("DELETE", "/api/v1/order/all")] = lambda data: (200, [])
+        resp = client.delete(self.RESOURCE_URL + "?symbol=XBTUSD&side=Sell", headers=self.VALID_API_SECRET)
+        assert resp.status_code == 204
+        assert json.loads(upstream.requests[-1][3]) == {"symbol": "XBTUSD", "filter": '{"side": "Sell"}'}
+        assert remaining() == [("ETHUSD", "Sell"), ("XBTUSD", "Buy"), ("XBTUSD", "Buy")]
+
+        resp = client.delete(self.RESOURCE_URL, headers=self.VALID_API_SECRET)
+        assert resp.status_code == 204
+        assert json.loads(upstream.requests[-1][3]) == {}
+        assert remaining() == []
+
+    def test_post_async(self, client, upstream, market, monkeypatch):
+        """
+        Tests that an order submitted with Prefer: respond-async is accepted
+        right away and that its submission tells how it went
+        """
+        upstream.handlers[("POST", "/api/v1/order")] = lambda data: (200, {
+            "orderID": "50000000-0000-0000-0000-000000000000", "orderQty": data["orderQty"],
+            "side": data["side"], "symbol": data["symbol"], "price": data["price"]})
+        headers = dict(self.VALID_API_SECRET, Prefer="respond-async")
+        resp = client.post(self.RESOURCE_URL, json=_get_order_json(), headers=headers)
+        assert resp.status_code == 202
+        assert resp.headers["Preference-Applied"] == "respond-async"
+        submission = resp.headers["Location"]
+
+        resp = client.get(submission + "?wait=5", headers=self.VALID_API_SECRET)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["status"] == "done"
+        _check_control_get_method("order", client, body, headers=self.VALID_API_SECRET)
+        resp = client.get(submission, headers={"api_secret": "j9ey6Lk2xR6V-qJRfN-HqD2nfOGme0FnBddp1cxqK6k8G123"})
+        assert resp.status_code == 401
+        resp = client.get(submission.replace("RBu", "RB1"), headers=self.VALID_API_SECRET)
+        assert resp.status_code == 404
+
+        upstream.handlers[("POST", "/api/v1/order")] = lambda data: (400, {"error": {"message": "Bad price"}})
+        resp = client.post(self.RESOURCE_URL, json=_get_order_json(), headers=headers)
+        body = json.loads(client.get(resp.headers["Location"] + "?wait=5", headers=self.VALID_API_SECRET).data)
+        assert body["status"] == "failed"
+        assert body["error"] == {"status": 400, "title": "Upstream Error", "message": "Bad price"}
+
+        body = json.loads(client.get("/orders/queue/").data)
+        assert body["completed"] >= 1 and body["failed"] >= 1
+
+        # without workers the queue fills up
+        monkeypatch.setattr(app_module, "order_queue", OrderQueue(workers=0, max_size=1))
+        assert client.post(self.RESOURCE_URL, json=_get_order_json(), headers=headers).status_code == 202
+        assert client.post(self.RESOURCE_URL, json=_get_order_json(), headers=headers).status_code == 503
+
+    def test_etag(self, client, upstream, market):
+        """
+        Tests that the order list is answered with 304 until the orders of
+        the account change
+        """
+        resp = client.get(self.RESOURCE_URL, headers=self.VALID_API_SECRET)
+        # the body is streamed, reading it ends the request
+        assert json.loads(resp.data)["items"]
+        etag = resp.headers["ETag"]
+        headers = dict(self.VALID_API_SECRET, **{"If-None-Match": etag})
+        assert client.get(self.RESOURCE_URL, headers=headers).status_code == 304
+        resp = client.get(self.RESOURCE_URL + "?limit=1", headers=headers)
+        assert resp.status_code == 200 and resp.data
+        # the tag of one account doesn't match the list of another
+        resp = client.get("/accounts/79z47uUikMoPe2eADqfJzRB1/orders/", headers=headers)
+        assert resp.status_code == 200 and resp.data
+
+        upstream.handlers[("POST", "/api/v1/order")] = lambda data: (200, {
+            "orderID": "60000000-0000-0000-0000-000000000000", "orderQty": data["orderQty"],
+            "side": data["side"], "symbol": data["symbol"], "price": data["price"]})
+        client.post(self.RESOURCE_URL, json=_get_order_json(), headers=self.VALID_API_SECRET)
+        resp = client.get(self.RESOURCE_URL, headers=headers)
+        assert resp.status_code == 200
+        assert resp.headers["ETag"] != etag
+        assert len(json.loads(resp.data)["items"]) == 2
+
+    def test_rate_limited(self, client, upstream, monkeypatch):
+        """
+        Tests that once BitMEX says the limit is reached, calls are answered
+        with 429 without being sent
+        """
+        monkeypatch.setattr(app_module, "bitmex", BitMEXRestClient(upstream.url, limiter=RateLimiter(), max_wait=0))
+        upstream.handlers[("POST", "/api/v1/order")] = lambda data: (429, {"error": {"message": "Slow down"}},
+                                                                     {"Retry-After": "30"})
+        resp = client.post(self.RESOURCE_URL, json=_get_order_json(), headers=self.VALID_API_SECRET)
+        assert resp.status_code == 429
+        resp = client.post(self.RESOURCE_URL, json=_get_order_json(), headers=self.VALID_API_SECRET)
+        assert resp.status_code == 429
+        assert int(resp.headers["Retry-After"]) == 30
+        assert len(upstream.requests) == 1
+
+    def test_upstream_retry_after(self, client, upstream):
+        """
+        Tests that the Retry-After of a 429 from BitMEX is passed on for
+        single, bulk and cancel calls
+        """
+        slow_down = lambda data: (429, {"error": {"message": "Slow down"}}, {"Retry-After": "17"})
+        for method, path in (("POST", "/api/v1/order"), ("POST", "/api/v1/order/bulk"),
+                             ("DELETE", "/api/v1/order/all")):
+            upstream.handlers[(method, path)] = slow_down
+        for resp in (client.post(self.RESOURCE_URL, json=_get_order_json(), headers=self.VALID_API_SECRET),
+                     client.post(self.RESOURCE_URL, json=[_get_order_json()], headers=self.VALID_API_SECRET),
+                     client.delete(self.RESOURCE_URL, headers=self.VALID_API_SECRET)):
+            assert resp.status_code == 429
+            assert resp.headers["Retry-After"] == "17"
+
+    def test_unreachable(self, client, monkeypatch):
+        """
+        Tests that a failed call to BitMEX is a 502 and stores nothing
+        """
+        monkeypatch.setattr(app_module, "bitmex", BitMEXRestClient("http://127.0.0.1:9", connect_timeout=0.5))
+        with app.app_context():
+            count = Orders.query.count()
+        resp = client.post(self.RESOURCE_URL, json=_get_order_json(), headers=self.VALID_API_SECRET)
+        assert resp.status_code == 502
+        with app.app_context():
+            assert Orders.query.count() == count
+
+
+class TestOrderBook(object):
+    RESOURCE_URL = "/orderbook/"
+
+    def test_get(self, client, market):
+        """
+        Tests get method with depth and grouping and that the body is served
+        from the cache until the book changes
+        """
+        resp = client.get(self.RESOURCE_URL, query_string={"symbol": "XBTUSD"})
+        assert resp.status_code == 200
+        market[0].apply({"table": "orderBookL2", "action": "partial", "keys": ["symbol", "id", "side"],
+                         "data": [{"symbol": "XBTUSD", "id": 1, "side": "Sell", "size": 10, "price": 3502.0},
+                                  {"symbol": "XBTUSD", "id": 2, "side": "Buy", "size": 20, "price": 3499.0},
+                                  {"symbol": "XBTUSD", "id": 3, "side": "Buy", "size": 30, "price": 3497.5}]})
+        resp = client.get(self.RESOURCE_URL, query_string={"symbol": "XBTUSD", "depth": 1})
+        body = json.loads(resp.data)
+        assert body["bids"] == [{"price": 3499.0, "size": 20}]
+        assert body["asks"] == [{"price": 3502.0, "size": 10}]
+        _check_control_get_method("self", client, body)
+        assert orderbook_cache.stats()["hits"] == 1
+
+        resp = client.get(self.RESOURCE_URL, query_string={"symbol": "XBTUSD", "grouping": 5})
+        assert json.loads(resp.data)["bids"] == [{"price": 3495, "size": 50}]
+
+        # invalid query parameters for 400
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL, query_string={"symbol": "XBTUSD", "depth": "x"})
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL, query_string={"symbol": "XBTUSD", "grouping": 0})
+        assert resp.status_code == 400
+
+    def test_etag(self, client, market):
+        """
+        Tests that polling an unchanged book is answered with 304
+        """
+        query = {"symbol": "XBTUSD", "depth": 1}
+        resp = client.get(self.RESOURCE_URL, query_string=query)
+        etag = resp.headers["ETag"]
+        resp = client.get(self.RESOURCE_URL, query_string=query, headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+        assert resp.data == b""
+        assert resp.headers["ETag"] == etag
+        # other query, other representation
+        resp = client.get(self.RESOURCE_URL, query_string={"symbol": "XBTUSD"}, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+
+        market[0].apply({"table": "orderBookL2", "action": "partial", "keys": ["symbol", "id", "side"],
+                         "data": [{"symbol": "XBTUSD", "id": 1, "side": "Sell", "size": 10, "price": 3502.0}]})
+        resp = client.get(self.RESOURCE_URL, query_string=query, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert resp.headers["ETag"] != etag
+
+    def test_unavailable(self, client, market, monkeypatch):
+        """
+        Tests that a symbol BitMEX rejects is a 400 and a websocket that
+        can't connect a 503
+        """
+        monkeypatch.setattr(ws_manager, "factory", _unavailable(WebSocketRejected("Unknown or expired symbol.")))
+        resp = client.get(self.RESOURCE_URL, query_string={"symbol": "NOPE"})
+        assert resp.status_code == 400
+        assert "Unknown or expired symbol" in json.loads(resp.data)["@error"]["@messages"][0]
+        monkeypatch.setattr(ws_manager, "factory", _unavailable(websocket.WebSocketTimeoutException("Couldn't connect")))
+        resp = client.get(self.RESOURCE_URL, query_string={"symbol": "XBTUSD"})
+        assert resp.status_code == 503
+
+    def test_reconnect(self, client, market):
+        """
+        Tests that the book of a new connection isn't served from the cached
+        body of the one before, although its version starts over
+        """
+        query = {"symbol": "XBTUSD", "depth": 1}
+        client.get(self.RESOURCE_URL, query_string=query)
+        market[0].apply({"table": "orderBookL2", "action": "partial", "keys": ["symbol", "id", "side"],
+                         "data": [{"symbol": "XBTUSD", "id": 1, "side": "Sell", "size": 10, "price": 3502.0}]})
+        assert json.loads(client.get(self.RESOURCE_URL, query_string=query).data)["asks"][0]["size"] == 10
+        # the idle connection is closed and a new one gets its partial before the next request
+        ws_manager.close_all()
+        with ws_manager.connection(app.config["BITMEX_WS_ENDPOINT"], symbol="XBTUSD") as ws:
+            ws.apply({"table": "orderBookL2", "action": "partial", "keys": ["symbol", "id", "side"],
+                      "data": [{"symbol": "XBTUSD", "id": 1, "side": "Sell", "size": 99, "price": 3502.0}]})
+        assert market[1].order_book("XBTUSD").version == market[0].order_book("XBTUSD").version
+        assert json.loads(client.get(self.RESOURCE_URL, query_string=query).data)["asks"][0]["size"] == 99
+
+
+def _execution(i, symbol="XBTUSD"):
+    return {"execID": "00000000-0000-0000-0000-00000000000{}".format(i), "orderID": "order-{}".format(i),
+            "symbol": symbol, "side": "Buy", "execType": "Trade", "lastPx": 3500.0 + i, "lastQty": 1,
+            "timestamp": "2019-03-14T12:00:0{}.000Z".format(i)}
+
+
+class TestOrderHistory(object):
+    RESOURCE_URL = "/accounts/79z47uUikMoPe2eADqfJzRBu/orders/history/"
+    VALID_API_SECRET = {"api_secret": "j9ey6Lk2xR6V-qJRfN-HqD2nfOGme0FnBddp1cxqK6k8Gbjd"}
+    INVALID_API_SECRET = {"api_secret": "wrong"}
+
+    def test_get(self, client, market):
+        """
+        Tests that executions of the account websocket are stored and listed
+        newest first in pages, and the filters and error responses
+        """
+        resp = client.get(self.RESOURCE_URL, headers=self.INVALID_API_SECRET)
+        assert resp.status_code == 401
+        resp = client.get(self.RESOURCE_URL, headers=self.VALID_API_SECRET)
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["items"] == []
+
+        account = market[0]
+        account.apply({"table": "execution", "action": "partial", "keys": ["execID"],
+                       "data": [_execution(i) for i in range(3)]})
+        account.apply({"table": "execution", "action": "insert",
+                       "data": [_execution(2), _execution(3), _execution(4, symbol="ETHUSD")]})
+
+        ids = []
+        body = json.loads(client.get(self.RESOURCE_URL + "?limit=2", headers=self.VALID_API_SECRET).data)
+        while True:
+            ids += [item["id"][-1] for item in body["items"]]
+            if "next" not in body["@controls"]:
+                break
+            body = json.loads(client.get(body["@controls"]["next"]["href"], headers=self.VALID_API_SECRET).data)
+        assert ids == ["4", "3", "2", "1", "0"]
+
+        resp = client.get(self.RESOURCE_URL, query_string={"symbol": "XBTUSD", "start": "2019-03-14T12:00:01Z",
+                                                           "end": "2019-03-14T12:00:02Z"},
+                          headers=self.VALID_API_SECRET)
+        body = json.loads(resp.data)
+        assert [item["price"] for item in body["items"]] == [3502.0, 3501.0]
+        assert body["items"][0]["timestamp"] == "2019-03-14T12:00:02.000Z"
+        _check_control_get_method("self", client, body, headers=self.VALID_API_SECRET)
+
+        # invalid query parameters for 400
+        for query in ({"after": "nope"}, {"limit": 0}, {"start": "yesterday"}):
+            resp = client.get(self.RESOURCE_URL, query_string=query, headers=self.VALID_API_SECRET)
+            assert resp.status_code == 400
+
+    def test_feed_kept_open(self, client, market, monkeypatch):
+        """
+        Tests that the account websocket stays open after the request, so
+        executions made while nobody polls are recorded too
+        """
+        client.get(self.RESOURCE_URL, headers=self.VALID_API_SECRET)
+        account = [feed for feed in market if feed.api_key][0]
+        monkeypatch.setattr(ws_manager, "idle_timeout", 0)
+        ws_manager.reap()
+        assert not account.exited
+        account.apply({"table": "execution", "action": "partial", "keys": ["execID"], "data": [_execution(1)]})
+        body = json.loads(client.get(self.RESOURCE_URL, headers=self.VALID_API_SECRET).data)
+        assert [item["id"] for item in body["items"]] == [_execution(1)["execID"]]
+        assert [feed for feed in market if feed.api_key] == [account]
+
+    def test_unavailable(self, client, market, monkeypatch):
+        """
+        Tests that an account websocket BitMEX rejects is a 400 and one that
+        can't connect a 503
+        """
+        monkeypatch.setattr(ws_manager, "factory", _unavailable(WebSocketRejected("Invalid API Key.")))
+        resp = client.get(self.RESOURCE_URL, headers=self.VALID_API_SECRET)
+        assert resp.status_code == 400
+        monkeypatch.setattr(ws_manager, "factory", _unavailable(websocket.WebSocketTimeoutException("Couldn't connect")))
+        resp = client.get(self.RESOURCE_URL, headers=self.VALID_API_SECRET)
+        assert resp.status_code == 503
+
+
+class TestPriceActionRange(object):
+    RESOURCE_URL = "/priceaction/"
+
+    def test_get(self, client, market):
+        """
+        Tests that trades of a time range are listed from the trade tape
+        """
+        resp = client.get(self.RESOURCE_URL, query_string={"symbol": "XBTUSD", "start": "2019-03-14"})
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["items"] == []
+        market[0].apply({"table": "trade", "action": "insert", "data": [
+            {"timestamp": "2019-03-14T12:00:0{}.000Z".format(i), "symbol": "XBTUSD", "side": "Buy", "size": 1,
+             "price": 3500.0 + i, "trdMatchID": "00000000-0000-0000-0000-00000000000{}".format(i)} for i in range(5)]})
+        resp = client.get(self.RESOURCE_URL, query_string={"symbol": "XBTUSD", "start": "2019-03-14T12:00:01Z",
+                                                           "end": "2019-03-14T12:00:03Z", "count": 2})
+        body = json.loads(resp.data)
+        assert [trade["price"] for trade in body["items"]] == [3501.0, 3502.0]
+        _check_control_get_method("self", client, body)
+
+        # invalid query parameters for 400
+        for query in ({"symbol": "XBTUSD", "start": "yesterday"}, {"symbol": "XBTUSD", "end": "2019-03-14", "count": -1},
+                      {"symbol": "../XBTUSD", "start": "2019-03-14"}):
+            resp = client.get(self.RESOURCE_URL, query_string=query)
+            assert resp.status_code == 400
+
+    def test_etag(self, client, market):
+        """
+        Tests that polling the latest trade is answered with 304 until a
+        trade comes in
+        """
+        def trade(i):
+            return {"timestamp": "2019-03-14T12:00:0{}.000Z".format(i), "symbol": "XBTUSD", "side": "Buy",
+                    "size": 1, "price": 3500.0 + i, "trdMatchID": "00000000-0000-0000-0000-00000000000{}".format(i)}
+        client.get(self.RESOURCE_URL, query_string={"symbol": "XBTUSD"})
+        market[0].apply({"table": "trade", "action": "insert", "data": [trade(1)]})
+        resp = client.get(self.RESOURCE_URL, query_string={"symbol": "XBTUSD"})
+        assert json.loads(resp.data)["price"] == 3501.0
+        headers = {"If-None-Match": resp.headers["ETag"]}
+        assert client.get(self.RESOURCE_URL, query_string={"symbol": "XBTUSD"}, headers=headers).status_code == 304
+
+        market[0].apply({"table": "trade", "action": "insert", "data": [trade(2)]})
+        resp = client.get(self.RESOURCE_URL, query_string={"symbol": "XBTUSD"}, headers=headers)
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["price"] == 3502.0
+
+
+class TestBucketedPriceAction(object):
+    RESOURCE_URL = "/priceaction/bucketed/"
+
+    def test_get(self, client, market):
+        """
+        Tests that the trades of the websocket end up in the bars and that
+        wrong query parameters give proper error responses
+        """
+        resp = client.get(self.RESOURCE_URL, query_string={"symbol": "XBTUSD", "binSize": "5m"})
+        assert resp.status_code == 200
+        market[0].apply({"table": "trade", "action": "insert", "data": [
+            {"timestamp": "2019-03-14T12:00:01.000Z", "symbol": "XBTUSD", "side": "Buy", "size": 10, "price": 3500.0},
+            {"timestamp": "2019-03-14T12:04:01.000Z", "symbol": "XBTUSD", "side": "Sell", "size": 30, "price": 3400.0},
+            {"timestamp": "2019-03-14T12:05:01.000Z", "symbol": "XBTUSD", "side": "Sell", "size": 1, "price": 3300.0}]})
+        resp = client.get(self.RESOURCE_URL, query_string={"symbol": "XBTUSD", "binSize": "5m",
+                                                           "end": "2019-03-14T12:00:00Z"})
+        body = json.loads(resp.data)
+        bar, = body["items"]
+        assert (bar["open"], bar["high"], bar["low"], bar["close"], bar["volume"]) == (3500.0, 3500.0, 3400.0, 3400.0, 40)
+        assert bar["vwap"] == 3425.0
+        _check_control_get_method("self", client, body)
+        resp = client.get(self.RESOURCE_URL, query_string={"symbol": "XBTUSD", "binSize": "5m", "count": 1})
+        assert json.loads(resp.data)["items"][0]["close"] == 3300.0
+
+        # invalid query parameters for 400
+        for query in ({}, {"symbol": "XBTUSD", "binSize": "2m"}, {"symbol": "XBTUSD", "start": "yesterday"},
+                      {"symbol": "XBTUSD", "count": 0}):
+            resp = client.get(self.RESOURCE_URL, query_string=query)
+            assert resp.status_code == 400
+
+    def test_unavailable(self, client, market, monkeypatch):
+        """
+        Tests that a symbol BitMEX rejects is a 400 and a websocket that
+        can't connect a 503
+        """
+        monkeypatch.setattr(ws_manager, "factory", _unavailable(WebSocketRejected("Unknown or expired symbol.")))
+        resp = client.get(self.RESOURCE_URL, query_string={"symbol": "NOPE"})
+        assert resp.status_code == 400
+        monkeypatch.setattr(ws_manager, "factory", _unavailable(websocket.WebSocketTimeoutException("Couldn't connect")))
+        resp = client.get(self.RESOURCE_URL, query_string={"symbol": "XBTUSD"})
+        assert resp.status_code == 503
+
+
 class TestPositions(object):
     RESOURCE_URL = "/accounts/79z47uUikMoPe2eADqfJzRBu/positions/"
     INVALID_URL = "/accounts/79z47uUikMoPe2eADqfJzRxx/positions/"
@@ -461,6 +1083,23 @@ class TestPositions(object):
             assert "avgEntryPrice" in item
             assert "liquidationPrice" in item
 
+    def test_etag(self, client, market):
+        """
+        Tests that polling unchanged positions is answered with 304
+        """
+        resp = client.get(self.RESOURCE_URL, headers=self.VALID_API_SECRET)
+        assert json.loads(resp.data)["items"] == []
+        headers = dict(self.VALID_API_SECRET, **{"If-None-Match": resp.headers["ETag"]})
+        assert client.get(self.RESOURCE_URL, headers=headers).status_code == 304
+
+        account = [feed for feed in market if feed.api_key][0]
+        account.apply({"table": "position", "action": "partial", "keys": ["account", "symbol"],
+                       "data": [{"account": 1, "symbol": "XBTUSD", "currentQty": 10, "crossMargin": True,
+                                 "leverage": 100, "avgEntryPrice": 3500.0, "liquidationPrice": 3000.0}]})
+        resp = client.get(self.RESOURCE_URL, headers=headers)
+        assert resp.status_code == 200
+        assert len(json.loads(resp.data)["items"]) == 1
+
 class TestPosition(object):
     RESOURCE_URL = "/accounts/79z47uUikMoPe2eADqfJzRBu/positions/ADAM19/"
     INVALID_URL = "/accounts/79z47uUikMoPe2eADqfJzRxx/positions/asdf123/"
@@ -1,14 +1,32 @@
-from flask import Flask, Response, request
+from flask import Flask, Response, request, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.exc import IntegrityError, DataError
 from flask_restful import Resource, Api
 import requests
-from jsonschema import validate, ValidationError
-from utils import MasonBuilder
+from jsonschema import ValidationError
+from validation import SchemaValidator
+from utils import MasonBuilder, HrefTemplates, parse_timestamp, format_timestamp
 import json
-from bitmex_websocket import BitMEXWebsocket
-from util.api_key import generate_nonce, generate_signature
-from database import db, User, Orders
+from functools import partial, lru_cache
+from urllib.parse import urlencode
+import websocket
+from bitmex_websocket import BitMEXWebsocket, WebSocketRejected
+from async_bitmex_websocket import FeedLoop
+from ws_manager import WebsocketManager
+from caching import VersionedCache, AccountCache, Versions
+from bars import BarAggregator, BIN_SIZES
+from trade_tape import TradeTape
+import os
+import hashlib
+from rest_client import BitMEXRestClient
+from order_queue import OrderQueue, QueueFull
+from rate_limit import RateLimiter, RateLimited
+import math
+from database import db, User, Orders, Execution
+from executions import ExecutionRecorder
+from reconciler import OrderReconciler, order_values
+from account_feeds import AccountFeeds
+from sqlalchemy import tuple_
 import traceback
 from sqlalchemy.engine import Engine
 from sqlalchemy import event
@@ -23,7 +41,106 @@ MASON = "application/vnd.mason+json"
 app = Flask(__name__)
 app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///test.db"
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+app.config["BITMEX_WS_ENDPOINT"] = "https://testnet.bitmex.com/api/v1"
+# seconds an unused websocket is kept open before it is closed
+app.config["WS_IDLE_TIMEOUT"] = 60
+# seconds a new websocket may take to connect and receive its partials
+app.config["WS_READY_TIMEOUT"] = 10
+# run all websockets on one asyncio loop instead of a thread per connection
+app.config["WS_ASYNC"] = False
+# bars kept per symbol and bin size, and the most a request can get
+app.config["BAR_CAPACITY"] = 1000
+app.config["BAR_MAX_COUNT"] = 1000
+# directory of the files every received trade is written to, and the most trades a request can get
+app.config["TRADE_TAPE_DIR"] = os.path.join(app.instance_path, "trades")
+app.config["TRADE_MAX_COUNT"] = 1000
+# most orders one bulk request can place
+app.config["BULK_MAX_ORDERS"] = 100
+# seconds between the writes of the order updates of the account websockets, and how long the
+# updates of an order that isn't stored yet are kept
+app.config["RECONCILE_INTERVAL"] = 0.2
+app.config["RECONCILE_GRACE"] = 5
+# seconds between the checks which accounts have open orders and need their websocket kept open
+app.config["ACCOUNT_FEED_INTERVAL"] = 30
+# worker threads that place the orders submitted with Prefer: respond-async, how many can
+# wait for them, how many finished submissions can still be looked up and the longest wait
+# in seconds a client can ask for when it polls one
+app.config["ORDER_QUEUE_WORKERS"] = 4
+app.config["ORDER_QUEUE_SIZE"] = 1000
+app.config["ORDER_QUEUE_KEEP"] = 10000
+app.config["ORDER_WAIT_MAX"] = 30
+# BitMEX REST API, the size of its connection pool and the timeouts of a call in seconds
+app.config["BITMEX_REST_URL"] = "https://testnet.bitmex.com"
+app.config["BITMEX_POOL_SIZE"] = 10
+app.config["BITMEX_CONNECT_TIMEOUT"] = 3.05
+app.config["BITMEX_READ_TIMEOUT"] = 10
+# calls an API key can make to BitMEX in a minute until its responses tell otherwise, and the
+# longest a call waits for its turn before it is answered with 429
+app.config["BITMEX_RATE_LIMIT"] = 60
+app.config["BITMEX_RATE_MAX_WAIT"] = 10
+# accounts kept in the in-process cache and for how many seconds
+app.config["ACCOUNT_CACHE_SIZE"] = 10000
+app.config["ACCOUNT_CACHE_TTL"] = 60
+# default and largest page of the accounts and orders listings
+app.config["PAGE_SIZE"] = 100
+app.config["MAX_PAGE_SIZE"] = 1000
+# default and largest page of the order history
+app.config["HISTORY_PAGE_SIZE"] = 100
+app.config["HISTORY_MAX_PAGE_SIZE"] = 1000
 api = Api(app)
+# hrefs of the resources from templates built once per route, see HrefTemplates
+href = HrefTemplates(api)
+if app.config["WS_ASYNC"]:
+    ws_factory = FeedLoop(timeout=app.config["WS_READY_TIMEOUT"]).open
+else:
+    ws_factory = partial(BitMEXWebsocket, timeout=app.config["WS_READY_TIMEOUT"])
+ws_manager = WebsocketManager(factory=ws_factory, idle_timeout=app.config["WS_IDLE_TIMEOUT"])
+# pooled keep-alive connections to the BitMEX REST API, every call waits for its turn in the
+# rate limiter of its API key
+rate_limiter = RateLimiter(limit=app.config["BITMEX_RATE_LIMIT"])
+bitmex = BitMEXRestClient(base_url=app.config["BITMEX_REST_URL"], pool_size=app.config["BITMEX_POOL_SIZE"],
+                          connect_timeout=app.config["BITMEX_CONNECT_TIMEOUT"],
+                          read_timeout=app.config["BITMEX_READ_TIMEOUT"],
+                          limiter=rate_limiter, max_wait=app.config["BITMEX_RATE_MAX_WAIT"])
+# orders placed in the background, see OrdersResource.post
+order_queue = OrderQueue(workers=app.config["ORDER_QUEUE_WORKERS"], max_size=app.config["ORDER_QUEUE_SIZE"],
+                         keep=app.config["ORDER_QUEUE_KEEP"])
+# change counters of the orders of every account, for ETags
+versions = Versions()
+# accounts by api_public, saves the database lookup of every authenticated request
+account_cache = AccountCache(max_entries=app.config["ACCOUNT_CACHE_SIZE"], ttl=app.config["ACCOUNT_CACHE_TTL"])
+# serialized order book bodies per (symbol, depth, grouping), valid until the book changes
+orderbook_cache = VersionedCache()
+# OHLCV bars built from the trades of the market websockets
+bars = BarAggregator(capacity=app.config["BAR_CAPACITY"])
+# every trade of the market websockets, for time range queries
+tape = TradeTape(app.config["TRADE_TAPE_DIR"])
+
+def attach_market(ws):
+    """ feeds the bars and the trade tape from the market websockets,
+        there is one per symbol so no trade is counted twice
+    """
+    if ws.api_key is None:
+        bars.attach(ws)
+        tape.attach(ws)
+
+ws_manager.add_connect_hook(attach_market)
+# executions of the account websockets, for the order history
+recorder = ExecutionRecorder(app)
+# order updates of the account websockets, written to Orders in batches
+reconciler = OrderReconciler(app, interval=app.config["RECONCILE_INTERVAL"], grace=app.config["RECONCILE_GRACE"],
+                             versions=versions)
+
+def attach_account(ws):
+    """ records the executions and follows the orders of the account websockets """
+    if ws.api_key is not None:
+        recorder.attach(ws)
+        reconciler.attach(ws)
+
+ws_manager.add_connect_hook(attach_account)
+# account websockets of the accounts with open orders, kept open for the two above
+account_feeds = AccountFeeds(app, ws_manager, app.config["BITMEX_WS_ENDPOINT"],
+                             interval=app.config["ACCOUNT_FEED_INTERVAL"])
 db.init_app(app)
 with app.app_context():
     db.create_all()
@@ -31,10 +148,13 @@ with app.app_context():
 class MasonControls(MasonBuilder):
     """ Based on the MasonControls class thas was used in Exercise 3
         Makes the response bodies and attaches Hypermedia controls to
-        them. Also, holds the schemas for POST and PATCH methods.
+        them. Also, holds the schemas for POST and PATCH methods. The
+        schemas are built once and shared by every response, they must not
+        be changed.
     """
 
     @staticmethod
+    @lru_cache(maxsize=None)
     def account_schema():
         """Schema of the account"""
         schema = {
@@ -58,6 +178,7 @@ class MasonControls(MasonBuilder):
         return schema
 
     @staticmethod
+    @lru_cache(maxsize=None)
     def order_schema():
         """Schema of the order"""
         schema = {
@@ -85,6 +206,18 @@ class MasonControls(MasonBuilder):
         return schema
 
     @staticmethod
+    @lru_cache(maxsize=None)
+    def bulk_order_schema():
+        """ Schema of a list of orders placed with one request """
+        return {
+            "type": "array",
+            "items": MasonControls.order_schema(),
+            "minItems": 1,
+            "maxItems": app.config["BULK_MAX_ORDERS"]
+        }
+
+    @staticmethod
+    @lru_cache(maxsize=None)
     def position_schema():
         """ Schema for the position patch method """
         schema = {
@@ -100,55 +233,61 @@ class MasonControls(MasonBuilder):
 
     def add_control_accounts(self):
         """ adds accounts-all control to response body """
-        self.add_control("accounts-all", href=api.url_for(Accounts),
+        self.add_control("accounts-all", href=href(Accounts),
                         method="GET",
                         title="List all the accounts registered")
 
     def add_control_account(self, apikey):
         """ adds account control to response body """
-        self.add_control("account", href=api.url_for(Account, apikey=apikey),
+        self.add_control("account", href=href(Account, apikey=apikey),
                         method="GET",
                         title="Login to account")
 
     def add_control_orders(self, apikey):
         """ adds orders-all control to response body """
-        self.add_control("orders-all", href=api.url_for(OrdersResource, apikey=apikey),
+        self.add_control("orders-all", href=href(OrdersResource, apikey=apikey),
                         method="GET",
                         title="Get open orders")
 
+    def add_control_orderhistory(self, apikey):
+        """ adds order-history control to response body """
+        self.add_control("order-history", href=href(OrderHistory, apikey=apikey),
+                        method="GET",
+                        title="Get the executions of the account's orders")
+
     def add_control_orderbook(self):
         """ adds orderbook control to response body """
-        self.add_control("orderbook", href=api.url_for(OrderBook),
+        self.add_control("orderbook", href=href(OrderBook),
                         method="GET",
                         title="Get order book data")
 
     def add_control_priceaction(self):
         """ adds priceaction control to response body """
-        self.add_control("priceaction", href=api.url_for(PriceAction),
+        self.add_control("priceaction", href=href(PriceAction),
                         method="GET",
                         title="Show recent trades that happened in the market")
 
     def add_control_positions(self, apikey):
         """ adds positions-all control to response body """
-        self.add_control("positions-all", href=api.url_for(Positions, apikey=apikey),
+        self.add_control("positions-all", href=href(Positions, apikey=apikey),
                         method="GET",
                         title="Get open positions")
 
     def add_control_accountbalance(self, apikey):
         """ adds balance control to response body """
-        self.add_control("balance", href=api.url_for(AccountBalance, apikey=apikey),
+        self.add_control("balance", href=href(AccountBalance, apikey=apikey),
                         method="GET",
                         title="Get account balance")
 
     def add_control_transactionhistory(self, apikey):
         """ adds transactions control to response body """
-        self.add_control("transactions", href=api.url_for(TransactionHistory, apikey=apikey),
+        self.add_control("transactions", href=href(TransactionHistory, apikey=apikey),
                         method="GET",
                         title="Get history of the wallet transactions")
 
     def add_control_add_account(self):
         """ adds add-account control to response body """
-        self.add_control("add-account", href=api.url_for(Accounts),
+        self.add_control("add-account", href=href(Accounts),
                         method="POST",
                         encoding="json",
                         title="Add account to cryptotrading API",
@@ -156,65 +295,90 @@ class MasonControls(MasonBuilder):
 
     def add_control_delete_account(self, apikey):
         """ adds delete control for deleting to response body """
-        self.add_control("delete", href=api.url_for(Account, apikey=apikey),
+        self.add_control("delete", href=href(Account, apikey=apikey),
                         method="DELETE",
                         title="delete this account")
 
 
     def add_control_add_order(self, apikey):
         """ adds add-order control to response body """
-        self.add_control("add-order", href=api.url_for(OrdersResource, apikey=apikey),
+        self.add_control("add-order", href=href(OrdersResource, apikey=apikey),
                         method="POST",
                         encoding="json",
                         title="Add an order to Cryptotrading API",
                         schema=self.order_schema())
 
+    def add_control_add_orders(self, apikey):
+        """ adds add-orders control for placing many orders at once to response body """
+        self.add_control("add-orders", href=href(OrdersResource, apikey=apikey),
+                        method="POST",
+                        encoding="json",
+                        title="Add a list of orders to Cryptotrading API with one request",
+                        schema=self.bulk_order_schema())
+
+    def add_control_delete_orders(self, apikey):
+        """ adds delete-orders control for cancelling all orders to response body,
+            query variables symbol and side limit it to the matching ones
+        """
+        self.add_control("delete-orders", href=href(OrdersResource, apikey=apikey),
+                        method="DELETE",
+                        title="cancel all orders, or those of a symbol or side")
+
     def add_control_delete_order(self, apikey, orderid):
         """ adds delete control for deleting orders to response body """
-        self.add_control("delete", href=api.url_for(OrderResource, apikey=apikey, orderid=orderid),
+        self.add_control("delete", href=href(OrderResource, apikey=apikey, orderid=orderid),
                         method="DELETE",
                         title="delete this order")
 
 
+# validators of the request bodies, built once
+account_validator = SchemaValidator(MasonControls.account_schema())
+order_validator = SchemaValidator(MasonControls.order_schema())
+bulk_order_validator = SchemaValidator(MasonControls.bulk_order_schema())
+position_validator = SchemaValidator(MasonControls.position_schema())
 
 @app.route("/", methods=["GET"])
 def entrypoint():
     """ This is the view function for the API entry point """
     body = MasonControls()
     body.add_control_accounts()
-    body.add_control_orderbook() # resource is not implemented
+    body.add_control_orderbook()
     body.add_control_priceaction()
     return Response(json.dumps(body), status=200, mimetype=MASON)
 
 class Accounts(Resource):
     def get(self):
-        """ Lists all the accounts registered to cryptotrading api """
-        userlist_q = User.query.all()
-        userlist = []
-
-        if len(userlist_q) == 0:  # if there are no accounts registered
-            body = MasonControls(items=userlist)
-            body.add_control("self", href=api.url_for(Accounts))
-            body.add_control_add_account()
-            return Response(json.dumps(body), status=200, mimetype=MASON)
+        """ Lists the accounts registered to cryptotrading api a page at a
+            time. limit sets the page size and after is the cursor of the
+            next page given in the next control.
+        """
+        try:
+            limit, after = page_args(int)
+        except ValueError as e:
+            return create_error_response(400, "Query Error", str(e))
 
-        for user in userlist_q:
-            userbody=MasonControls(accountname = user.username,
-                                   api_public = user.api_public)
-            userbody.add_control("self", href=api.url_for(Account, apikey=user.api_public), title="login to account")
-            userlist.append(userbody)
+        userlist_q = User.query
+        if after is not None:
+            userlist_q = userlist_q.filter(User.id > after)
+        userlist_q = userlist_q.order_by(User.id)
 
-        body = MasonControls(items=userlist)
+        def item(user):
+            userbody = MasonControls(accountname = user.username,
+                                     api_public = user.api_public)
+            userbody.add_control("self", href=href(Account, apikey=user.api_public), title="login to account")
+            return userbody
 
+        body = MasonControls()
+        body.add_control("self", href=href(Accounts))
         body.add_control_add_account()
-        return Response(json.dumps(body), status=200, mimetype=MASON)
+        return stream_page(userlist_q, limit, item, lambda user: user.id, body, href(Accounts))
 
     def post(self):
         """ Makes new account to cryptotrading API. """
         if not request.json:
             return create_error_response(415, "Unsupported media type", "Requests must be JSON")
         try:
-            validate(request.json, MasonControls.account_schema())
+            account_validator.validate(request.json)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
@@ -224,16 +388,17 @@ class Accounts(Resource):
         try:
             db.session.add(user)
             db.session.commit()
+            account_cache.invalidate(user.api_public)
 
         except IntegrityError:
             return create_error_response(409, "Already exists",
                                         "Account with name '{}' already exists.".format(request.json["accountname"]))
-        return Response(status=201, headers={"Location": api.url_for(Account, apikey=request.json["api_public"])})
+        return Response(status=201, headers={"Location": href(Account, apikey=request.json["api_public"])})
 
 class Account(Resource):
     def get(self, apikey):
         """ Sending get to Account resource logins to that account. """
-        acc = User.query.filter_by(api_public=apikey).first()
+        acc = get_account(apikey)
         if not acc:
             return create_error_response(404, "Account does not exist", "Account with api-key '{}' does not exist.".format(apikey))
         if not authorize(acc, request):
@@ -241,8 +406,9 @@ class Account(Resource):
 
 
         body = MasonControls(accountname=acc.username, api_public=acc.api_public, api_secret=acc.api_secret)
-        body.add_control("self", api.url_for(Account, apikey=apikey))
+        body.add_control("self", href(Account, apikey=apikey))
         body.add_control_orders(apikey)
+        body.add_control_orderhistory(apikey)
         body.add_control_accountbalance(apikey)
         body.add_control_positions(apikey)
         body.add_control_transactionhistory(apikey)
@@ -252,19 +418,111 @@ class Account(Resource):
 
     def delete(self, apikey):
         """ Used for deleting the account """
-        acc = User.query.filter_by(api_public=apikey).first()
+        acc = get_account(apikey)
         if not acc:
             return create_error_response(404, "Account does not exist", "Account with api-key '{}' does not exist.".format(apikey))
         if not authorize(acc, request):
             return create_error_response(401, "Unauthorized", "No API-key or wrong API-key")
 
-        db.session.delete(acc)
+        db.session.delete(User.query.get(acc.id))
         db.session.commit()
+        account_cache.invalidate(apikey)
         return Response(status=204)
 
 
 
 
+def page_args(cursor_type):
+    """ Reads the limit and after query variables of a paginated listing.
+        after is converted with cursor_type. Raises ValueError with the
+        message for the error response.
+    """
+    try:
+        limit = int(request.args.get("limit", app.config["PAGE_SIZE"]))
+        after = cursor_type(request.args["after"]) if "after" in request.args else None
+    except ValueError:
+        raise ValueError("limit must be an integer and after a cursor from a next control")
+    if not 0 < limit <= app.config["MAX_PAGE_SIZE"]:
+        raise ValueError("limit must be between 1 and {}".format(app.config["MAX_PAGE_SIZE"]))
+    return limit, after
+
+def stream_page(query, limit, item, cursor, body, url):
+    """ Streams a page of a listing as a Mason body. The rows come from a
+        server-side cursor and each item is written out as soon as it is
+        built, so neither the rows nor the body are held in memory. body
+        holds the controls of the listing, a next control to the page after
+        the last row (cursor(row) gives its key) is added when there is one.
+    """
+    def generate():
+        yield '{"items": ['
+        last = None
+        for count, row in enumerate(query.limit(limit + 1).yield_per(100)):
+            if count == limit:
+                args = request.args.to_dict()
+                args["after"] = cursor(last)
+                body.add_control("next", href=url + "?" + urlencode(args), title="Next page")
+                break
+            if count:
+                yield ", "
+            yield json.dumps(item(row))
+            last = row
+        yield "], " + json.dumps(body)[1:]
+    return Response(stream_with_context(generate()), status=200, mimetype=MASON)
+
+def get_account(apikey):
+    """ returns the AccountRecord of the account with the api-key or None.
+        Served from the account cache, Accounts.post and Account.delete
+        invalidate it.
+    """
+    return account_cache.get(apikey, lambda: User.query.filter_by(api_public=apikey).first())
+
+class OrderError(Exception):
+    """ An order that could not be placed, with the status code, title and
+        message of its error response. retry_after is set when the rate
+        limiter held it back or BitMEX told when to retry.
+    """
+
+    def __init__(self, status_code, title, message, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.title = title
+        self.message = message
+        self.retry_after = retry_after
+
+def place_order(acc, api_secret, order):
+    """ posts an order that is valid against order_schema to BitMEX test net
+        and adds it to the database. Returns its order id, raises OrderError
+        if it could not be placed or stored. Needs an app context but no
+        request, so the workers of the order queue can call it.
+    """
+    url = '/api/v1/order'
+
+    data = {"symbol" : order["symbol"],
+            "orderQty" : order["size"],
+            "price" : order["price"],
+            "side" : order["side"]
+    }
+
+    try:
+        res = bitmex.post(url, data, acc.api_public, api_secret)
+    except requests.RequestException as e:
+        raise OrderError(*upstream_failure(e), retry_after=getattr(e, "retry_after", None))
+    if res.status_code != 200:
+        raise OrderError(*upstream_rejection(res), retry_after=upstream_retry_after(res))
+    json_response = json.loads(res.text)
+    placed = Orders(order_id=json_response["orderID"], order_side=json_response["side"],
+                    order_symbol=json_response["symbol"], user_id=acc.id, **order_values(json_response))
+    try:
+        db.session.add(placed)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        raise OrderError(409, "Already exists", "Order '{}' is already stored".format(json_response["orderID"]))
+    versions.bump(("orders", acc.id))
+    # the next refresh opens the account websocket that follows the new order
+    account_feeds.start()
+    return json_response["orderID"]
+
 def authorize(model, request):
     """ takes in user model and request object
         compares request object's api key to the saved api key in the database
@@ -281,7 +539,7 @@ def authorize(model, request):
 class AccountBalance(Resource):
     """ Get Account Margin Balance from BitMEX Websocket API """
     def get(self, apikey):
-        acc = User.query.filter_by(api_public=apikey).first()
+        acc = get_account(apikey)
         if not acc:
             return create_error_response(404, "Account does not exist",
              "Account with api-key '{}' does not exist.".format(apikey))
@@ -289,8 +547,10 @@ class AccountBalance(Resource):
             return create_error_response(401, "Unauthorized", "No API-key or wrong API-key")
 
 
-        ws = BitMEXWebsocket(endpoint="https://testnet.bitmex.com/api/v1", symbol="", api_key=acc.api_public, api_secret=request.headers["api_secret"])
-        balance = ws.funds()
+        with ws_manager.connection(app.config["BITMEX_WS_ENDPOINT"], symbol="",
+                                   api_key=acc.api_public,
+                                   api_secret=request.headers["api_secret"]) as ws:
+            balance = ws.funds()
 
         body = MasonControls()
         body.add_control_account(apikey)
@@ -300,7 +560,7 @@ class AccountBalance(Resource):
 class TransactionHistory(Resource):
     """ not implemented """
     def get(self, apikey):
-        acc = User.query.filter_by(api_public=apikey).first()
+        acc = get_account(apikey)
         if not acc:
             return create_error_response(404, "Account does not exist",
              "Account with api-key '{}' does not exist.".format(apikey))
@@ -315,46 +575,62 @@ class TransactionHistory(Resource):
 class OrdersResource(Resource):
     def get(self, apikey):
         """ lists the active orders made by the user """
-        acc = User.query.filter_by(api_public=apikey).first()
+        acc = get_account(apikey)
         if not acc:
             return create_error_response(404, "Account does not exist",
              "Account with api-key '{}' does not exist.".format(apikey))
         if not authorize(acc, request):
             return create_error_response(401, "Unauthorized", "No API-key or wrong API-key")
 
-        # quries all the orders made by the account
-        orderlist_q = Orders.query.filter_by(user_id=acc.id).all()
-        orderlist = []
+        try:
+            limit, after = page_args(str)
+        except ValueError as e:
+            return create_error_response(400, "Query Error", str(e))
+        # the status of the orders comes from the account websocket, make sure it is open
+        try:
+            account_feeds.hold(apikey, request.headers["api_secret"])
+        except websocket.WebSocketTimeoutException as e:
+            return websocket_error_response(e)
+        etag = etag_for(versions.get(("orders", acc.id)), request.full_path)
+        resp = not_modified(etag)
+        if resp is not None:
+            return resp
+
+        # quries the orders made by the account a page at a time
+        orderlist_q = Orders.query.filter_by(user_id=acc.id)
+        if after is not None:
+            orderlist_q = orderlist_q.filter(Orders.order_id > after)
+        orderlist_q = orderlist_q.order_by(Orders.order_id)
+
+        def item(order):
+            orderbody = MasonControls(id = order.order_id,
+                                      price = order.order_price,
+                                      symbol = order.order_symbol,
+                                      side = order.order_side,
+                                      size = order.order_size,
+                                      status = order.order_status,
+                                      filled = order.filled_qty,
+                                      leaves = order.leaves_qty)
+            orderbody.add_control("self", href(OrderResource, apikey=apikey, orderid=order.order_id))
+            return orderbody
 
-        if len(orderlist_q) == 0: # if there are no orders made by the account.
-            body = MasonControls(items=orderlist)
-            body.add_control_add_order(apikey)
-            body.add_control("self", api.url_for(OrdersResource, apikey=apikey))
-            body.add_control_account(apikey)
-            return Response(json.dumps(body), status=200, mimetype=MASON)
-
-        for order in orderlist_q:
-            orderbody=MasonControls(id = order.order_id,
-                                    price = order.order_price,
-                                    symbol = order.order_symbol,
-                                    side = order.order_side,
-                                    size = order.order_size)
-            orderbody.add_control("self", api.url_for(OrderResource, apikey=acc.api_public, orderid=order.order_id))
-            # add maybe link to order profile
-            orderlist.append(orderbody)
-
-        body = MasonControls(items=orderlist)
+        body = MasonControls()
         body.add_control_add_order(apikey)
-        body.add_control("self", api.url_for(OrdersResource, apikey=apikey))
+        body.add_control_add_orders(apikey)
+        body.add_control_delete_orders(apikey)
+        body.add_control("self", href(OrdersResource, apikey=apikey))
         body.add_control_account(apikey)
-        return Response(json.dumps(body), status=200, mimetype=MASON)
+        resp = stream_page(orderlist_q, limit, item, lambda order: order.order_id, body,
+                           href(OrdersResource, apikey=apikey))
+        resp.set_etag(etag)
+        return resp
 
 
     def post(self, apikey):
         """ posts new order to BitMEX test net and adds the order
             and its information to database.
         """
-        acc = User.query.filter_by(api_public=apikey).first()
+        acc = get_account(apikey)
         if not acc:
             return create_error_response(404, "Account does not exist",
              "Account with api-key '{}' does not exist.".format(apikey))
@@ -363,45 +639,133 @@ class OrdersResource(Resource):
 
         if not request.json:
             return create_error_response(415, "Unsupported media type", "Requests must be JSON")
+        if isinstance(request.json, list):
+            return self.post_bulk(acc, apikey)
         try:
-            validate(request.json, MasonControls.order_schema())
+            order_validator.validate(request.json)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
+        order = request.json
+        api_secret = request.headers["api_secret"]
+        if "respond-async" in request.headers.get("Prefer", ""):
+            # the order is placed by a worker of the queue and the client follows its submission
+            def job():
+                with app.app_context():
+                    return place_order(acc, api_secret, order)
+            try:
+                submission = order_queue.submit(acc.id, job)
+            except QueueFull as e:
+                return create_error_response(503, "Queue full", str(e))
+            return Response(status=202, headers={
+                "Location": href(OrderSubmission, apikey=apikey, submissionid=submission.id),
+                "Preference-Applied": "respond-async"})
+
+        try:
+            orderid = place_order(acc, api_secret, order)
+        except OrderError as e:
+            resp = create_error_response(e.status_code, e.title, e.message)
+            if e.retry_after is not None:
+                resp.headers["Retry-After"] = str(math.ceil(e.retry_after))
+            return resp
+        return Response(status=201, headers={"Location": href(OrderResource, apikey=apikey, orderid=orderid)})
 
+    def delete(self, apikey):
+        """ cancels all orders of the account in BitMEX test net, or with
+            query variables symbol and side only the matching ones, with one
+            call and then deletes them from the database in one statement
+        """
+        acc = get_account(apikey)
+        if not acc:
+            return create_error_response(404, "Account does not exist",
+             "Account with api-key '{}' does not exist.".format(apikey))
+        if not authorize(acc, request):
+            return create_error_response(401, "Unauthorized", "No API-key or wrong API-key")
 
-        # post to bitmex websocket api
-        # Receive order id with other data
-        # add the order then to our own database
-        url = '/api/v1/order'
+        symbol = request.args.get("symbol")
+        side = request.args.get("side")
+        if side is not None and side not in ("Buy", "Sell"):
+            return create_error_response(400, "Query Error", "side must be Buy or Sell")
 
-        data = {"symbol" : request.json["symbol"],
-                "orderQty" : request.json["size"],
-                "price" : request.json["price"],
-                "side" : request.json["side"]
-        }
+        url = '/api/v1/order/all'
+        data = {}
+        if symbol:
+            data["symbol"] = symbol
+        if side:
+            data["filter"] = json.dumps({"side": side})
+
+        try:
+            res = bitmex.delete(url, data, acc.api_public, request.headers["api_secret"])
+        except requests.RequestException as e:
+            return upstream_error_response(e)
+        if res.status_code != 200:
+            return upstream_rejected_response(res)
+
+        orders_q = Orders.query.filter_by(user_id=acc.id)
+        if symbol:
+            orders_q = orders_q.filter_by(order_symbol=symbol)
+        if side:
+            orders_q = orders_q.filter_by(order_side=side)
+        orders_q.delete(synchronize_session=False)
+        db.session.commit()
+        versions.bump(("orders", acc.id))
+        return Response(status=204)
 
-        headers = generate_headers(request.headers["api_secret"], acc.api_public, url, "POST", data)
+    def post_bulk(self, acc, apikey):
+        """ posts a list of orders to BitMEX test net with one bulk request
+            and adds the ones it accepted to the database in one transaction.
+            Responds with the result of every order, in the order they were
+            sent.
+        """
+        try:
+            bulk_order_validator.validate(request.json)
+        except ValidationError as e:
+            return create_error_response(400, "Invalid JSON document", str(e))
 
-        res = requests.post('https://testnet.bitmex.com' + url, json=data, headers=headers)
-        # print(res.text)
+        url = '/api/v1/order/bulk'
+        data = {"orders": [{"symbol" : order["symbol"],
+                            "orderQty" : order["size"],
+                            "price" : order["price"],
+                            "side" : order["side"]} for order in request.json]}
+
+        try:
+            res = bitmex.post(url, data, acc.api_public, request.headers["api_secret"])
+        except requests.RequestException as e:
+            return upstream_error_response(e)
+        if res.status_code != 200:
+            return upstream_rejected_response(res)
         json_response = json.loads(res.text)
-        order = Orders(order_id=json_response["orderID"],
-                        order_size=json_response["orderQty"], order_side=json_response["side"],
-                        order_symbol=json_response["symbol"], order_price=json_response["price"], user=acc)
+
+        # BitMEX answers with the orders in the order they were sent, rejected ones included
+        results = []
+        orders = []
+        for placed in json_response:
+            if placed.get("ordStatus") == "Rejected":
+                results.append(MasonBuilder(status=400, message=placed.get("ordRejReason") or placed.get("text")))
+                continue
+            orders.append(Orders(order_id=placed["orderID"], order_side=placed["side"],
+                                 order_symbol=placed["symbol"], user_id=acc.id, **order_values(placed)))
+            result = MasonBuilder(status=201, id=placed["orderID"])
+            result.add_control("self", href(OrderResource, apikey=apikey, orderid=placed["orderID"]))
+            results.append(result)
         try:
-            db.session.add(order)
+            db.session.add_all(orders)
             db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return create_error_response(409, "Already exists", "An order with the same id is already stored")
+        versions.bump(("orders", acc.id))
+        account_feeds.start()
 
-        except ValueError:
-            return create_error_response(409, "Already exists", "")
-
-        return Response(status=201, headers={"Location": api.url_for(OrderResource, apikey=apikey, orderid=json_response["orderID"])})
+        body = MasonControls(items=results)
+        body.add_control("self", href(OrdersResource, apikey=apikey))
+        body.add_control_account(apikey)
+        return Response(json.dumps(body), status=200, mimetype=MASON)
 
 class OrderResource(Resource):
     def get(self, apikey, orderid):
         """ gets single order indetified by its url from the database """
-        acc = User.query.filter_by(api_public=apikey).first()
+        acc = get_account(apikey)
         if not acc:
             return create_error_response(404, "Account does not exist",
              "Account with api-key '{}' does not exist.".format(apikey))
@@ -411,14 +775,21 @@ class OrderResource(Resource):
         order = Orders.query.filter_by(order_id=orderid).first()
         if not order:
                return create_error_response(404, "Order does not exist", "Order with orderid '{}' does not exist.".format(orderid))
+        try:
+            account_feeds.hold(apikey, request.headers["api_secret"])
+        except websocket.WebSocketTimeoutException as e:
+            return websocket_error_response(e)
 
         body = MasonControls(id = order.order_id,
                              price = order.order_price,
                              symbol = order.order_symbol,
                              side = order.order_side,
-                             size = order.order_size)
+                             size = order.order_size,
+                             status = order.order_status,
+                             filled = order.filled_qty,
+                             leaves = order.leaves_qty)
 
-        body.add_control("self", api.url_for(OrderResource, apikey=apikey, orderid=order.order_id))
+        body.add_control("self", href(OrderResource, apikey=apikey, orderid=order.order_id))
         body.add_control_orders(apikey)
         body.add_control_delete_order(apikey, orderid)
 
@@ -429,7 +800,7 @@ class OrderResource(Resource):
             and upon succesful deletion deletes the order from
             database.
         """
-        acc = User.query.filter_by(api_public=apikey).first()
+        acc = get_account(apikey)
         if not acc:
             return create_error_response(404, "Account does not exist", "Account with api-key '{}' does not exist.".format(apikey))
         if not authorize(acc, request):
@@ -445,80 +816,322 @@ class OrderResource(Resource):
         data = {"orderID" : orderid,
         }
 
-        headers = generate_headers(request.headers["api_secret"], acc.api_public, url, "DELETE", data)
-
-        res = requests.delete('https://testnet.bitmex.com' + url, json=data, headers=headers)
-
-
-
-        # if everything works, and deletion is succesfful, continue
+        try:
+            res = bitmex.delete(url, data, acc.api_public, request.headers["api_secret"])
+        except requests.RequestException as e:
+            return upstream_error_response(e)
+        if res.status_code != 200:
+            return upstream_rejected_response(res)
 
         db.session.delete(order)
         db.session.commit()
+        versions.bump(("orders", acc.id))
         return Response(status=204)
 
     def put(self, apikey, orderid):
         # not implemented
         return Response(status=503)
 
-class OrderHistory(Resource):
-    # not implemented
+class OrderSubmission(Resource):
+    """ An order submitted with Prefer: respond-async. With query variable
+        wait the response is held until the order has been placed or wait
+        seconds have passed.
+    """
+    def get(self, apikey, submissionid):
+        acc = get_account(apikey)
+        if not acc:
+            return create_error_response(404, "Account does not exist",
+             "Account with api-key '{}' does not exist.".format(apikey))
+        if not authorize(acc, request):
+            return create_error_response(401, "Unauthorized", "No API-key or wrong API-key")
+        submission = order_queue.get(submissionid)
+        if submission is None or submission.account != acc.id:
+            return create_error_response(404, "Submission does not exist",
+             "Submission with id '{}' does not exist.".format(submissionid))
+
+        try:
+            wait = float(request.args.get("wait", 0))
+        except ValueError:
+            return create_error_response(400, "Query Error", "wait must be a number")
+        if wait > 0:
+            submission.wait(min(wait, app.config["ORDER_WAIT_MAX"]))
+
+        body = MasonControls(id=submission.id, status=submission.status,
+                             queue_time=submission.queue_time())
+        if submission.status == "done":
+            body["order"] = submission.result
+            body.add_control("order", href(OrderResource, apikey=apikey, orderid=submission.result))
+        elif submission.status == "failed":
+            error = submission.error
+            if not isinstance(error, OrderError):
+                error = OrderError(500, "Internal Error", "The order could not be placed")
+            body["error"] = {"status": error.status_code, "title": error.title, "message": error.message}
+        body.add_control("self", href(OrderSubmission, apikey=apikey, submissionid=submission.id))
+        body.add_control("up", href(OrdersResource, apikey=apikey))
+        return Response(json.dumps(body), status=200, mimetype=MASON)
+
+class OrderQueueStatus(Resource):
+    """ Depth of the order queue and how long submissions wait in it """
     def get(self):
-        return Response(status=503)
+        body = MasonControls(order_queue.stats())
+        body.add_control("self", href(OrderQueueStatus))
+        return Response(json.dumps(body), status=200, mimetype=MASON)
+
+class RateLimitStatus(Resource):
+    """ How long calls to BitMEX wait for the rate limiter, per priority """
+    def get(self):
+        body = MasonControls(rate_limiter.stats())
+        body.add_control("self", href(RateLimitStatus))
+        return Response(json.dumps(body), status=200, mimetype=MASON)
+
+class OrderHistory(Resource):
+    """ Lists the executions of the account, newest first. Query variables
+        symbol, start and end filter them, limit sets the page size and
+        after is the cursor of the next page given in the next control.
+    """
+    def get(self, apikey):
+        acc = get_account(apikey)
+        if not acc:
+            return create_error_response(404, "Account does not exist",
+             "Account with api-key '{}' does not exist.".format(apikey))
+        if not authorize(acc, request):
+            return create_error_response(401, "Unauthorized", "No API-key or wrong API-key")
+
+        try:
+            start = parse_timestamp(request.args["start"]) if "start" in request.args else None
+            end = parse_timestamp(request.args["end"]) if "end" in request.args else None
+            limit = int(request.args.get("limit", app.config["HISTORY_PAGE_SIZE"]))
+            after = parse_history_cursor(request.args["after"]) if "after" in request.args else None
+        except ValueError:
+            return create_error_response(400, "Query Error",
+                                         "start and end must be timestamps, limit an integer and after a cursor")
+        if not 0 < limit <= app.config["HISTORY_MAX_PAGE_SIZE"]:
+            return create_error_response(400, "Query Error",
+                                         "limit must be between 1 and {}".format(app.config["HISTORY_MAX_PAGE_SIZE"]))
+
+        # the executions are recorded from the account websocket, make sure it is open
+        try:
+            account_feeds.hold(apikey, request.headers["api_secret"])
+        except websocket.WebSocketTimeoutException as e:
+            return websocket_error_response(e)
+
+        query = Execution.query.filter_by(user_id=acc.id)
+        if "symbol" in request.args:
+            query = query.filter_by(symbol=request.args["symbol"])
+        if start is not None:
+            query = query.filter(Execution.timestamp >= int(round(start * 1000)))
+        if end is not None:
+            query = query.filter(Execution.timestamp <= int(round(end * 1000)))
+        if after is not None:
+            # keyset pagination, the index goes straight to the first row of the page
+            query = query.filter(tuple_(Execution.timestamp, Execution.exec_id) < after)
+        executions = query.order_by(Execution.timestamp.desc(), Execution.exec_id.desc()).limit(limit).all()
+
+        items = []
+        for execution in executions:
+            items.append(MasonControls(id=execution.exec_id,
+                                       order=execution.order_id,
+                                       symbol=execution.symbol,
+                                       side=execution.side,
+                                       type=execution.exec_type,
+                                       price=execution.price,
+                                       size=execution.size,
+                                       timestamp=format_timestamp(execution.timestamp / 1000)))
+
+        body = MasonControls(items=items)
+        body.add_control("self", href=request.full_path)
+        if len(executions) == limit:
+            last = executions[-1]
+            args = request.args.to_dict()
+            args["after"] = "{}_{}".format(last.timestamp, last.exec_id)
+            body.add_control("next", href=href(OrderHistory, apikey=apikey) + "?" + urlencode(args),
+                             title="Next page of the history")
+        body.add_control_orders(apikey)
+        return Response(json.dumps(body), status=200, mimetype=MASON)
+
+def etag_for(*parts):
+    """ strong ETag of a representation, parts must identify the version of
+        the data it is built from and everything else it depends on
+    """
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+def not_modified(etag):
+    """ 304 response if the client already has the representation with
+        etag, None otherwise
+    """
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+        resp.set_etag(etag)
+        return resp
+    return None
+
+def parse_history_cursor(cursor):
+    """ Splits the after cursor of the order history into (timestamp, exec_id) """
+    timestamp, exec_id = cursor.split("_", 1)
+    return int(timestamp), exec_id
 
 class OrderBook(Resource):
-    # not implemented
+    """ gets the L2 order book from the BitMEX websocket
+        needs symbol of the book in query variable, depth and grouping
+        are optional.
+    """
     def get(self):
-        return Response(status=503)
+        symbol = request.args.get("symbol")
+        if not symbol:
+            return create_error_response(400, "Query Error", 'Missing Query Parameter "symbol"')
+        try:
+            depth = int(request.args["depth"]) if "depth" in request.args else None
+            grouping = float(request.args["grouping"]) if "grouping" in request.args else None
+        except ValueError:
+            return create_error_response(400, "Query Error", "depth must be an integer and grouping a number")
+        if (depth is not None and depth < 1) or (grouping is not None and grouping <= 0):
+            return create_error_response(400, "Query Error", "depth and grouping must be positive")
+
+        try:
+            with ws_manager.connection(app.config["BITMEX_WS_ENDPOINT"], symbol=symbol) as ws:
+                book = ws.order_book(symbol)
+                version = book.version
+                etag = etag_for(ws.epoch, version, symbol, depth, grouping)
+                resp = not_modified(etag)
+                if resp is not None:
+                    return resp
+                # the version starts over with every connection
+                body = orderbook_cache.get((symbol, depth, grouping), (ws.epoch, version),
+                                           lambda: self.serialize(ws, symbol, depth, grouping))
+        except websocket.WebSocketTimeoutException as e:
+            return websocket_error_response(e)
+        resp = Response(body, status=200, mimetype=MASON)
+        resp.set_etag(etag)
+        return resp
+
+    @staticmethod
+    def serialize(ws, symbol, depth, grouping):
+        """ Builds the response body of the order book """
+        book = ws.market_depth(symbol, depth, grouping)
+        body = MasonControls(symbol=symbol,
+                             bids=[{"price": row["price"], "size": row["size"]} for row in book["bids"]],
+                             asks=[{"price": row["price"], "size": row["size"]} for row in book["asks"]])
+        query = {"symbol": symbol, "depth": depth, "grouping": grouping}
+        body.add_control("self", href=href(OrderBook) + "?" + urlencode(
+            {key: value for key, value in query.items() if value is not None}))
+        body.add_control_priceaction()
+        return json.dumps(body)
 
 class PriceAction(Resource):
     """ gets the most recent trade from the BitMEX
-        needs symbol of the trade in query variable.
+        needs symbol of the trade in query variable. With start and/or end
+        the trades of that time range are listed from the trade tape,
+        count limits how many.
     """
     def get(self):
         if not request.args:
             return create_error_response(400, "Query Error", 'Missing Query Parameter "symbol"')
         try:
             if request.args["symbol"]:
-                ws = BitMEXWebsocket(endpoint="https://testnet.bitmex.com/api/v1", symbol=request.args["symbol"], api_key=None, api_secret=None)
-                trades = []
-                trades = ws.recent_trades()
+                if "start" in request.args or "end" in request.args:
+                    return self.trade_range(request.args["symbol"])
+                with ws_manager.connection(app.config["BITMEX_WS_ENDPOINT"], symbol=request.args["symbol"]) as ws:
+                    # read before the trades, a newer body can get an older tag but never the other way round
+                    etag = etag_for(ws.epoch, ws.version("trade"), request.full_path)
+                    resp = not_modified(etag)
+                    if resp is not None:
+                        return resp
+                    trades = list(ws.recent_trades())
                 for trade in trades:
                     body = MasonControls(symbol = trade["symbol"],
                                          side= trade["side"],
                                          size = trade["size"],
                                          price = trade["price"])
-                    body.add_control("buckets", href=api.url_for(BucketedPriceAction) + "?{timebucket}",
+                    body.add_control("buckets", href=href(BucketedPriceAction) + "?symbol={}&binSize=1m".format(trade["symbol"]),
                                      title="Trades in time buckets")
-                    body.add_control("self", href=api.url_for(PriceAction) + "?symbol={}".format(trade["symbol"]))
-                return Response(json.dumps(body), status=200, mimetype=MASON)
+                    body.add_control("self", href=href(PriceAction) + "?symbol={}".format(trade["symbol"]))
+                resp = Response(json.dumps(body), status=200, mimetype=MASON)
+                resp.set_etag(etag)
+                return resp
         except:
             print(traceback.format_exc())
             return create_error_response(400, "Query Error", "Query Parameter doesn't exist")
 
+    @staticmethod
+    def trade_range(symbol):
+        """ Lists the trades between start and end from the trade tape """
+        try:
+            start = parse_timestamp(request.args["start"]) if "start" in request.args else None
+            end = parse_timestamp(request.args["end"]) if "end" in request.args else None
+            count = int(request.args.get("count", 100))
+        except ValueError:
+            return create_error_response(400, "Query Error", "start and end must be timestamps and count an integer")
+        if not 0 < count <= app.config["TRADE_MAX_COUNT"]:
+            return create_error_response(400, "Query Error",
+                                         "count must be between 1 and {}".format(app.config["TRADE_MAX_COUNT"]))
+
+        # the market websocket of the symbol is what writes its trades to the tape
+        with ws_manager.connection(app.config["BITMEX_WS_ENDPOINT"], symbol=symbol):
+            try:
+                items = list(tape.trades(symbol, start, end, count))
+            except ValueError as e:
+                return create_error_response(400, "Query Error", str(e))
+
+        body = MasonControls(symbol=symbol, items=items)
+        body.add_control("self", href=href(PriceAction) + "?" + urlencode(request.args))
+        body.add_control("buckets", href=href(BucketedPriceAction) + "?symbol={}&binSize=1m".format(symbol),
+                         title="Trades in time buckets")
+        return Response(json.dumps(body), status=200, mimetype=MASON)
+
 class BucketedPriceAction(Resource):
-    # not implemented
+    """ gets open, high, low, close, volume and vwap of the trades in time
+        buckets. needs symbol in query variable, binSize (1m, 5m, 1h or 1d),
+        start, end and count are optional.
+    """
     def get(self):
-        return Response(status=503)
+        symbol = request.args.get("symbol")
+        if not symbol:
+            return create_error_response(400, "Query Error", 'Missing Query Parameter "symbol"')
+        bin_size = request.args.get("binSize", "1m")
+        if bin_size not in BIN_SIZES:
+            return create_error_response(400, "Query Error",
+                                         "binSize must be one of {}".format(", ".join(BIN_SIZES)))
+        try:
+            start = parse_timestamp(request.args["start"]) if "start" in request.args else None
+            end = parse_timestamp(request.args["end"]) if "end" in request.args else None
+            count = int(request.args.get("count", 100))
+        except ValueError:
+            return create_error_response(400, "Query Error", "start and end must be timestamps and count an integer")
+        if not 0 < count <= app.config["BAR_MAX_COUNT"]:
+            return create_error_response(400, "Query Error",
+                                         "count must be between 1 and {}".format(app.config["BAR_MAX_COUNT"]))
+
+        # the market websocket of the symbol is what keeps its bars up to date
+        try:
+            with ws_manager.connection(app.config["BITMEX_WS_ENDPOINT"], symbol=symbol):
+                items = bars.bars(symbol, bin_size, start, end, count)
+        except websocket.WebSocketTimeoutException as e:
+            return websocket_error_response(e)
+
+        body = MasonControls(symbol=symbol, binSize=bin_size, items=items)
+        body.add_control("self", href=href(BucketedPriceAction) + "?" + urlencode(request.args))
+        body.add_control_priceaction()
+        return Response(json.dumps(body), status=200, mimetype=MASON)
 
 class Positions(Resource):
     """ Gets active positions from the BitMEX testnet """
     def get(self, apikey):
-        acc = User.query.filter_by(api_public=apikey).first()
+        acc = get_account(apikey)
         if not acc:
             return create_error_response(404, "Account does not exist", "Account with api-key '{}' does not exist.".format(apikey))
         if not authorize(acc, request):
             return create_error_response(401, "Unauthorized", "No API-key or wrong API-key")
 
         try:
-            ws = BitMEXWebsocket(endpoint="https://testnet.bitmex.com/api/v1",
-                                 symbol="", api_key=apikey,
-                                 api_secret=request.headers["api_secret"])
-
-            positions = []
+            with ws_manager.connection(app.config["BITMEX_WS_ENDPOINT"],
+                                       symbol="", api_key=apikey,
+                                       api_secret=request.headers["api_secret"]) as ws:
+                etag = etag_for(ws.epoch, ws.version("position"), request.full_path)
+                resp = not_modified(etag)
+                if resp is not None:
+                    return resp
+                positions = list(ws.positions())
             parsed_positions = []
-            positions = ws.positions()
-            ws.exit()
             if positions:
                 for position in positions:
 
@@ -536,14 +1149,16 @@ class Positions(Resource):
                                                     leverage = parsed_position_leverage,
                                                     avgEntryPrice = parsed_position_entyprice,
                                                     liquidationPrice = parsed_position_liquidationPrice)
-                    parsed_position.add_control("self", href=api.url_for(Position, apikey=apikey, symbol=parsed_position_symbol))
+                    parsed_position.add_control("self", href=href(Position, apikey=apikey, symbol=parsed_position_symbol))
                     if not position["currentQty"] == 0:
                         parsed_positions.append(parsed_position)
 
             body = MasonControls(items=parsed_positions)
             body.add_control_account(apikey)
-            body.add_control("self", api.url_for(Positions, apikey=apikey))
-            return Response(json.dumps(body), status=200, mimetype=MASON)
+            body.add_control("self", href(Positions, apikey=apikey))
+            resp = Response(json.dumps(body), status=200, mimetype=MASON)
+            resp.set_etag(etag)
+            return resp
 
         except TypeError:
             return create_error_response(400, "Query Error", "Query Parameter doesn't exist")
@@ -552,21 +1167,18 @@ class Positions(Resource):
 class Position(Resource):
     def get(self, apikey, symbol):
         """ Gets a single active position from the BitMEX testnet """
-        acc = User.query.filter_by(api_public=apikey).first()
+        acc = get_account(apikey)
         if not acc:
             return create_error_response(404, "Account does not exist", "Account with api-key '{}' does not exist.".format(apikey))
         if not authorize(acc, request):
             return create_error_response(401, "Unauthorized", "No API-key or wrong API-key")
 
         try:
-            ws = BitMEXWebsocket(endpoint="https://testnet.bitmex.com/api/v1",
-                                 symbol=symbol, api_key=apikey,
-                                 api_secret=request.headers["api_secret"])
-
-            positions = []
+            with ws_manager.connection(app.config["BITMEX_WS_ENDPOINT"],
+                                       symbol=symbol, api_key=apikey,
+                                       api_secret=request.headers["api_secret"]) as ws:
+                positions = list(ws.positions())
             parsed_positions = []
-            positions = ws.positions()
-            ws.exit()
             if positions:
                 for position in positions:
                     parsed_position_symbol = position["symbol"]
@@ -584,8 +1196,8 @@ class Position(Resource):
                                                     avgEntryPrice = parsed_position_entyprice,
                                                     liquidationPrice = parsed_position_liquidationPrice)
 
-                    parsed_position.add_control("self", href=api.url_for(Position, apikey=apikey, symbol=parsed_position_symbol))
-                    parsed_position.add_control("edit", href=api.url_for(Position, apikey=apikey, symbol=parsed_position_symbol),
+                    parsed_position.add_control("self", href=href(Position, apikey=apikey, symbol=parsed_position_symbol))
+                    parsed_position.add_control("edit", href=href(Position, apikey=apikey, symbol=parsed_position_symbol),
                                                 method="PATCH",
                                                 encoding="json",
                                                 title="Change position leverage",
@@ -605,7 +1217,7 @@ class Position(Resource):
 
     def patch(self, apikey, symbol):
         """ Edits active position's leverage attribute """
-        acc = User.query.filter_by(api_public=apikey).first()
+        acc = get_account(apikey)
         if not acc:
             return create_error_response(404, "Account does not exist",
              "Account with api-key '{}' does not exist.".format(apikey))
@@ -615,7 +1227,7 @@ class Position(Resource):
         if not request.json:
             return create_error_response(415, "Unsupported media type", "Requests must be JSON")
         try:
-            validate(request.json, MasonControls.position_schema())
+            position_validator.validate(request.json)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
@@ -626,11 +1238,10 @@ class Position(Resource):
             data["leverage"] = float(request.json["leverage"])
 
             url = '/api/v1/position/leverage'
-            #Create signature and headers with BitMEXWebsocket generate signature function
-            headers = generate_headers(request.headers["api_secret"], acc.api_public, url, "POST", data)
-
-            res = requests.post('https://testnet.bitmex.com' + url, json=data, headers=headers)
-            print(res.status_code)
+            try:
+                res = bitmex.post(url, data, acc.api_public, request.headers["api_secret"])
+            except requests.RequestException as e:
+                return upstream_error_response(e)
             if res.status_code == 400:
                 return create_error_response(400, "Parameter Error", "One of the parameters have an invalid value")
             return Response("", status=204, mimetype="application/json")
@@ -640,18 +1251,6 @@ class Position(Resource):
 
 
 
-def generate_headers(api_secret, api_public, url, method, data):
-    nonce = generate_nonce()
-    headers = {
-            "api-nonce" : str(nonce),
-            "api-signature" :  generate_signature(api_secret, method, url, nonce, json.dumps(data)),
-            "api-key" : api_public
-        }
-    return headers
-
-
-
-
 """ routes for the resources """
 api.add_resource(Accounts,"/accounts/")
 api.add_resource(Account,"/accounts/<apikey>/")
@@ -662,10 +1261,66 @@ api.add_resource(Positions, "/accounts/<apikey>/positions/")
 api.add_resource(Position, "/accounts/<apikey>/positions/<symbol>/")
 api.add_resource(OrderBook, "/orderbook/")
 api.add_resource(OrderHistory, "/accounts/<apikey>/orders/history/")
+api.add_resource(OrderSubmission, "/accounts/<apikey>/orders/submissions/<submissionid>/")
+api.add_resource(OrderQueueStatus, "/orders/queue/")
+api.add_resource(RateLimitStatus, "/orders/ratelimit/")
 api.add_resource(TransactionHistory, "/accounts/<apikey>/history/")
 api.add_resource(AccountBalance, "/accounts/<apikey>/balance/")
 api.add_resource(BucketedPriceAction, "/priceaction/bucketed/")
 
+def upstream_failure(error):
+    """ status code, title and message of the error response for a call to
+        BitMEX that failed, timed out or was held back by the rate limiter
+    """
+    if isinstance(error, RateLimited):
+        return 429, "Rate limited", str(error)
+    return 502, "Upstream Error", "BitMEX request failed: {}".format(error)
+
+def upstream_error_response(error):
+    """ error response for a call to BitMEX that failed or timed out """
+    resp = create_error_response(*upstream_failure(error))
+    if isinstance(error, RateLimited):
+        resp.headers["Retry-After"] = str(math.ceil(error.retry_after))
+    return resp
+
+def upstream_rejection(res):
+    """ status code, title and message of the error response for a call to
+        BitMEX that it answered with an error, client errors are passed on
+        and server errors become 502
+    """
+    try:
+        message = res.json()["error"]["message"]
+    except (ValueError, KeyError, TypeError):
+        message = "BitMEX responded with status {}".format(res.status_code)
+    return res.status_code if res.status_code < 500 else 502, "Upstream Error", message
+
+def upstream_retry_after(res):
+    """ seconds from the Retry-After header of a BitMEX response, None if it
+        has none in seconds
+    """
+    try:
+        return float(res.headers["Retry-After"])
+    except (KeyError, ValueError):
+        return None
+
+def upstream_rejected_response(res):
+    """ error response for a call to BitMEX that it answered with an error,
+        its Retry-After is passed on
+    """
+    resp = create_error_response(*upstream_rejection(res))
+    retry_after = upstream_retry_after(res)
+    if retry_after is not None:
+        resp.headers["Retry-After"] = str(math.ceil(retry_after))
+    return resp
+
+def websocket_error_response(error):
+    """ error response for a websocket that couldn't be opened, a
+        subscription BitMEX rejected is the fault of the query
+    """
+    if isinstance(error, WebSocketRejected):
+        return create_error_response(400, "Query Error", "BitMEX rejected the subscription: {}".format(error))
+    return create_error_response(503, "Upstream Error", "BitMEX websocket unavailable: {}".format(error))
+
 def create_error_response(status_code, title, message=None):
     """ creates error responses using mason builder
         Based on the one used in Exercise 3 of the course.
@@ -0,0 +1,244 @@
+import asyncio
+import json
+import logging
+import threading
+import traceback
+import websocket
+from bitmex_websocket import BitMEXWebsocket, WebSocketRejected, MessageStats, get_decoder, subscription_url, auth_headers
+from ws_store import TableStore
+
+try:
+    import websockets
+except ImportError:  # only needed when the async client is used
+    websockets = None
+
+
+class AsyncBitMEXWebsocket(TableStore):
+    """ asyncio version of BitMEXWebsocket. Has the same getters, but the
+        connection is a task on an event loop instead of a thread of its own,
+        so any number of feeds can share one loop.
+
+            ws = AsyncBitMEXWebsocket(endpoint, "XBTUSD")
+            await ws.connect()
+            print(ws.get_ticker())
+            async for table, action, rows in ws.changes("trade"):
+                ...
+            await ws.close()
+    """
+
+    # Changes a slow consumer of changes() may fall behind before the oldest are dropped
+    CHANGES_QUEUE_LEN = 1000
+
+    def __init__(self, endpoint, symbol, api_key=None, api_secret=None, table_capacity=None, timeout=None,
+                 decoder=None):
+        self.logger = logging.getLogger(__name__)
+        TableStore.__init__(self, symbol, table_capacity)
+        self.endpoint = endpoint
+
+        if api_key is not None and api_secret is None:
+            raise ValueError('api_secret is required if api_key is provided')
+        if api_key is None and api_secret is not None:
+            raise ValueError('api_key is required if api_secret is provided')
+
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.timeout = timeout or BitMEXWebsocket.READY_TIMEOUT
+        self.decode = get_decoder(decoder)
+        self.stats = MessageStats()
+        self.exited = False
+        self.error = None
+        self.rejected = False
+        self._loop = None
+        self._conn = None
+        self._reader = None
+        self._changed = None
+        self._subscribers = []
+
+    async def connect(self):
+        """ Connects and waits until the partials are in. Raises
+            WebSocketTimeoutException like BitMEXWebsocket when that takes
+            longer than the timeout or BitMEX rejects the subscription.
+        """
+        if websockets is None:
+            raise ImportError("AsyncBitMEXWebsocket needs the websockets package")
+        self._loop = asyncio.get_running_loop()
+        self._changed = asyncio.Event()
+        url = subscription_url(self.endpoint, self.symbols)
+        self.logger.info("Connecting to %s", url)
+        try:
+            self._conn = await asyncio.wait_for(
+                websockets.connect(url, additional_headers=auth_headers(self.api_key, self.api_secret)),
+                self.timeout)
+        except (OSError, asyncio.TimeoutError, websockets.WebSocketException) as e:
+            self.exited = True
+            raise websocket.WebSocketTimeoutException("Couldn't connect to WS: %s" % (e or "timed out"))
+        self._reader = self._loop.create_task(self._read())
+        await self.wait_ready()
+        return self
+
+    async def wait_ready(self, timeout=None):
+        """ Waits for the partials of the subscribed tables """
+        deadline = self._loop.time() + (timeout or self.timeout)
+        account = self.api_key is not None
+        while True:
+            if self.is_ready(account):
+                return self
+            if self.error is not None or self.exited:
+                reason = self.error if self.error is not None else "connection closed"
+                break
+            remaining = deadline - self._loop.time()
+            if remaining <= 0:
+                reason = "no data for symbol '%s' within %s seconds" % (', '.join(self.symbols), self.timeout)
+                break
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+        self.logger.error(reason)
+        await self.close()
+        error = WebSocketRejected if self.rejected else websocket.WebSocketTimeoutException
+        raise error("WS not ready: %s" % reason)
+
+    async def subscribe(self, symbol, timeout=None):
+        """ Adds a symbol to the connection and waits for its partials """
+        if symbol in self.symbols:
+            return
+        self.error = None
+        self.rejected = False
+        self.add_symbol(symbol)
+        await self._conn.send(json.dumps({"op": "subscribe", "args": self.topics([symbol])}))
+        deadline = self._loop.time() + (timeout or self.timeout)
+        while not self.is_ready():
+            remaining = deadline - self._loop.time()
+            if self.error is not None or self.exited or remaining <= 0:
+                reason = self.error if self.error is not None else "no data within %s seconds" % self.timeout
+                await self.unsubscribe(symbol)
+                error = WebSocketRejected if self.rejected else websocket.WebSocketTimeoutException
+                raise error(
+                    "No market data received for symbol '%s': %s" % (symbol, reason))
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    async def unsubscribe(self, symbol):
+        """ Removes a symbol from the connection and drops its data """
+        if not self.exited:
+            await self._conn.send(json.dumps({"op": "unsubscribe", "args": self.topics([symbol])}))
+        self.drop_symbol(symbol)
+
+    async def changes(self, *tables):
+        """ Async iterator of (table, action, rows) for every change to the
+            given tables, or all tables when none are given. Ends when the
+            connection closes.
+        """
+        queue = asyncio.Queue(maxsize=self.CHANGES_QUEUE_LEN)
+        subscriber = (frozenset(tables), queue)
+        self._subscribers.append(subscriber)
+        try:
+            while True:
+                change = await queue.get()
+                if change is None:
+                    return
+                yield change
+        finally:
+            self._subscribers.remove(subscriber)
+
+    async def close(self):
+        """ Closes the connection and ends the changes() iterators """
+        self.exited = True
+        if self._conn is not None:
+            await self._conn.close()
+        if self._reader is not None and self._reader is not asyncio.current_task():
+            await asyncio.gather(self._reader, return_exceptions=True)
+        self._publish(None)
+
+    def exit(self):
+        """ Thread-safe close, for callers outside the event loop """
+        if self._loop is not None and not self._loop.is_closed():
+            asyncio.run_coroutine_threadsafe(self.close(), self._loop)
+        else:
+            self.exited = True
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def _read(self):
+        try:
+            async for raw in self._conn:
+                self._on_message(raw)
+        except websockets.ConnectionClosed:
+            pass
+        except Exception as e:
+            self.logger.error(traceback.format_exc())
+            self.error = e
+        finally:
+            self.logger.info('Websocket Closed')
+            self.exited = True
+            self._changed.set()
+            self._publish(None)
+
+    def _on_message(self, raw):
+        self.stats.record(len(raw))
+        self.logger.debug("%s", raw)
+        message = self.decode(raw)
+        try:
+            if 'subscribe' in message:
+                self.logger.debug("Subscribed to %s.", message['subscribe'])
+            elif 'error' in message:
+                self.logger.error("Error from BitMEX: %s", message['error'])
+                self.error = message['error']
+                self.rejected = True
+                self._changed.set()
+            else:
+                applied = self.apply(message)
+                if applied:
+                    if applied[1] == 'partial':
+                        self._changed.set()
+                    self._publish((applied[0], applied[1], message['data']))
+        except Exception:
+            self.logger.error(traceback.format_exc())
+
+    def _publish(self, change):
+        for tables, queue in self._subscribers:
+            if change is not None and tables and change[0] not in tables:
+                continue
+            if queue.full():
+                # drop the oldest change rather than block the feed
+                queue.get_nowait()
+            queue.put_nowait(change)
+
+
+class FeedLoop:
+    """ Runs AsyncBitMEXWebsocket connections on one event loop in a
+        background thread, for synchronous code such as the Flask app.
+        open() has the signature of the BitMEXWebsocket constructor, so it
+        can be used as the factory of a WebsocketManager.
+    """
+
+    def __init__(self, **options):
+        self.options = options
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="bitmex-feed-loop")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def open(self, endpoint, symbol, api_key=None, api_secret=None):
+        """ Connects a feed on the loop and blocks until it is ready """
+        ws = AsyncBitMEXWebsocket(endpoint, symbol, api_key, api_secret, **self.options)
+        future = asyncio.run_coroutine_threadsafe(ws.connect(), self.loop)
+        # connect() enforces the timeout itself, this only guards against a stuck loop
+        return future.result(ws.timeout * 2)
+
+    def run(self, coroutine, timeout=None):
+        """ Runs a coroutine on the loop and returns its result """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
@@ -0,0 +1,132 @@
+import asyncio
+import json
+import pytest
+import websocket
+from async_bitmex_websocket import AsyncBitMEXWebsocket, FeedLoop, WebSocketRejected
+
+websockets = pytest.importorskip("websockets")
+from websockets.asyncio.server import serve
+
+
+"""
+Tests for the asyncio websocket client. A local websocket server plays the
+part of BitMEX.
+
+"""
+
+def _partial(table, data=None):
+    return {"table": table, "action": "partial", "keys": [], "data": data or [],
+            "filter": {"symbol": "XBTUSD"}}
+
+def _trade(price):
+    return {"symbol": "XBTUSD", "side": "Buy", "size": 1, "price": price}
+
+MARKET = [_partial("instrument", [{"symbol": "XBTUSD", "tickSize": 0.01}]),
+          _partial("trade", [_trade(3500.0)]),
+          _partial("quote", [{"symbol": "XBTUSD", "bidPrice": 3499.5, "askPrice": 3500.0}])]
+
+
+class FakeBitMEX(object):
+    """ Sends the script to every client, then whatever is pushed """
+
+    def __init__(self, script, replies=None):
+        self.script = script
+        # subscribe topic -> messages sent in reply
+        self.replies = replies or {}
+        self.received = []
+        self.clients = []
+        self.paths = []
+
+    async def handler(self, connection):
+        self.paths.append(connection.request.path)
+        self.clients.append(connection)
+        for message in self.script:
+            await connection.send(json.dumps(message))
+        async for raw in connection:
+            self.received.append(json.loads(raw))
+            for topic in self.received[-1]["args"]:
+                for message in self.replies.get(topic, []):
+                    await connection.send(json.dumps(message))
+
+    async def push(self, message):
+        for connection in self.clients:
+            await connection.send(json.dumps(message))
+
+    async def __aenter__(self):
+        self.server = await serve(self.handler, "127.0.0.1", 0).__aenter__()
+        self.endpoint = "http://127.0.0.1:{}/api/v1".format(self.server.sockets[0].getsockname()[1])
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.server.__aexit__(*exc)
+
+
+def test_connect_and_getters():
+    """ connect() returns once the partials are in and the getters work """
+    async def scenario():
+        async with FakeBitMEX(MARKET) as server:
+            async with AsyncBitMEXWebsocket(server.endpoint, "XBTUSD") as ws:
+                assert ws.get_ticker()["last"] == 3500.0
+                assert ws.recent_trades() == [_trade(3500.0)]
+            assert ws.exited
+            assert "subscribe=" in server.paths[0]
+    asyncio.run(scenario())
+
+def test_many_feeds_and_changes():
+    """ Several feeds share the loop and changes() yields the updates """
+    async def scenario():
+        async with FakeBitMEX(MARKET) as server:
+            feeds = [AsyncBitMEXWebsocket(server.endpoint, "XBTUSD") for _ in range(5)]
+            await asyncio.gather(*[ws.connect() for ws in feeds])
+
+            async def first_insert(ws):
+                async for table, action, rows in ws.changes("trade"):
+                    return table, action, rows
+            waiters = [asyncio.ensure_future(first_insert(ws)) for ws in feeds]
+            await asyncio.sleep(0.05)
+            await server.push({"table": "quote", "action": "insert", "data": []})
+            await server.push({"table": "trade", "action": "insert", "data": [_trade(3600.0)]})
+            results = await asyncio.wait_for(asyncio.gather(*waiters), 2)
+            assert all(result == ("trade", "insert", [_trade(3600.0)]) for result in results)
+            assert all(ws.get_ticker()["last"] == 3600.0 for ws in feeds)
+            await asyncio.gather(*[ws.close() for ws in feeds])
+    asyncio.run(scenario())
+
+def test_subscribe_and_unsubscribe():
+    """ Symbols can be added to and removed from a running connection """
+    eth = [dict(message, filter={"symbol": "ETHUSD"}) for message in MARKET]
+    async def scenario():
+        async with FakeBitMEX(MARKET, {"trade:ETHUSD": eth}) as server:
+            async with AsyncBitMEXWebsocket(server.endpoint, "XBTUSD") as ws:
+                await ws.subscribe("ETHUSD")
+                assert ws.symbols == ["XBTUSD", "ETHUSD"]
+                await ws.unsubscribe("ETHUSD")
+                assert ws.symbols == ["XBTUSD"]
+            assert [message["op"] for message in server.received] == ["subscribe", "unsubscribe"]
+    asyncio.run(scenario())
+
+def test_rejected_subscription():
+    """ An error from BitMEX fails connect() """
+    async def scenario():
+        async with FakeBitMEX([{"status": 400, "error": "Unknown or expired symbol."}]) as server:
+            ws = AsyncBitMEXWebsocket(server.endpoint, "NOPE", timeout=2)
+            with pytest.raises(WebSocketRejected) as error:
+                await ws.connect()
+            assert "Unknown or expired symbol" in str(error.value)
+            assert ws.exited
+    asyncio.run(scenario())
+
+def test_feed_loop_facade():
+    """ The synchronous facade connects from a normal thread """
+    loop = FeedLoop(timeout=2)
+    server = FakeBitMEX(MARKET)
+    loop.run(server.__aenter__())
+    try:
+        ws = loop.open(server.endpoint, "XBTUSD")
+        assert ws.get_ticker()["buy"] == 3499.5
+        ws.exit()
+        loop.run(asyncio.sleep(0.1))
+        assert ws.exited
+    finally:
+        loop.run(server.__aexit__(None, None, None))
+        loop.stop()
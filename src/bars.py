@@ -0,0 +1,158 @@
+import threading
+from array import array
+from utils import parse_timestamp, format_timestamp
+
+
+"""
+OHLCV bars that are built incrementally from the trade table of the BitMEX
+websocket.
+
+"""
+
+# Bin sizes of the bucketed trades BitMEX offers, in seconds
+BIN_SIZES = {"1m": 60, "5m": 300, "1h": 3600, "1d": 86400}
+
+
+class BarSeries:
+    """ Bars of one symbol and bin size. The bars are kept in preallocated
+        arrays used as a ring, so folding a trade in is O(1) and the newest
+        capacity bars are kept. Bars without trades are not stored.
+    """
+
+    FIELDS = ("open", "high", "low", "close", "volume", "turnover")
+
+    def __init__(self, seconds, capacity):
+        self.seconds = seconds
+        self.capacity = capacity
+        self.starts = array("q", bytes(8 * capacity))
+        self.values = {field: array("d", bytes(8 * capacity)) for field in self.FIELDS}
+        self._start = 0
+        self._len = 0
+
+    def add(self, timestamp, price, size):
+        """ Folds a trade into its bar. Returns False for trades older than
+            the newest bar, the bars before it are final.
+        """
+        start = int(timestamp // self.seconds) * self.seconds
+        last = (self._start + self._len - 1) % self.capacity
+        values = self.values
+        if self._len and self.starts[last] == start:
+            if price > values["high"][last]:
+                values["high"][last] = price
+            if price < values["low"][last]:
+                values["low"][last] = price
+            values["close"][last] = price
+            values["volume"][last] += size
+            values["turnover"][last] += price * size
+            return True
+        if self._len and self.starts[last] > start:
+            return False
+
+        if self._len < self.capacity:
+            last = (self._start + self._len) % self.capacity
+            self._len += 1
+        else:
+            last = self._start
+            self._start = (self._start + 1) % self.capacity
+        self.starts[last] = start
+        values["open"][last] = values["high"][last] = values["low"][last] = values["close"][last] = price
+        values["volume"][last] = size
+        values["turnover"][last] = price * size
+        return True
+
+    def bars(self, start=None, end=None, count=None):
+        """ Returns the bars that start between start and end as dicts,
+            oldest first. With count only that many are returned, the first
+            ones if start is given and the newest ones otherwise.
+        """
+        first = 0 if start is None else self._bisect(start)
+        stop = self._len if end is None else self._bisect(end, right=True)
+        if count is not None and stop - first > count:
+            if start is None:
+                first = stop - count
+            else:
+                stop = first + count
+        return [self._bar((self._start + i) % self.capacity) for i in range(first, stop)]
+
+    def __len__(self):
+        return self._len
+
+    def _bar(self, slot):
+        volume = self.values["volume"][slot]
+        bar = {"timestamp": format_timestamp(self.starts[slot])}
+        for field in self.FIELDS[:5]:
+            bar[field] = self.values[field][slot]
+        bar["vwap"] = self.values["turnover"][slot] / volume if volume else bar["close"]
+        return bar
+
+    def _bisect(self, timestamp, right=False):
+        """ Position of the first bar that starts at or after timestamp, or
+            after it with right
+        """
+        low, high = 0, self._len
+        while low < high:
+            middle = (low + high) // 2
+            value = self.starts[(self._start + middle) % self.capacity]
+            if value < timestamp or (right and value == timestamp):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+
+class BarAggregator:
+    """ Builds bars of every bin size in BIN_SIZES for every symbol from
+        trade rows. attach() hooks it to the trade table of a websocket, the
+        bars are then updated from the feed thread as trades arrive and read
+        from the request threads with bars().
+    """
+
+    def __init__(self, capacity=1000, bin_sizes=BIN_SIZES):
+        self.capacity = capacity
+        self.bin_sizes = bin_sizes
+        # symbol -> bin size -> BarSeries
+        self._series = {}
+        # symbol -> timestamp of the newest trade folded in
+        self._last = {}
+        self._lock = threading.Lock()
+
+    def attach(self, ws):
+        """ Starts following the trades of a websocket, beginning with the
+            ones it already has
+        """
+        for symbol in ws.symbols:
+            if symbol:
+                self.on_trades("partial", ws.recent_trades(symbol))
+        ws.add_listener("trade", self.on_trades)
+
+    def on_trades(self, action, rows):
+        """ Listener of the trade table """
+        if action not in ("partial", "insert"):
+            return
+        with self._lock:
+            for row in rows:
+                timestamp = parse_timestamp(row["timestamp"])
+                symbol = row["symbol"]
+                # partials repeat trades that may have been folded in already
+                if action == "partial" and timestamp <= self._last.get(symbol, 0):
+                    continue
+                self._last[symbol] = max(timestamp, self._last.get(symbol, 0))
+                for series in self._symbol_series(symbol).values():
+                    series.add(timestamp, row["price"], row["size"])
+
+    def bars(self, symbol, bin_size, start=None, end=None, count=None):
+        """ Returns the bars of a symbol, see BarSeries.bars. Raises KeyError
+            for an unknown bin size.
+        """
+        seconds = self.bin_sizes[bin_size]
+        with self._lock:
+            series = self._series.get(symbol, {}).get(seconds)
+            if series is None:
+                return []
+            return series.bars(start, end, count)
+
+    def _symbol_series(self, symbol):
+        if symbol not in self._series:
+            self._series[symbol] = {seconds: BarSeries(seconds, self.capacity)
+                                    for seconds in self.bin_sizes.values()}
+        return self._series[symbol]
@@ -0,0 +1,64 @@
+import pytest
+from bars import BarAggregator, BarSeries
+from utils import parse_timestamp
+
+
+"""
+Tests for the OHLCV bar aggregation
+
+"""
+
+def _trade(timestamp, price, size, symbol="XBTUSD"):
+    return {"timestamp": timestamp, "symbol": symbol, "side": "Buy", "price": price, "size": size}
+
+@pytest.fixture
+def aggregator():
+    aggregator = BarAggregator(capacity=3)
+    aggregator.on_trades("partial", [_trade("2019-03-14T12:00:01.000Z", 3500.0, 10),
+                                     _trade("2019-03-14T12:00:30.000Z", 3510.0, 30)])
+    aggregator.on_trades("insert", [_trade("2019-03-14T12:00:59.999Z", 3490.0, 10),
+                                    _trade("2019-03-14T12:01:00.000Z", 3495.0, 5),
+                                    _trade("2019-03-14T12:00:00.000Z", 3495.0, 5, symbol="ETHUSD")])
+    return aggregator
+
+def test_bars(aggregator):
+    """ Trades are folded into the bar of every bin size """
+    first, second = aggregator.bars("XBTUSD", "1m")
+    assert first["timestamp"] == "2019-03-14T12:00:00.000Z"
+    assert (first["open"], first["high"], first["low"], first["close"]) == (3500.0, 3510.0, 3490.0, 3490.0)
+    assert first["volume"] == 50
+    assert first["vwap"] == (3500.0 * 10 + 3510.0 * 30 + 3490.0 * 10) / 50
+    assert second["open"] == 3495.0
+    hour, = aggregator.bars("XBTUSD", "1h")
+    assert hour["volume"] == 55
+    assert len(aggregator.bars("ETHUSD", "1d")) == 1
+    assert aggregator.bars("NOPE", "1m") == []
+    with pytest.raises(KeyError):
+        aggregator.bars("XBTUSD", "2m")
+
+def test_replayed_partial_is_ignored(aggregator):
+    """ A partial after a reconnect does not count trades twice """
+    aggregator.on_trades("partial", [_trade("2019-03-14T12:00:30.000Z", 3510.0, 30),
+                                     _trade("2019-03-14T12:01:30.000Z", 3520.0, 1)])
+    assert [bar["volume"] for bar in aggregator.bars("XBTUSD", "1m")] == [50, 6]
+
+def test_range_and_count():
+    """ Bars can be selected by start, end and count and only capacity are kept """
+    series = BarSeries(60, capacity=3)
+    for minute in range(5):
+        series.add(minute * 60 + 1, 1.0, 1)
+    assert [bar["timestamp"] for bar in series.bars()] == ["1970-01-01T00:02:00.000Z", "1970-01-01T00:03:00.000Z",
+                                                           "1970-01-01T00:04:00.000Z"]
+    assert len(series.bars(start=180)) == 2
+    assert len(series.bars(end=180)) == 2
+    assert len(series.bars(start=180, end=180)) == 1
+    assert series.bars(count=1)[0]["timestamp"] == "1970-01-01T00:04:00.000Z"
+    assert series.bars(start=0, count=1)[0]["timestamp"] == "1970-01-01T00:02:00.000Z"
+    assert not series.add(60, 1.0, 1)
+
+def test_parse_timestamp():
+    """ BitMEX timestamps and epoch seconds are accepted """
+    assert parse_timestamp("1970-01-01T00:01:00.000Z") == 60.0
+    assert parse_timestamp("60") == 60.0
+    with pytest.raises(ValueError):
+        parse_timestamp("yesterday")
@@ -0,0 +1,67 @@
+"""
+Measures how many websocket messages per second the decode and logging stage
+of BitMEXWebsocket.__on_message handles, comparing the old path (json.loads,
+json.dumps of the whole message for the debug log and eager % formatting of
+the data) with the current one (pluggable decoder, lazy log arguments).
+Logging is at INFO, like in production.
+
+Run from the src directory:
+
+    python -m benchmarks.decode_bench [messages]
+"""
+import json
+import logging
+import random
+import sys
+import time
+from bitmex_websocket import DECODERS, get_decoder
+
+logger = logging.getLogger("decode_bench")
+logger.setLevel(logging.INFO)
+
+
+def _messages(count):
+    rng = random.Random(1)
+    messages = []
+    for i in range(count):
+        rows = [{"symbol": "XBTUSD", "id": 8799000000 + rng.randint(0, 5000),
+                 "side": rng.choice(["Buy", "Sell"]), "size": rng.randint(1, 100000)}
+                for _ in range(rng.randint(1, 20))]
+        messages.append(json.dumps({"table": "orderBookL2", "action": "update", "data": rows}))
+    return messages
+
+
+def legacy(raw):
+    message = json.loads(raw)
+    logger.debug(json.dumps(message))
+    logger.debug('%s: updating %s' % (message['table'], message['data']))
+    return message
+
+
+def current(decode):
+    def handle(raw):
+        logger.debug("%s", raw)
+        message = decode(raw)
+        logger.debug('%s: updating %s', message['table'], message['data'])
+        return message
+    return handle
+
+
+def _rate(handle, messages):
+    start = time.perf_counter()
+    for raw in messages:
+        handle(raw)
+    return len(messages) / (time.perf_counter() - start)
+
+
+def main(count=50000):
+    messages = _messages(count)
+    before = _rate(legacy, messages)
+    print("before (loads + dumps + eager format): {:10.0f} msg/s".format(before))
+    for name in sorted(DECODERS):
+        after = _rate(current(get_decoder(name)), messages)
+        print("after  ({:6}, lazy logging):        {:10.0f} msg/s  {:.1f}x".format(name, after, after / before))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
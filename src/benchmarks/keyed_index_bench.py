@@ -0,0 +1,62 @@
+"""
+Compares finding orderBookL2 rows for update messages with the old linear
+findItemByKeys scan against the hashed KeyedTable index.
+
+Run from the src directory:
+
+    python -m benchmarks.keyed_index_bench [levels] [messages]
+"""
+import random
+import sys
+import time
+from bitmex_websocket import findItemByKeys
+from ws_tables import KeyedTable
+
+KEYS = ["symbol", "id", "side"]
+
+
+def _book(levels):
+    return [{"symbol": "XBTUSD", "id": 8799000000 + i, "side": "Buy" if i % 2 else "Sell",
+             "size": 100, "price": 3000.0 + i * 0.5} for i in range(levels)]
+
+
+def _updates(book, messages, rows_per_message=10):
+    rng = random.Random(1)
+    return [[{"symbol": row["symbol"], "id": row["id"], "side": row["side"], "size": rng.randint(1, 1000)}
+             for row in rng.sample(book, rows_per_message)] for _ in range(messages)]
+
+
+def run_linear(book, updates):
+    for message in updates:
+        for update in message:
+            findItemByKeys(KEYS, book, update).update(update)
+
+
+def run_indexed(table, updates):
+    for message in updates:
+        for update in message:
+            table.get(update).update(update)
+
+
+def _time(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def main(levels=5000, messages=2000):
+    book = _book(levels)
+    updates = _updates(book, messages)
+    rows = sum(len(message) for message in updates)
+
+    linear = _time(run_linear, book, updates)
+    indexed = _time(run_indexed, KeyedTable(KEYS, _book(levels)), updates)
+
+    print("orderBookL2 with {} levels, {} update rows".format(levels, rows))
+    print("before (findItemByKeys): {:8.3f} s  {:10.1f} us/row".format(linear, linear / rows * 1e6))
+    print("after  (KeyedTable):     {:8.3f} s  {:10.1f} us/row".format(indexed, indexed / rows * 1e6))
+    print("speedup: {:.0f}x".format(linear / indexed))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,94 @@
+"""
+Compares building the hypermedia controls of responses with a Werkzeug URL
+build per href and fresh schemas (before) against the href templates and
+memoized schemas of MasonControls (after). Measures the body of Account.get
+and a page of the orders list.
+
+Run from the src directory:
+
+    python -m benchmarks.mason_controls_bench [repeats] [orders]
+"""
+import sys
+import time
+from contextlib import contextmanager
+import app as app_module
+from app import app, api, MasonControls, Account, OrdersResource, OrderResource
+
+APIKEY = "79z47uUikMoPe2eADqfJzRBu"
+SCHEMAS = ("account_schema", "order_schema", "bulk_order_schema", "position_schema")
+
+
+@contextmanager
+def url_builds():
+    """ Makes the app build every href with url_for and every schema anew """
+    href = app_module.href
+    app_module.href = api.url_for
+    for name in SCHEMAS:
+        setattr(MasonControls, name, staticmethod(getattr(MasonControls, name).__wrapped__))
+    try:
+        yield
+    finally:
+        app_module.href = href
+        for name in SCHEMAS:
+            setattr(MasonControls, name, staticmethod(app_module.lru_cache(maxsize=None)(getattr(MasonControls, name))))
+
+
+def account_body():
+    """ The controls of Account.get """
+    body = MasonControls(accountname="testuser", api_public=APIKEY, api_secret="secret")
+    body.add_control("self", app_module.href(Account, apikey=APIKEY))
+    body.add_control_orders(APIKEY)
+    body.add_control_orderhistory(APIKEY)
+    body.add_control_accountbalance(APIKEY)
+    body.add_control_positions(APIKEY)
+    body.add_control_transactionhistory(APIKEY)
+    body.add_control_delete_account(APIKEY)
+    body.add_control_accounts()
+    return body
+
+
+def orders_body(orders):
+    """ The controls of a page of OrdersResource.get """
+    items = []
+    for i in range(orders):
+        orderid = "00000000-0000-0000-0000-{:012d}".format(i)
+        item = MasonControls(id=orderid, price=3500.0, symbol="XBTUSD", side="Buy", size=1)
+        item.add_control("self", app_module.href(OrderResource, apikey=APIKEY, orderid=orderid))
+        items.append(item)
+    body = MasonControls(items=items)
+    body.add_control_add_order(APIKEY)
+    body.add_control_add_orders(APIKEY)
+    body.add_control_delete_orders(APIKEY)
+    body.add_control("self", app_module.href(OrdersResource, apikey=APIKEY))
+    body.add_control_account(APIKEY)
+    return body
+
+
+def _time(fn, repeats, *args):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn(*args)
+    return (time.perf_counter() - start) / repeats
+
+
+def main(repeats=2000, orders=100):
+    with app.test_request_context():
+        # the templates are built on first use
+        assert account_body() == account_body() and orders_body(orders)
+        with url_builds():
+            before_account = _time(account_body, repeats)
+            before_orders = _time(orders_body, repeats // 10, orders)
+            expected = (account_body(), orders_body(orders))
+        after_account = _time(account_body, repeats)
+        after_orders = _time(orders_body, repeats // 10, orders)
+        assert (account_body(), orders_body(orders)) == expected
+
+    print("control building per response")
+    print("Account.get           before: {:8.1f} us  after: {:8.1f} us  speedup: {:.1f}x".format(
+        before_account * 1e6, after_account * 1e6, before_account / after_account))
+    print("orders page of {:4d}   before: {:8.1f} us  after: {:8.1f} us  speedup: {:.1f}x".format(
+        orders, before_orders * 1e6, after_orders * 1e6, before_orders / after_orders))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
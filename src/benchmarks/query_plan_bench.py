@@ -0,0 +1,147 @@
+"""
+Latency of the queries app.py runs against the Orders/User schema, on a
+SQLite database of about a million orders across thousands of users, with
+and without the indexes of database.py. Also checks with EXPLAIN QUERY PLAN
+that every query uses the index it is meant to, and exits with status 1 if
+one does not, so that a schema change that loses an index gets caught.
+
+Run from the src directory:
+
+    python -m benchmarks.query_plan_bench [orders] [users]
+"""
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from sqlalchemy import create_engine
+from database import db
+
+SYMBOLS = ["XBTUSD", "ETHUSD", "XRPU19", "LTCU19", "BCHU19"]
+
+# name, SQL as app.py issues it, parameter factory, what the plan has to use
+QUERIES = [
+    ("account by api_public",
+     "SELECT * FROM user WHERE api_public = ? LIMIT 1",
+     lambda rng, users: ("key{:020d}".format(rng.randrange(users)),),
+     "sqlite_autoindex_user_2"),
+    ("order by order_id",
+     "SELECT * FROM orders WHERE order_id = ? LIMIT 1",
+     lambda rng, users: (_order_id(rng.randrange(users * 10)),),
+     "sqlite_autoindex_orders_1"),
+    ("orders page of an account",
+     "SELECT * FROM orders WHERE user_id = ? ORDER BY order_id LIMIT 101",
+     lambda rng, users: (rng.randrange(1, users + 1),),
+     "ix_orders_user_order"),
+    ("next orders page of an account",
+     "SELECT * FROM orders WHERE user_id = ? AND order_id > ? ORDER BY order_id LIMIT 101",
+     lambda rng, users: (rng.randrange(1, users + 1), _order_id(rng.randrange(users * 200))),
+     "ix_orders_user_order"),
+    ("orders of an account and symbol",
+     "SELECT * FROM orders WHERE user_id = ? AND order_symbol = ?",
+     lambda rng, users: (rng.randrange(1, users + 1), rng.choice(SYMBOLS)),
+     "ix_orders_user_symbol"),
+    ("execution history page",
+     "SELECT * FROM execution WHERE user_id = ? ORDER BY timestamp DESC, exec_id DESC LIMIT 100",
+     lambda rng, users: (rng.randrange(1, users + 1),),
+     "ix_execution_user_time"),
+]
+
+# indexes added to Orders, dropped for the before numbers
+ORDER_INDEXES = ["ix_orders_user_order", "ix_orders_user_symbol"]
+
+
+def _order_id(number):
+    text = "{:032x}".format(number)
+    return "-".join((text[:8], text[8:12], text[12:16], text[16:20], text[20:]))
+
+
+def plan(connection, sql, params):
+    """ Returns the EXPLAIN QUERY PLAN details of a query as one string """
+    return " / ".join(row[-1] for row in connection.execute("EXPLAIN QUERY PLAN " + sql, params))
+
+
+def plan_problems(connection, users=10):
+    """ Returns (name, plan) of every query whose plan does not use its index """
+    rng = random.Random(1)
+    problems = []
+    for name, sql, params, index in QUERIES:
+        detail = plan(connection, sql, params(rng, users))
+        if index not in detail or "TEMP B-TREE" in detail:
+            problems.append((name, detail))
+    return problems
+
+
+def populate(connection, orders, users):
+    rng = random.Random(1)
+    connection.executemany("INSERT INTO user (id, username, api_public, api_secret) VALUES (?, ?, ?, ?)",
+                           [(i + 1, "user{}".format(i), "key{:020d}".format(i), "secret") for i in range(users)])
+    batch = []
+    for i in range(orders):
+        batch.append((_order_id(rng.randrange(orders * 100)), rng.randrange(1, users + 1), 3500.0, 1, "Buy",
+                      rng.choice(SYMBOLS)))
+        if len(batch) == 50000:
+            connection.executemany("INSERT OR IGNORE INTO orders (order_id, user_id, order_price, order_size, "
+                                   "order_side, order_symbol) VALUES (?, ?, ?, ?, ?, ?)", batch)
+            batch = []
+    connection.executemany("INSERT OR IGNORE INTO orders (order_id, user_id, order_price, order_size, "
+                           "order_side, order_symbol) VALUES (?, ?, ?, ?, ?, ?)", batch)
+    connection.executemany("INSERT INTO execution (user_id, exec_id, symbol, timestamp) VALUES (?, ?, ?, ?)",
+                           [(rng.randrange(1, users + 1), _order_id(i), rng.choice(SYMBOLS), 1552564800000 + i)
+                            for i in range(orders // 10)])
+    connection.commit()
+    connection.execute("ANALYZE")
+
+
+def measure(connection, sql, params, users, iterations):
+    """ Returns p50 and p99 latency in ms """
+    rng = random.Random(2)
+    latencies = []
+    for _ in range(iterations):
+        args = params(rng, users)
+        start = time.perf_counter()
+        connection.execute(sql, args).fetchall()
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+    return latencies[len(latencies) // 2], latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+
+
+def report(connection, users, iterations):
+    for name, sql, params, index in QUERIES:
+        p50, p99 = measure(connection, sql, params, users, iterations)
+        print("  {:34} p50 {:9.3f} ms  p99 {:9.3f} ms".format(name, p50, p99))
+
+
+def main(orders=1000000, users=5000):
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    try:
+        db.Model.metadata.create_all(create_engine("sqlite:///" + path))
+        connection = sqlite3.connect(path)
+        start = time.perf_counter()
+        populate(connection, orders, users)
+        count = connection.execute("SELECT COUNT(*) FROM orders").fetchone()[0]
+        print("{} orders of {} users, filled in {:.1f} s".format(count, users, time.perf_counter() - start))
+
+        problems = plan_problems(connection, users)
+        for name, sql, params, index in QUERIES:
+            print("  plan of {:34} {}".format(name, plan(connection, sql, params(random.Random(1), users))))
+
+        print("after (indexes of database.py):")
+        report(connection, users, 2000)
+        for index in ORDER_INDEXES:
+            connection.execute("DROP INDEX {}".format(index))
+        print("before (without {}):".format(", ".join(ORDER_INDEXES)))
+        report(connection, users, 50)
+        connection.close()
+    finally:
+        os.unlink(path)
+
+    for name, detail in problems:
+        print("PLAN REGRESSION: {} does not use its index: {}".format(name, detail))
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(*[int(arg) for arg in sys.argv[1:]]))
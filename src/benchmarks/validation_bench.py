@@ -0,0 +1,52 @@
+"""
+Compares validating order bodies with jsonschema.validate, which checks the
+schema and creates a validator on every call (before), against the compiled
+SchemaValidators with and without their fast check (after), for single
+orders and bulk lists.
+
+Run from the src directory:
+
+    python -m benchmarks.validation_bench [orders] [bulk size]
+"""
+import sys
+import time
+from jsonschema import validate
+from app import MasonControls
+from validation import SchemaValidator
+
+ORDER = {"symbol": "XBTUSD", "size": 20, "price": 3837.5, "side": "Buy"}
+
+
+def _rate(fn, bodies, orders_per_body):
+    start = time.perf_counter()
+    for body in bodies:
+        fn(body)
+    return len(bodies) * orders_per_body / (time.perf_counter() - start)
+
+
+def main(orders=20000, bulk=100):
+    order_schema = MasonControls.order_schema()
+    bulk_schema = MasonControls.bulk_order_schema()
+    singles = [dict(ORDER, size=i + 1) for i in range(orders)]
+    lists = [[dict(ORDER, size=i + 1) for i in range(bulk)] for _ in range(orders // bulk)]
+
+    compiled = SchemaValidator(order_schema)
+    compiled_bulk = SchemaValidator(bulk_schema)
+    slow = SchemaValidator(order_schema)
+    slow.fast = None
+    slow_bulk = SchemaValidator(bulk_schema)
+    slow_bulk.fast = None
+
+    print("validation throughput in orders/sec")
+    print("single orders  jsonschema.validate: {:10.0f}".format(_rate(lambda body: validate(body, order_schema),
+                                                                       singles, 1)))
+    print("single orders  compiled validator:  {:10.0f}".format(_rate(slow.validate, singles, 1)))
+    print("single orders  compiled, fast path: {:10.0f}".format(_rate(compiled.validate, singles, 1)))
+    print("bulk of {:4d}   jsonschema.validate: {:10.0f}".format(bulk, _rate(lambda body: validate(body, bulk_schema),
+                                                                              lists, bulk)))
+    print("bulk of {:4d}   compiled validator:  {:10.0f}".format(bulk, _rate(slow_bulk.validate, lists, bulk)))
+    print("bulk of {:4d}   compiled, fast path: {:10.0f}".format(bulk, _rate(compiled_bulk.validate, lists, bulk)))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
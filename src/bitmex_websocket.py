@@ -1,12 +1,66 @@
 import websocket
 import threading
 import traceback
-from time import sleep
+import time
 import json
 import logging
 import urllib
-import math
 from util.api_key import generate_nonce, generate_signature
+from ws_store import TableStore, findItemByKeys
+
+
+# Decoders for incoming frames. The faster third party JSON libraries are used when installed.
+DECODERS = {'json': json.loads}
+try:
+    import orjson
+    DECODERS['orjson'] = orjson.loads
+except ImportError:
+    pass
+try:
+    import ujson
+    DECODERS['ujson'] = ujson.loads
+except ImportError:
+    pass
+
+
+def get_decoder(decoder=None):
+    '''Return a function that turns a raw frame into a dict. decoder can be a name from DECODERS,
+    a callable, or None for the fastest one installed.'''
+    if callable(decoder):
+        return decoder
+    if decoder is None:
+        for name in ('orjson', 'ujson', 'json'):
+            if name in DECODERS:
+                return DECODERS[name]
+    if decoder not in DECODERS:
+        raise ValueError("Unknown or not installed decoder: %s" % decoder)
+    return DECODERS[decoder]
+
+
+class WebSocketRejected(websocket.WebSocketTimeoutException):
+    '''Raised instead of WebSocketTimeoutException when BitMEX answers the subscription with an
+    error, e.g. for an unknown symbol.'''
+
+
+class MessageStats:
+    '''Throughput counter of the feed thread.'''
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        self.started = time.monotonic()
+
+    def record(self, size):
+        self.messages += 1
+        self.bytes += size
+
+    def rate(self):
+        '''Messages per second since the counter was started.'''
+        elapsed = time.monotonic() - self.started
+        return self.messages / elapsed if elapsed > 0 else 0.0
+
+    def as_dict(self):
+        return {"messages": self.messages, "bytes": self.bytes, "messages_per_second": self.rate()}
 
 
 # Naive implementation of connecting to BitMEX websocket for streaming realtime data.
@@ -20,18 +74,20 @@ from util.api_key import generate_nonce, generate_signature
 
 # This is a modified version from the python package bitmex-ws version 0.3.1. Juuso added a public positions function to include
 # open positions into the BitMEX websocket API.
-class BitMEXWebsocket:
+class BitMEXWebsocket(TableStore):
 
-    # Don't grow a table larger than this amount. Helps cap memory usage.
-    MAX_TABLE_LEN = 200
+    # Seconds to wait for the connection and the first partials before giving up.
+    READY_TIMEOUT = 10
 
-    def __init__(self, endpoint, symbol, api_key=None, api_secret=None):
-        '''Connect to the websocket and initialize data stores.'''
+    def __init__(self, endpoint, symbol, api_key=None, api_secret=None, table_capacity=None, timeout=None,
+                 decoder=None):
+        '''Connect to the websocket and initialize data stores. symbol can also be a list of
+        symbols, more can be added later with subscribe().'''
         self.logger = logging.getLogger(__name__)
         self.logger.debug("Initializing WebSocket.")
 
+        TableStore.__init__(self, symbol, table_capacity)
         self.endpoint = endpoint
-        self.symbol = symbol
 
         if api_key is not None and api_secret is None:
             raise ValueError('api_secret is required if api_key is provided')
@@ -40,22 +96,32 @@ class BitMEXWebsocket:
 
         self.api_key = api_key
         self.api_secret = api_secret
-
-        self.data = {}
-        self.keys = {}
         self.exited = False
 
+        # Decoding of the frames and a message counter for the feed thread
+        self.decode = get_decoder(decoder)
+        self.stats = MessageStats()
+
+        # Startup waits on this instead of polling. It is notified when the socket opens,
+        # when a partial arrives and when the connection fails.
+        self.timeout = timeout or BitMEXWebsocket.READY_TIMEOUT
+        self.ready = threading.Condition()
+        self.opened = False
+        self.error = None
+        self.rejected = False
+        deadline = time.monotonic() + self.timeout
+
         # We can subscribe right in the connection querystring, so let's build that.
         # Subscribe to all pertinent endpoints
-        wsURL = self.__get_url()
+        wsURL = subscription_url(self.endpoint, self.symbols)
         self.logger.info("Connecting to %s" % wsURL)
-        self.__connect(wsURL, symbol)
+        self.__connect(wsURL, symbol, deadline)
         self.logger.info('Connected to WS.')
 
         # Connected. Wait for partials
-        self.__wait_for_symbol(symbol)
+        self.__wait_for_symbol(', '.join(self.symbols), deadline)
         if api_key:
-            self.__wait_for_account()
+            self.__wait_for_account(deadline)
         self.logger.info('Got all market data. Starting.')
 
     def exit(self):
@@ -63,53 +129,32 @@ class BitMEXWebsocket:
         self.exited = True
         self.ws.close()
 
-    def get_instrument(self):
-        '''Get the raw instrument data for this symbol.'''
-        # Turn the 'tickSize' into 'tickLog' for use in rounding
-        instrument = self.data['instrument'][0]
-        instrument['tickLog'] = int(math.fabs(math.log10(instrument['tickSize'])))
-        return instrument
-
-    def get_ticker(self):
-        '''Return a ticker object. Generated from quote and trade.'''
-        lastQuote = self.data['quote'][-1]
-        lastTrade = self.data['trade'][-1]
-        ticker = {
-            "last": lastTrade['price'],
-            "buy": lastQuote['bidPrice'],
-            "sell": lastQuote['askPrice'],
-            "mid": (float(lastQuote['bidPrice'] or 0) + float(lastQuote['askPrice'] or 0)) / 2
-        }
-
-        # The instrument has a tickSize. Use it to round values.
-        instrument = self.data['instrument'][0]
-        return {k: round(float(v or 0), instrument['tickLog']) for k, v in ticker.items()}
-
-    def funds(self):
-        '''Get your margin details.'''
-        return self.data['margin'][0]
-    def positions(self):
-        '''Get your positions. This has been added by Juuso.'''
-        return self.data['position']
-    def market_depth(self):
-        '''Get market depth (orderbook). Returns all levels.'''
-        return self.data['orderBookL2']
-
-    def open_orders(self, clOrdIDPrefix):
-        '''Get all your open orders.'''
-        orders = self.data['order']
-        # Filter to only open orders (leavesQty > 0) and those that we actually placed
-        return [o for o in orders if str(o['clOrdID']).startswith(clOrdIDPrefix) and o['leavesQty'] > 0]
-
-    def recent_trades(self):
-        '''Get recent trades.'''
-        return self.data['trade']
+    def subscribe(self, symbol, timeout=None):
+        '''Start receiving the tables of another symbol on this connection. Blocks until its
+        partials have arrived, raises WebSocketTimeoutException if they don't in time.'''
+        if symbol in self.symbols:
+            return
+        self.error = None
+        self.rejected = False
+        self.add_symbol(symbol)
+        self.__send_command("subscribe", self.topics([symbol]))
+        try:
+            self.__wait_until(self.is_ready, time.monotonic() + (timeout or self.timeout),
+                              "No market data received for symbol '%s'" % symbol, closeOnFailure=False)
+        except websocket.WebSocketTimeoutException:
+            self.unsubscribe(symbol)
+            raise
+
+    def unsubscribe(self, symbol):
+        '''Stop receiving the tables of a symbol and drop what was stored for it.'''
+        self.__send_command("unsubscribe", self.topics([symbol]))
+        self.drop_symbol(symbol)
 
     #
     # End Public Methods
     #
 
-    def __connect(self, wsURL, symbol):
+    def __connect(self, wsURL, symbol, deadline):
         '''Connect to the websocket in a thread.'''
         self.logger.debug("Starting thread")
 
@@ -126,59 +171,51 @@ class BitMEXWebsocket:
         self.logger.debug("Started thread")
 
         # Wait for connect before continuing
-        conn_timeout = 5
-        while not self.ws.sock or not self.ws.sock.connected and conn_timeout:
-            sleep(1)
-            conn_timeout -= 1
-        if not conn_timeout:
-            self.logger.error("Couldn't connect to WS! Exiting.")
-            self.exit()
-            raise websocket.WebSocketTimeoutException('Couldn\'t connect to WS! Exiting.')
+        self.__wait_until(lambda: self.opened, deadline, "Couldn't connect to WS")
 
     def __get_auth(self):
         '''Return auth headers. Will use API Keys if present in settings.'''
         if self.api_key:
             self.logger.info("Authenticating with API Key.")
-            # To auth to the WS using an API key, we generate a signature of a nonce and
-            # the WS API endpoint.
-            nonce = generate_nonce()
-            return [
-                "api-nonce: " + str(nonce),
-                "api-signature: " + generate_signature(self.api_secret, 'GET', '/realtime', nonce, ''),
-                "api-key:" + self.api_key
-            ]
         else:
             self.logger.info("Not authenticating.")
-            return []
-
-    def __get_url(self):
-        '''
-        Generate a connection URL. We can define subscriptions right in the querystring.
-        Most subscription topics are scoped by the symbol we're listening to.
-        '''
-
-        # You can sub to orderBookL2 for all levels, or orderBook10 for top 10 levels & save bandwidth
-        symbolSubs = ["execution", "instrument", "order", "orderBookL2", "position", "quote", "trade"]
-        genericSubs = ["margin"]
-
-        subscriptions = [sub + ':' + self.symbol for sub in symbolSubs]
-        subscriptions += genericSubs
+        return ["%s: %s" % header for header in auth_headers(self.api_key, self.api_secret).items()]
 
-        urlParts = list(urllib.parse.urlparse(self.endpoint))
-        urlParts[0] = urlParts[0].replace('http', 'ws')
-        urlParts[2] = "/realtime?subscribe={}".format(','.join(subscriptions))
-        return urllib.parse.urlunparse(urlParts)
-
-    def __wait_for_account(self):
+    def __wait_for_account(self, deadline):
         '''On subscribe, this data will come down. Wait for it.'''
         # Wait for the keys to show up from the ws
-        while not {'margin', 'position', 'order', 'orderBookL2'} <= set(self.data):
-            sleep(0.1)
+        self.__wait_until(lambda: self.is_ready(account=True), deadline, "No account data received")
 
-    def __wait_for_symbol(self, symbol):
+    def __wait_for_symbol(self, symbol, deadline):
         '''On subscribe, this data will come down. Wait for it.'''
-        while not {'instrument', 'trade', 'quote'} <= set(self.data):
-            sleep(0.1)
+        self.__wait_until(self.is_ready, deadline, "No market data received for symbol '%s'" % symbol)
+
+    def __wait_until(self, condition, deadline, failure, closeOnFailure=True):
+        '''Block until condition is true. Raises WebSocketTimeoutException, and closes the socket
+        unless told not to, if the deadline passes or the connection fails first.'''
+        with self.ready:
+            self.ready.wait_for(lambda: condition() or self.error is not None or self.exited,
+                                timeout=max(0, deadline - time.monotonic()))
+            if condition():
+                return
+            rejected = self.rejected
+            if self.error is not None:
+                reason = "%s: %s" % (failure, self.error)
+            elif self.exited:
+                reason = "%s: connection closed" % failure
+            else:
+                reason = "%s within %s seconds" % (failure, self.timeout)
+        self.logger.error(reason)
+        if closeOnFailure:
+            self.exit()
+        if rejected:
+            raise WebSocketRejected(reason)
+        raise websocket.WebSocketTimeoutException(reason)
+
+    def __notify(self):
+        '''Wake up the startup waits.'''
+        with self.ready:
+            self.ready.notify_all()
 
     def __send_command(self, command, args=None):
         '''Send a raw command.'''
@@ -188,58 +225,24 @@ class BitMEXWebsocket:
 
     def __on_message(self, ws, message):
         '''Handler for parsing WS messages.'''
-        message = json.loads(message)
-        self.logger.debug(json.dumps(message))
+        self.stats.record(len(message))
+        # Log arguments are only formatted when DEBUG is enabled
+        self.logger.debug("%s", message)
+        message = self.decode(message)
 
-        table = message['table'] if 'table' in message else None
-        action = message['action'] if 'action' in message else None
         try:
             if 'subscribe' in message:
-                self.logger.debug("Subscribed to %s." % message['subscribe'])
-            elif action:
-
-                if table not in self.data:
-                    self.data[table] = []
-
-                # There are four possible actions from the WS:
-                # 'partial' - full table image
-                # 'insert'  - new row
-                # 'update'  - update row
-                # 'delete'  - delete row
-                if action == 'partial':
-                    self.logger.debug("%s: partial" % table)
-                    self.data[table] += message['data']
-                    # Keys are communicated on partials to let you know how to uniquely identify
-                    # an item. We use it for updates.
-                    self.keys[table] = message['keys']
-                elif action == 'insert':
-                    self.logger.debug('%s: inserting %s' % (table, message['data']))
-                    self.data[table] += message['data']
-
-                    # Limit the max length of the table to avoid excessive memory usage.
-                    # Don't trim orders because we'll lose valuable state if we do.
-                    if table not in ['order', 'orderBookL2'] and len(self.data[table]) > BitMEXWebsocket.MAX_TABLE_LEN:
-                        self.data[table] = self.data[table][int(BitMEXWebsocket.MAX_TABLE_LEN / 2):]
-
-                elif action == 'update':
-                    self.logger.debug('%s: updating %s' % (table, message['data']))
-                    # Locate the item in the collection and update it.
-                    for updateData in message['data']:
-                        item = findItemByKeys(self.keys[table], self.data[table], updateData)
-                        if not item:
-                            return  # No item found to update. Could happen before push
-                        item.update(updateData)
-                        # Remove cancelled / filled orders
-                        if table == 'order' and item['leavesQty'] <= 0:
-                            self.data[table].remove(item)
-                elif action == 'delete':
-                    self.logger.debug('%s: deleting %s' % (table, message['data']))
-                    # Locate the item in the collection and remove it.
-                    for deleteData in message['data']:
-                        item = findItemByKeys(self.keys[table], self.data[table], deleteData)
-                        self.data[table].remove(item)
-                else:
-                    raise Exception("Unknown action: %s" % action)
+                self.logger.debug("Subscribed to %s.", message['subscribe'])
+            elif 'error' in message:
+                # e.g. subscribing to an unknown symbol, fail the startup waits right away
+                self.logger.error("Error from BitMEX: %s" % message['error'])
+                self.error = message['error']
+                self.rejected = True
+                self.__notify()
+            else:
+                applied = self.apply(message)
+                if applied and applied[1] == 'partial':
+                    self.__notify()
         except:
             self.logger.error(traceback.format_exc())
 
@@ -247,29 +250,50 @@ class BitMEXWebsocket:
         '''Called on fatal websocket errors. We exit on these.'''
         if not self.exited:
             self.logger.error("Error : %s" % error)
+            self.error = error
+            self.__notify()
             raise websocket.WebSocketException(error)
 
     def __on_open(self, ws):
         '''Called when the WS opens.'''
         self.logger.debug("Websocket Opened.")
+        self.opened = True
+        self.__notify()
 
     def __on_close(self, ws):
         '''Called on websocket close.'''
         self.logger.info('Websocket Closed')
-
-
-# Utility method for finding an item in the store.
-# When an update comes through on the websocket, we need to figure out which item in the array it is
-# in order to match that item.
-#
-# Helpfully, on a data push (or on an HTTP hit to /api/v1/schema), we have a "keys" array. These are the
-# fields we can use to uniquely identify an item. Sometimes there is more than one, so we iterate through all
-# provided keys.
-def findItemByKeys(keys, table, matchData):
-    for item in table:
-        matched = True
-        for key in keys:
-            if item[key] != matchData[key]:
-                matched = False
-        if matched:
-            return item
+        self.exited = True
+        self.__notify()
+
+
+def subscription_url(endpoint, symbols):
+    '''
+    Generate a connection URL. We can define subscriptions right in the querystring.
+    Most subscription topics are scoped by the symbols we're listening to.
+    '''
+    if isinstance(symbols, str):
+        symbols = [symbols]
+
+    # You can sub to orderBookL2 for all levels, or orderBook10 for top 10 levels & save bandwidth
+    subscriptions = [sub + ':' + symbol for symbol in symbols for sub in TableStore.SYMBOL_TABLES]
+    subscriptions += TableStore.GENERIC_TABLES
+
+    urlParts = list(urllib.parse.urlparse(endpoint))
+    urlParts[0] = urlParts[0].replace('http', 'ws')
+    urlParts[2] = "/realtime?subscribe={}".format(','.join(subscriptions))
+    return urllib.parse.urlunparse(urlParts)
+
+
+def auth_headers(api_key, api_secret):
+    '''Return the auth headers of the realtime endpoint as a dict, empty without an API key.'''
+    if not api_key:
+        return {}
+    # To auth to the WS using an API key, we generate a signature of a nonce and
+    # the WS API endpoint.
+    nonce = generate_nonce()
+    return {
+        "api-nonce": str(nonce),
+        "api-signature": generate_signature(api_secret, 'GET', '/realtime', nonce, ''),
+        "api-key": api_key
+    }
@@ -0,0 +1,270 @@
+import json
+import logging
+import threading
+import time
+import pytest
+import websocket
+from bitmex_websocket import BitMEXWebsocket, WebSocketRejected, findItemByKeys, get_decoder, MessageStats
+from ws_store import TableStore
+from ws_tables import KeyedTable, RingBuffer
+
+
+"""
+Tests for the table handling of the BitMEX websocket. Messages are fed
+straight to the message handler so that no network connection is needed.
+
+"""
+
+class OfflineWebsocket(BitMEXWebsocket):
+    """ BitMEXWebsocket that does not connect anywhere """
+
+    def __init__(self, symbol="XBTUSD"):
+        self.logger = logging.getLogger(__name__)
+        TableStore.__init__(self, symbol)
+        self.endpoint = "https://testnet.bitmex.com/api/v1"
+        self.api_key = None
+        self.api_secret = None
+        self.exited = False
+        self.ready = threading.Condition()
+        self.opened = True
+        self.error = None
+        self.decode = get_decoder()
+        self.stats = MessageStats()
+
+    def feed(self, table, action, data, keys=None):
+        message = {"table": table, "action": action, "data": data}
+        if keys is not None:
+            message["keys"] = keys
+        self._BitMEXWebsocket__on_message(None, json.dumps(message))
+
+
+class ScriptedApp(object):
+    """ Replaces websocket.WebSocketApp, plays back a list of messages """
+    script = []
+
+    # subscribe topic -> messages sent in reply
+    replies = {}
+
+    def __init__(self, url, on_message, on_close, on_open, on_error, header):
+        self.url = url
+        self.sent = []
+        self.on_message = on_message
+        self.on_close = on_close
+        self.on_open = on_open
+        self.closed = threading.Event()
+
+    def run_forever(self):
+        self.on_open(self)
+        for message in ScriptedApp.script:
+            self.on_message(self, json.dumps(message))
+        self.closed.wait()
+
+    def send(self, data):
+        self.sent.append(json.loads(data))
+        for topic in self.sent[-1]["args"]:
+            for message in ScriptedApp.replies.get(topic, []):
+                self.on_message(self, json.dumps(message))
+
+    def close(self):
+        self.closed.set()
+        self.on_close(self)
+
+
+def _book_row(id, side, size, price, symbol="XBTUSD"):
+    return {"symbol": symbol, "id": id, "side": side, "size": size, "price": price}
+
+def _position_row(symbol, qty):
+    return {"account": 1, "symbol": symbol, "currency": "XBt", "currentQty": qty}
+
+def _order_row(id, leaves=10):
+    return {"orderID": id, "clOrdID": "mm-" + id, "symbol": "XBTUSD",
+            "price": 3500.0, "orderQty": 10, "leavesQty": leaves}
+
+@pytest.fixture
+def ws():
+    return OfflineWebsocket()
+
+def test_partial_builds_index(ws):
+    """ Keyed tables get indexed, tables without keys stay lists """
+    ws.feed("position", "partial", [_position_row("XBTUSD", 10), _position_row("ETHUSD", 20)],
+            keys=["account", "symbol", "currency"])
+    ws.feed("trade", "partial", [{"symbol": "XBTUSD", "price": 3500.5}], keys=[])
+    assert isinstance(ws.data["position"]["ETHUSD"], KeyedTable)
+    assert isinstance(ws.data["trade"]["XBTUSD"], RingBuffer)
+    assert ws.data["position"]["ETHUSD"].get(_position_row("ETHUSD", 0))["currentQty"] == 20
+
+def test_update_and_delete(ws):
+    """ Updates change the right row and deletes remove it """
+    ws.feed("position", "partial", [_position_row("S{}".format(i), i) for i in range(100)],
+            keys=["account", "symbol", "currency"])
+    ws.feed("position", "update", [{"account": 1, "symbol": "S42", "currency": "XBt", "currentQty": 1000}])
+    ws.feed("position", "delete", [{"account": 1, "symbol": "S7", "currency": "XBt"}])
+    ws.feed("position", "insert", [_position_row("XBTUSD", 5)])
+    positions = ws.positions()
+    assert len(positions) == 100
+    assert ws.positions("S42")[0]["currentQty"] == 1000
+    assert ws.positions("S7") == []
+    assert positions[-1]["symbol"] == "XBTUSD"
+    assert positions[0]["symbol"] == "S0"
+
+def test_filled_orders_are_removed(ws):
+    """ Orders with nothing left to fill are dropped from the order table """
+    ws.feed("order", "partial", [_order_row("a"), _order_row("b")], keys=["orderID"])
+    ws.feed("order", "update", [{"orderID": "a", "leavesQty": 0},
+                                {"orderID": "unknown", "leavesQty": 0},
+                                {"orderID": "b", "leavesQty": 5}])
+    assert [o["orderID"] for o in ws.open_orders("mm-")] == ["b"]
+
+def test_market_depth(ws):
+    """ orderBookL2 goes to a price ordered book per symbol """
+    ws.feed("orderBookL2", "partial", [_book_row(1, "Sell", 10, 3502.0), _book_row(2, "Buy", 20, 3499.0),
+                                       _book_row(3, "Sell", 30, 3501.0), _book_row(4, "Buy", 40, 3500.0),
+                                       _book_row(5, "Buy", 1, 100.0, symbol="ETHUSD")],
+            keys=["symbol", "id", "side"])
+    ws.feed("orderBookL2", "update", [{"symbol": "XBTUSD", "id": 4, "side": "Buy", "size": 45}])
+    ws.feed("orderBookL2", "delete", [{"symbol": "XBTUSD", "id": 1, "side": "Sell"}])
+    depth = ws.market_depth()
+    assert [row["price"] for row in depth["bids"]] == [3500.0, 3499.0]
+    assert [row["price"] for row in depth["asks"]] == [3501.0]
+    assert depth["bids"][0]["size"] == 45
+    assert len(ws.books["ETHUSD"]) == 1
+
+def test_trades_are_bounded(ws):
+    """ Trades go to a ring buffer that keeps the newest MAX_TABLE_LEN rows """
+    ws.feed("trade", "partial", [{"symbol": "XBTUSD", "price": 1.0, "size": 0}], keys=[])
+    for i in range(1, 500):
+        ws.feed("trade", "insert", [{"symbol": "XBTUSD", "price": 1.0, "size": i}])
+    assert isinstance(ws.data["trade"]["XBTUSD"], RingBuffer)
+    trades = ws.recent_trades()
+    assert len(trades) == BitMEXWebsocket.MAX_TABLE_LEN
+    assert [t["size"] for t in trades] == list(range(300, 500))
+
+def test_tables_are_partitioned_by_symbol():
+    """ One connection keeps the rows of each symbol apart """
+    ws = OfflineWebsocket(["XBTUSD", "ETHUSD"])
+    ws.feed("trade", "partial", [{"symbol": "XBTUSD", "price": 3500.0}, {"symbol": "ETHUSD", "price": 120.0}],
+            keys=[])
+    ws.feed("trade", "insert", [{"symbol": "ETHUSD", "price": 121.0}])
+    assert [t["price"] for t in ws.recent_trades()] == [3500.0]
+    assert [t["price"] for t in ws.recent_trades("ETHUSD")] == [120.0, 121.0]
+    ws.drop_symbol("ETHUSD")
+    assert ws.symbols == ["XBTUSD"]
+    assert "ETHUSD" not in ws.data["trade"]
+
+def test_snapshots_are_immutable_and_versioned(ws):
+    """ A snapshot keeps showing the table as it was when it was taken """
+    ws.feed("order", "partial", [_order_row("a"), _order_row("b")], keys=["orderID"])
+    version = ws.version("order")
+    before = ws.snapshot("order")
+    assert ws.snapshot("order") is before
+    ws.feed("order", "update", [{"orderID": "a", "leavesQty": 4}])
+    assert ws.version("order") == version + 1
+    assert [o["leavesQty"] for o in before] == [10, 10]
+    assert [o["leavesQty"] for o in ws.snapshot("order")] == [4, 10]
+
+def test_readers_see_consistent_tables(ws):
+    """ Reading while the feed thread changes the tables does not fail or tear """
+    ws.feed("order", "partial", [_order_row(str(i)) for i in range(50)], keys=["orderID"])
+    done = threading.Event()
+
+    def feed():
+        i = 50
+        while not done.is_set():
+            # every message removes one order and adds one, the table always has 50 rows
+            ws.feed("order", "update", [{"orderID": str(i - 50), "leavesQty": 0}])
+            ws.feed("order", "insert", [_order_row(str(i))])
+            i += 1
+    feeder = threading.Thread(target=feed)
+    feeder.start()
+    try:
+        sizes = set()
+        for _ in range(2000):
+            sizes.add(len(ws.open_orders("mm-")))
+    finally:
+        done.set()
+        feeder.join()
+    assert sizes <= {49, 50}
+
+def test_decoder_selection():
+    """ Decoders can be picked by name or passed in as a callable """
+    assert get_decoder("json")('{"a": 1}') == {"a": 1}
+    assert get_decoder()('{"a": 1}') == {"a": 1}
+    custom = lambda raw: {"raw": raw}
+    assert get_decoder(custom) is custom
+    with pytest.raises(ValueError):
+        get_decoder("nope")
+
+def test_message_counter(ws):
+    """ Every frame is counted """
+    ws.feed("trade", "partial", [], keys=[])
+    ws.feed("trade", "insert", [{"symbol": "XBTUSD", "price": 1.0}])
+    assert ws.stats.messages == 2
+    assert ws.stats.as_dict()["bytes"] > 0
+
+def test_find_item_by_keys():
+    """ The linear fallback still finds the first matching row """
+    table = [{"a": 1, "b": 1}, {"a": 1, "b": 2}]
+    assert findItemByKeys(["a", "b"], table, {"a": 1, "b": 2}) is table[1]
+    assert findItemByKeys(["a"], table, {"a": 2}) is None
+
+def _partial(table, symbol="XBTUSD"):
+    return {"table": table, "action": "partial", "keys": [], "data": [],
+            "filter": {"symbol": symbol}}
+
+@pytest.fixture
+def scripted(monkeypatch):
+    monkeypatch.setattr(websocket, "WebSocketApp", ScriptedApp)
+    monkeypatch.setattr(ScriptedApp, "replies", {})
+    return ScriptedApp
+
+def test_startup_returns_on_partials(scripted):
+    """ The constructor returns as soon as the partials are in, without polling """
+    scripted.script = [_partial("instrument"), _partial("trade"), _partial("quote")]
+    start = time.monotonic()
+    ws = BitMEXWebsocket("https://testnet.bitmex.com/api/v1", "XBTUSD", timeout=5)
+    assert time.monotonic() - start < 0.5
+    assert ws.opened
+    ws.exit()
+
+def test_unknown_symbol_fails_fast(scripted):
+    """ An error message from BitMEX ends the wait with a clear error """
+    scripted.script = [{"status": 400, "error": "Unknown or expired symbol."}]
+    start = time.monotonic()
+    with pytest.raises(WebSocketRejected) as error:
+        BitMEXWebsocket("https://testnet.bitmex.com/api/v1", "NOPE", timeout=5)
+    assert "Unknown or expired symbol" in str(error.value)
+    assert time.monotonic() - start < 0.5
+
+def test_missing_partials_time_out(scripted):
+    """ Without partials the constructor gives up after the deadline """
+    scripted.script = [_partial("instrument")]
+    start = time.monotonic()
+    with pytest.raises(websocket.WebSocketTimeoutException) as error:
+        BitMEXWebsocket("https://testnet.bitmex.com/api/v1", "XBTUSD", timeout=0.3)
+    assert "within 0.3 seconds" in str(error.value)
+    assert not isinstance(error.value, WebSocketRejected)
+    assert time.monotonic() - start < 2
+
+def test_subscribe_and_unsubscribe(scripted):
+    """ Symbols can be added to and removed from a running connection """
+    scripted.script = [_partial("instrument"), _partial("trade"), _partial("quote")]
+    scripted.replies = {"instrument:ETHUSD": [_partial(table, "ETHUSD") for table in ("instrument", "trade", "quote")]}
+    ws = BitMEXWebsocket("https://testnet.bitmex.com/api/v1", "XBTUSD", timeout=5)
+    ws.subscribe("ETHUSD")
+    assert ws.symbols == ["XBTUSD", "ETHUSD"]
+    assert ws.ws.sent[0] == {"op": "subscribe", "args": ws.topics(["ETHUSD"])}
+    ws.unsubscribe("ETHUSD")
+    assert ws.ws.sent[1]["op"] == "unsubscribe"
+    assert ws.symbols == ["XBTUSD"]
+    assert ws.recent_trades("XBTUSD") == []
+    ws.exit()
+
+def test_subscribe_times_out_without_closing(scripted):
+    """ A symbol that never gets its partials is dropped again, the connection stays up """
+    scripted.script = [_partial("instrument"), _partial("trade"), _partial("quote")]
+    ws = BitMEXWebsocket("https://testnet.bitmex.com/api/v1", "XBTUSD", timeout=5)
+    with pytest.raises(websocket.WebSocketTimeoutException):
+        ws.subscribe("ETHUSD", timeout=0.2)
+    assert ws.symbols == ["XBTUSD"]
+    assert not ws.exited
+    ws.exit()
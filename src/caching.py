@@ -0,0 +1,155 @@
+import time
+import threading
+import uuid
+from collections import OrderedDict
+
+
+"""
+In-memory caches for the responses and accounts of the API.
+
+"""
+
+class VersionedCache:
+    """ Caches values that are derived from versioned data, such as the
+        serialized body of an order book. An entry is valid as long as the
+        version it was built from is the current one, so there is no expiry
+        to tune and a poller gets the cached value until the data changes.
+        Holds at most max_entries keys, the least recently used are dropped.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version, build):
+        """ Returns the value cached for key if it was built from version,
+            otherwise calls build() and caches what it returns.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        # built outside the lock so that slow builds of different keys don't wait on each other
+        value = build()
+        with self._lock:
+            self._entries[key] = (version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """ Returns the number of entries, hits and misses """
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+class Versions:
+    """ Change counters of data kept in the database, such as the orders of
+        an account, for the ETags of its responses. Writers bump the key of
+        what they changed after committing. The counters live in the process,
+        so every process starts from its own epoch and the ETags of an
+        earlier one never match.
+    """
+
+    def __init__(self):
+        self.epoch = uuid.uuid4().hex
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def bump(self, key):
+        with self._lock:
+            self._counts[key] = self._counts.get(key, 0) + 1
+
+    def get(self, key):
+        """ Returns the current version of key as a string """
+        return "{}-{}".format(self.epoch, self._counts.get(key, 0))
+
+
+class AccountRecord:
+    """ The columns of a User row, detached from the session so that it can
+        be shared between requests
+    """
+    __slots__ = ("id", "username", "api_public", "api_secret")
+
+    def __init__(self, id, username, api_public, api_secret):
+        self.id = id
+        self.username = username
+        self.api_public = api_public
+        self.api_secret = api_secret
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(user.id, user.username, user.api_public, user.api_secret)
+
+
+class AccountCache:
+    """ LRU cache of AccountRecords keyed by api_public. Entries expire
+        after ttl seconds so that changes made by other processes show up,
+        changes made by this one invalidate their entry right away. Accounts
+        that don't exist are not cached, so unknown keys can't fill it up.
+    """
+
+    def __init__(self, max_entries=10000, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # bumped by invalidate, a record loaded before it is not cached
+        self._generation = 0
+
+    def get(self, api_public, load):
+        """ Returns the cached record of api_public, or the one load() makes
+            of the User it returns. None if load() returns None.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(api_public)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(api_public)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self._generation
+        user = load()
+        if user is None:
+            return None
+        record = AccountRecord.from_user(user)
+        with self._lock:
+            if generation != self._generation:
+                return record
+            self._entries[api_public] = (now + self.ttl, record)
+            self._entries.move_to_end(api_public)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return record
+
+    def invalidate(self, api_public):
+        with self._lock:
+            self._entries.pop(api_public, None)
+            self._generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+    def stats(self):
+        """ Returns the number of entries, hits, misses and evictions """
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions}
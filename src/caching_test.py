@@ -0,0 +1,68 @@
+import time
+from caching import VersionedCache, AccountCache
+
+
+"""
+Tests for the in-memory caches
+
+"""
+
+class FakeUser(object):
+    def __init__(self, id, api_public="key", username="user", api_secret="secret"):
+        self.id = id
+        self.api_public = api_public
+        self.username = username
+        self.api_secret = api_secret
+
+def test_versioned_cache():
+    """ Values are rebuilt only when the version changes """
+    cache = VersionedCache(max_entries=2)
+    builds = []
+    def build(value):
+        builds.append(value)
+        return value
+    assert cache.get("a", 1, lambda: build("a1")) == "a1"
+    assert cache.get("a", 1, lambda: build("a2")) == "a1"
+    assert cache.get("a", 2, lambda: build("a2")) == "a2"
+    cache.get("b", 1, lambda: build("b1"))
+    cache.get("c", 1, lambda: build("c1"))
+    assert cache.stats() == {"entries": 2, "hits": 1, "misses": 4}
+    # a was the least recently used
+    assert cache.get("a", 2, lambda: build("a3")) == "a3"
+
+def test_account_cache_hits_and_invalidation():
+    """ Records are served from the cache until invalidated """
+    cache = AccountCache()
+    loads = []
+    def load():
+        loads.append(1)
+        return FakeUser(len(loads))
+    assert cache.get("key", load).id == 1
+    assert cache.get("key", load).id == 1
+    cache.invalidate("key")
+    assert cache.get("key", load).id == 2
+    assert cache.get("nope", lambda: None) is None
+    assert cache.get("nope", lambda: None) is None
+    assert cache.stats() == {"entries": 1, "hits": 1, "misses": 4, "evictions": 0}
+
+def test_account_cache_expiry_and_size():
+    """ Entries expire after the ttl and the least recently used are evicted """
+    cache = AccountCache(max_entries=2, ttl=0.05)
+    cache.get("a", lambda: FakeUser(1))
+    cache.get("b", lambda: FakeUser(2))
+    cache.get("a", lambda: FakeUser(3))
+    cache.get("c", lambda: FakeUser(4))
+    assert cache.stats()["evictions"] == 1
+    assert cache.get("a", lambda: FakeUser(5)).id == 1
+    assert cache.get("b", lambda: FakeUser(6)).id == 6
+    time.sleep(0.06)
+    assert cache.get("a", lambda: FakeUser(7)).id == 7
+
+def test_invalidate_during_load():
+    """ A record loaded before an invalidate is not cached """
+    cache = AccountCache()
+    def load():
+        cache.invalidate("key")
+        return FakeUser(1)
+    assert cache.get("key", load).id == 1
+    assert cache.get("key", lambda: FakeUser(2)).id == 2
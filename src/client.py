@@ -75,9 +75,15 @@ def priceactionmenu():
         else:
             connected = True
             prev_response = {}
+            etag = None
             while(connected == True):
-                response = requests.get(API_URL + '/priceaction/', params={"symbol" : str})
-                response = json.loads(response.text)
+                # the API answers 304 without a body while there are no new trades
+                headers = {"If-None-Match": etag} if etag else {}
+                response = requests.get(API_URL + '/priceaction/', params={"symbol" : str}, headers=headers)
+                if response.status_code != 304:
+                    etag = response.headers.get("ETag")
+                    prev_response = json.loads(response.text)
+                response = prev_response
 
                 print("PRICE: {}, SIZE: {}, SIDE: {}".format(response["price"], response["size"], response["side"]))
                 time.sleep(2)
@@ -10,12 +10,44 @@ class User(db.Model):
     api_public = db.Column(db.String(24), nullable=False, unique=True)
     api_secret = db.Column(db.String(48), nullable=False)
     orders = db.relationship("Orders", back_populates="user")
+    executions = db.relationship("Execution", back_populates="user", passive_deletes=True)
 
 class Orders(db.Model):
+    """ (user_id, order_id) serves the order listing of an account and its
+        keyset pagination, (user_id, order_symbol) the lookups of an account's
+        orders of one symbol. order_id is the primary key.
+    """
+    __table_args__ = (db.Index("ix_orders_user_order", "user_id", "order_id"),
+                      db.Index("ix_orders_user_symbol", "user_id", "order_symbol"))
     order_id = db.Column(db.String(36), nullable=False, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="SET NULL", onupdate="CASCADE"))
     order_price = db.Column(db.Float, nullable=False)
     order_size = db.Column(db.Integer, nullable=False)
     order_side = db.Column(db.String(4), nullable=False)
     order_symbol = db.Column(db.String(10), nullable=False)
+    # kept up to date from the order table of the account websocket, see reconciler.py
+    order_status = db.Column(db.String(16), nullable=False, default="New")
+    filled_qty = db.Column(db.Integer, nullable=False, default=0)
+    leaves_qty = db.Column(db.Integer, nullable=True)
     user = db.relationship("User", back_populates="orders")
+
+class Execution(db.Model):
+    """ Execution received from the execution table of the BitMEX websocket.
+        The indexes serve the history of an account newest first, with and
+        without a symbol filter, paginated on (timestamp, exec_id).
+    """
+    __table_args__ = (db.UniqueConstraint("user_id", "exec_id"),
+                      db.Index("ix_execution_user_time", "user_id", "timestamp", "exec_id"),
+                      db.Index("ix_execution_user_symbol_time", "user_id", "symbol", "timestamp", "exec_id"))
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), nullable=False)
+    exec_id = db.Column(db.String(36), nullable=False)
+    order_id = db.Column(db.String(36))
+    symbol = db.Column(db.String(10), nullable=False)
+    side = db.Column(db.String(4))
+    exec_type = db.Column(db.String(16))
+    price = db.Column(db.Float)
+    size = db.Column(db.Integer)
+    # milliseconds since the epoch
+    timestamp = db.Column(db.BigInteger, nullable=False)
+    user = db.relationship("User", back_populates="executions")
@@ -1,8 +1,16 @@
 import pytest
+import sqlite3
 import tempfile
 import os
 import app
-from database import User, Orders, db
+from database import User, Orders, Execution, db
+from executions import ExecutionRecorder
+from reconciler import OrderReconciler
+from account_feeds import AccountFeeds
+from ws_manager import WebsocketManager
+from ws_manager_test import FakeWebsocket
+from caching import Versions
+from benchmarks.query_plan_bench import plan_problems
 from sqlalchemy.engine import Engine
 from sqlalchemy import event
 
@@ -104,3 +112,116 @@ def test_order_onupdate_user(db_handle):
     db.session.commit()
     db_order = Orders.query.first()
     assert db_order.user_id == 73
+
+def test_executions_are_recorded_once(db_handle):
+    """
+    Tests that the recorder skips executions that are already stored and
+    that the executions of a deleted user are deleted with it.
+    """
+
+    user = _get_user()
+    db_handle.session.add(user)
+    db_handle.session.commit()
+    row = {"execID": "e1", "orderID": "o1", "symbol": "XBTUSD", "side": "Buy", "execType": "Trade",
+           "lastPx": 3500.0, "lastQty": 5, "timestamp": "2019-03-14T12:00:00.000Z"}
+    recorder = ExecutionRecorder(app.app)
+    recorder.record(user.id, [row])
+    recorder.record(user.id, [row, dict(row, execID="e2")])
+    assert Execution.query.count() == 2
+    assert Execution.query.filter_by(exec_id="e1").first().timestamp == 1552564800000
+
+    db_handle.session.delete(user)
+    db_handle.session.commit()
+    assert Execution.query.count() == 0
+
+def test_order_updates_are_reconciled(db_handle):
+    """
+    Tests that the updates of an order are merged into one row update, that
+    other accounts' orders are not touched and that updates of orders that
+    are not stored yet wait for them.
+    """
+
+    user, other = _get_user(1), _get_user(2)
+    order = _get_order(1)
+    user.orders.append(order)
+    other.orders.append(_get_order(2))
+    db_handle.session.add_all([user, other])
+    db_handle.session.commit()
+    versions = Versions()
+    reconciler = OrderReconciler(app.app, grace=60, versions=versions)
+
+    reconciler.add(user.id, [{"orderID": order.order_id, "ordStatus": "PartiallyFilled", "cumQty": 1,
+                              "leavesQty": 1, "orderQty": 2},
+                             {"orderID": order.order_id, "cumQty": 2, "leavesQty": 0},
+                             {"orderID": order.order_id, "ordStatus": "Filled"},
+                             {"orderID": "00000000-0000-0000-0000-000000000002", "ordStatus": "Canceled"},
+                             {"orderID": "00000000-0000-0000-0000-000000000003", "ordStatus": "Filled"}])
+    assert reconciler.flush() == 1
+    db_handle.session.expire_all()
+    stored = Orders.query.get(order.order_id)
+    assert (stored.order_status, stored.filled_qty, stored.leaves_qty, stored.order_size) == ("Filled", 2, 0, 2)
+    assert Orders.query.get("00000000-0000-0000-0000-000000000002").order_status == "New"
+    assert reconciler.stats() == {"received": 5, "written": 1, "flushes": 1, "pending": 2}
+    assert versions.get(("orders", user.id)) != versions.get(("orders", other.id))
+
+    # the order placed meanwhile gets its update, the other account's order never does
+    late = _get_order(3)
+    user.orders.append(late)
+    db_handle.session.commit()
+    assert reconciler.flush() == 1
+    db_handle.session.expire_all()
+    assert Orders.query.get(late.order_id).order_status == "Filled"
+    reconciler.grace = 0
+    reconciler.flush()
+    assert reconciler.stats()["pending"] == 0
+
+def test_account_feeds_follow_open_orders(db_handle):
+    """
+    Tests that the websockets of accounts with open orders are kept open and
+    reopened after the server closed them, and given back once their orders
+    are done.
+    """
+
+    user, other = _get_user(1), _get_user(2)
+    order = _get_order(1)
+    user.orders.append(order)
+    done = _get_order(2)
+    done.order_status = "Filled"
+    other.orders.append(done)
+    db_handle.session.add_all([user, other])
+    db_handle.session.commit()
+    manager = WebsocketManager(factory=FakeWebsocket, idle_timeout=0, reap_interval=60)
+    feeds = AccountFeeds(app.app, manager, "endpoint", interval=60)
+    try:
+        assert feeds.refresh() == 1
+        assert feeds.held() == {user.api_public}
+        ws = feeds.hold(user.api_public, user.api_secret)
+        assert manager.reap() == 0
+        assert manager.stats() == {("endpoint", "", user.api_public): 1}
+
+        ws.exited = True
+        feeds.refresh()
+        again = feeds.hold(user.api_public, user.api_secret)
+        assert again is not ws
+        assert manager.stats() == {("endpoint", "", user.api_public): 1}
+
+        order.order_status = "Canceled"
+        db_handle.session.commit()
+        assert feeds.refresh() == 0
+        assert manager.reap() == 1
+        assert again.exited
+    finally:
+        feeds.close()
+        manager.close_all()
+
+def test_queries_use_indexes(db_handle):
+    """
+    Tests that the query patterns of the app are answered from an index
+    instead of a table scan.
+    """
+
+    connection = sqlite3.connect(db_handle.engine.url.database)
+    try:
+        assert plan_problems(connection) == []
+    finally:
+        connection.close()
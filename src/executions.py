@@ -0,0 +1,76 @@
+import logging
+from contextlib import nullcontext
+from flask import has_app_context
+from database import db, User, Execution
+from utils import parse_timestamp
+
+
+"""
+Persists the execution table of the account websockets, so that the order
+history of an account outlives the few executions the websocket keeps.
+
+"""
+
+def execution_values(user_id, row):
+    """ Turns an execution row of the websocket into the columns of Execution """
+    return {"user_id": user_id,
+            "exec_id": row["execID"],
+            "order_id": row.get("orderID"),
+            "symbol": row["symbol"],
+            "side": row.get("side"),
+            "exec_type": row.get("execType"),
+            "price": row.get("lastPx", row.get("price")),
+            "size": row.get("lastQty", row.get("orderQty")),
+            "timestamp": int(round(parse_timestamp(row["timestamp"]) * 1000))}
+
+
+class ExecutionRecorder:
+    """ Writes the executions of account websockets to the database.
+        Executions arrive more than once, e.g. in the partial after a
+        reconnect, so they are inserted with INSERT OR IGNORE on the unique
+        (user_id, exec_id).
+
+        Executions are only received while the account websocket is open.
+        AccountFeeds keeps it open for accounts with open orders. Of the
+        time it was closed, only what the partial of the next connection
+        replays is recorded.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.logger = logging.getLogger(__name__)
+        self._insert = Execution.__table__.insert().prefix_with("OR IGNORE", dialect="sqlite")
+
+    def attach(self, ws):
+        """ Starts recording the executions of an account websocket,
+            beginning with the ones it already has
+        """
+        with self._context():
+            user = User.query.filter_by(api_public=ws.api_key).first()
+            if user is None:
+                return
+            user_id = user.id
+
+        def on_executions(action, rows):
+            if action in ("partial", "insert"):
+                self.record(user_id, rows)
+        if "execution" in ws.data:
+            self.record(user_id, ws.snapshot("execution", ws.ALL_SYMBOLS))
+        ws.add_listener("execution", on_executions)
+
+    def record(self, user_id, rows):
+        """ Inserts execution rows, skipping the ones already stored.
+            Usually called from the feed thread, which needs an app context.
+        """
+        values = [execution_values(user_id, row) for row in rows if "execID" in row]
+        if not values:
+            return 0
+        with self._context():
+            db.session.execute(self._insert, values)
+            db.session.commit()
+        return len(values)
+
+    def _context(self):
+        # Popping an app context removes the session of the thread, so a
+        # request that already has one must keep using it.
+        return nullcontext() if has_app_context() else self.app.app_context()
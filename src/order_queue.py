@@ -0,0 +1,146 @@
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+"""
+Bounded in-process queue of order submissions drained by a pool of worker
+threads, so a request can hand its order over and return without waiting for
+the exchange.
+
+"""
+
+class QueueFull(Exception):
+    """ Raised by OrderQueue.submit when the queue has no room left """
+
+
+class Submission:
+    """ A job on the queue and, once a worker has run it, its outcome. status
+        goes from queued to running to done, or failed if the job raised, in
+        which case error is the exception.
+    """
+
+    def __init__(self, account, job):
+        self.id = uuid.uuid4().hex
+        self.account = account
+        self.job = job
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.queued_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+        self._done = threading.Event()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """ Blocks until the job has run or timeout seconds have passed,
+            returns whether it has run
+        """
+        return self._done.wait(timeout)
+
+    def queue_time(self):
+        """ Seconds the job waited for a worker, so far if it still waits """
+        return (self.started_at or time.monotonic()) - self.queued_at
+
+
+class OrderQueue:
+    """ Runs submitted jobs on worker threads, at most max_size of them wait
+        at a time. The newest keep submissions are kept for get() after they
+        have run. The workers are started with the first submission.
+    """
+
+    def __init__(self, workers=4, max_size=1000, keep=10000):
+        self.workers = workers
+        self.keep = keep
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.total_queue_time = 0.0
+        self.max_queue_time = 0.0
+        self._queue = queue.Queue(max_size)
+        self._submissions = OrderedDict()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, account, job):
+        """ Queues job, a function without arguments, for the account and
+            returns its Submission. Raises QueueFull if there is no room.
+        """
+        submission = Submission(account, job)
+        with self._lock:
+            self._start()
+            try:
+                self._queue.put_nowait(submission)
+            except queue.Full:
+                self.rejected += 1
+                raise QueueFull("{} submissions are already waiting".format(self._queue.maxsize))
+            self.submitted += 1
+            self._submissions[submission.id] = submission
+            # the oldest are dropped once they have run
+            while len(self._submissions) > self.keep and next(iter(self._submissions.values())).done:
+                self._submissions.popitem(last=False)
+        return submission
+
+    def get(self, submission_id):
+        """ Returns the Submission with the id, None if there is none """
+        with self._lock:
+            return self._submissions.get(submission_id)
+
+    def stats(self):
+        """ Returns the depth of the queue, the outcomes of the submissions
+            and the mean and longest time they waited for a worker
+        """
+        with self._lock:
+            started = self.completed + self.failed
+            return {"depth": self._queue.qsize(), "capacity": self._queue.maxsize, "workers": self.workers,
+                    "submitted": self.submitted, "rejected": self.rejected, "completed": self.completed,
+                    "failed": self.failed,
+                    "mean_queue_time": self.total_queue_time / started if started else 0.0,
+                    "max_queue_time": self.max_queue_time}
+
+    def close(self, timeout=None):
+        """ Lets the workers finish the queued jobs and stops them """
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join(timeout)
+
+    def _start(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work, name="order-queue-{}".format(len(self._threads)))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            submission = self._queue.get()
+            if submission is None:
+                return
+            submission.started_at = time.monotonic()
+            submission.status = "running"
+            try:
+                submission.result = submission.job()
+                submission.status = "done"
+            except Exception as e:
+                submission.error = e
+                submission.status = "failed"
+            submission.finished_at = time.monotonic()
+            with self._lock:
+                if submission.status == "done":
+                    self.completed += 1
+                else:
+                    self.failed += 1
+                waited = submission.queue_time()
+                self.total_queue_time += waited
+                self.max_queue_time = max(self.max_queue_time, waited)
+            submission._done.set()
@@ -0,0 +1,57 @@
+import threading
+import pytest
+from order_queue import OrderQueue, QueueFull
+
+
+"""
+Tests for the order submission queue
+
+"""
+
+def test_jobs_run_on_workers():
+    """ Jobs run on the worker threads and their outcome is kept """
+    queue = OrderQueue(workers=2)
+    ok = queue.submit(1, lambda: threading.current_thread().name)
+    def fail():
+        raise ValueError("refused")
+    failed = queue.submit(1, fail)
+    assert ok.wait(5) and failed.wait(5)
+    assert ok.status == "done"
+    assert ok.result.startswith("order-queue-")
+    assert failed.status == "failed"
+    assert str(failed.error) == "refused"
+    assert queue.get(ok.id) is ok
+    assert queue.get("nope") is None
+    stats = queue.stats()
+    assert (stats["submitted"], stats["completed"], stats["failed"], stats["depth"]) == (2, 1, 1, 0)
+    queue.close(5)
+
+def test_full_queue_rejects():
+    """ Submissions beyond max_size are refused instead of piling up """
+    release = threading.Event()
+    queue = OrderQueue(workers=1, max_size=2)
+    running = queue.submit(1, release.wait)
+    while running.status == "queued":
+        running.wait(0.01)
+    waiting = [queue.submit(1, lambda: None) for _ in range(2)]
+    with pytest.raises(QueueFull):
+        queue.submit(1, lambda: None)
+    stats = queue.stats()
+    assert (stats["depth"], stats["rejected"]) == (2, 1)
+    assert waiting[0].queue_time() > 0
+
+    release.set()
+    assert all(submission.wait(5) for submission in waiting)
+    assert queue.stats()["max_queue_time"] >= waiting[0].queue_time()
+    queue.close(5)
+
+def test_finished_submissions_are_dropped():
+    """ Only the newest keep submissions are kept once they have run """
+    queue = OrderQueue(workers=1, keep=3)
+    submissions = []
+    for i in range(6):
+        submissions.append(queue.submit(1, lambda: None))
+        submissions[-1].wait(5)
+    assert [queue.get(submission.id) for submission in submissions[:3]] == [None] * 3
+    assert all(queue.get(submission.id) for submission in submissions[3:])
+    queue.close(5)
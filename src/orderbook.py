@@ -0,0 +1,171 @@
+import math
+from bisect import bisect_left, insort
+
+
+"""
+Price ordered L2 order book that is maintained from the orderBookL2 table of
+the BitMEX websocket.
+
+"""
+
+class BookSide:
+    """ One side of the book. Prices are kept in a sorted list and the rows
+        in a dict keyed by price, so a size update is a dict lookup and
+        adding or removing a level is a binary search plus a list insert.
+    """
+
+    def __init__(self, descending):
+        self.descending = descending
+        self.prices = []
+        self.rows = {}
+
+    def add(self, row):
+        price = row["price"]
+        if price not in self.rows:
+            insort(self.prices, price)
+        self.rows[price] = row
+
+    def remove(self, price):
+        if self.rows.pop(price, None) is not None:
+            del self.prices[bisect_left(self.prices, price)]
+
+    def best(self):
+        """ Returns the best row of the side or None if it is empty """
+        if not self.prices:
+            return None
+        return self.rows[self.prices[-1] if self.descending else self.prices[0]]
+
+    def levels(self, depth=None):
+        """ Returns up to depth rows, best price first """
+        if depth is None or depth > len(self.prices):
+            depth = len(self.prices)
+        if self.descending:
+            prices = self.prices[len(self.prices) - depth:][::-1]
+        else:
+            prices = self.prices[:depth]
+        return [self.rows[price] for price in prices]
+
+    def grouped(self, grouping, depth=None):
+        """ Returns up to depth {"price", "size"} rows of the levels summed
+            into price buckets of width grouping, best price first. Bids are
+            rounded down into their bucket and asks up.
+        """
+        rounding = math.floor if self.descending else math.ceil
+        buckets = []
+        for row in self.levels():
+            # rounded again to drop the float noise of groupings like 0.1
+            price = round(rounding(row["price"] / grouping) * grouping, 8)
+            if buckets and buckets[-1]["price"] == price:
+                buckets[-1]["size"] += row["size"]
+            elif depth is not None and len(buckets) == depth:
+                break
+            else:
+                buckets.append({"price": price, "size": row["size"]})
+        return buckets
+
+    def __len__(self):
+        return len(self.prices)
+
+
+class OrderBook:
+    """ L2 order book of one symbol. Feed it the rows of orderBookL2 messages
+        with apply(), then query it with the best_*, top and cumulative_depth
+        methods. The version is increased on every change.
+    """
+
+    def __init__(self, symbol):
+        self.symbol = symbol
+        self.bids = BookSide(descending=True)
+        self.asks = BookSide(descending=False)
+        # (id, side) -> row, updates and deletes don't always carry the price
+        self._levels = {}
+        self.version = 0
+
+    def apply(self, action, rows):
+        """ Applies a partial, insert, update or delete message """
+        if action == "partial":
+            self.clear()
+            action = "insert"
+        for row in rows:
+            key = (row["id"], row["side"])
+            if action == "insert":
+                self._insert(key, dict(row))
+            elif action == "update":
+                level = self._levels.get(key)
+                if level is None:
+                    continue
+                # rows are replaced, never changed, so rows handed out by top() stay as they were
+                changed = dict(level)
+                changed.update(row)
+                if changed["price"] != level["price"]:
+                    self._delete(key)
+                    self._insert(key, changed)
+                else:
+                    self._levels[key] = changed
+                    self._side(changed["side"]).rows[changed["price"]] = changed
+            elif action == "delete":
+                self._delete(key)
+            else:
+                raise ValueError("Unknown action: %s" % action)
+        self.version += 1
+
+    def clear(self):
+        self.bids = BookSide(descending=True)
+        self.asks = BookSide(descending=False)
+        self._levels = {}
+        self.version += 1
+
+    def best_bid(self):
+        """ Returns the highest bid row or None """
+        return self.bids.best()
+
+    def best_ask(self):
+        """ Returns the lowest ask row or None """
+        return self.asks.best()
+
+    def spread(self):
+        """ Returns the difference between best ask and best bid or None """
+        bid = self.best_bid()
+        ask = self.best_ask()
+        if bid is None or ask is None:
+            return None
+        return ask["price"] - bid["price"]
+
+    def top(self, depth=None, grouping=None):
+        """ Returns up to depth rows of each side, best price first. With a
+            grouping the levels are summed into price buckets of that width.
+        """
+        if grouping:
+            return {"bids": self.bids.grouped(grouping, depth), "asks": self.asks.grouped(grouping, depth)}
+        return {"bids": self.bids.levels(depth), "asks": self.asks.levels(depth)}
+
+    def cumulative_depth(self, depth=None):
+        """ Returns (price, size, cumulative size) tuples of each side,
+            best price first
+        """
+        result = {}
+        for name, side in (("bids", self.bids), ("asks", self.asks)):
+            total = 0
+            levels = []
+            for row in side.levels(depth):
+                total += row["size"]
+                levels.append((row["price"], row["size"], total))
+            result[name] = levels
+        return result
+
+    def __len__(self):
+        return len(self.bids) + len(self.asks)
+
+    def _side(self, side):
+        return self.bids if side == "Buy" else self.asks
+
+    def _insert(self, key, row):
+        if key in self._levels:
+            self._delete(key)
+        self._levels[key] = row
+        self._side(row["side"]).add(row)
+
+    def _delete(self, key):
+        row = self._levels.pop(key, None)
+        if row is not None:
+            self._side(row["side"]).remove(row["price"])
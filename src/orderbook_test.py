@@ -0,0 +1,70 @@
+import pytest
+from orderbook import OrderBook
+
+
+"""
+Tests for the price ordered order book
+
+"""
+
+def _row(id, side, size, price):
+    return {"symbol": "XBTUSD", "id": id, "side": side, "size": size, "price": price}
+
+@pytest.fixture
+def book():
+    book = OrderBook("XBTUSD")
+    book.apply("partial", [_row(1, "Sell", 10, 3502.0), _row(2, "Sell", 20, 3501.0),
+                           _row(3, "Buy", 30, 3500.0), _row(4, "Buy", 40, 3499.5),
+                           _row(5, "Buy", 50, 3498.0)])
+    return book
+
+def test_sides_are_price_ordered(book):
+    """ Bids are highest first, asks lowest first """
+    top = book.top()
+    assert [row["price"] for row in top["bids"]] == [3500.0, 3499.5, 3498.0]
+    assert [row["price"] for row in top["asks"]] == [3501.0, 3502.0]
+    assert book.best_bid()["size"] == 30
+    assert book.best_ask()["size"] == 20
+    assert book.spread() == 1.0
+
+def test_incremental_changes(book):
+    """ Inserts, updates and deletes keep the order """
+    version = book.version
+    book.apply("insert", [_row(6, "Buy", 5, 3500.5)])
+    book.apply("update", [{"symbol": "XBTUSD", "id": 3, "side": "Buy", "size": 35}])
+    book.apply("delete", [{"symbol": "XBTUSD", "id": 2, "side": "Sell"}])
+    # updates for unknown levels are ignored
+    book.apply("update", [{"symbol": "XBTUSD", "id": 99, "side": "Buy", "size": 1}])
+    assert book.version == version + 4
+    assert [row["price"] for row in book.top(2)["bids"]] == [3500.5, 3500.0]
+    assert book.top(2)["bids"][1]["size"] == 35
+    assert book.best_ask()["price"] == 3502.0
+    assert len(book) == 5
+
+def test_cumulative_depth(book):
+    """ Cumulative size adds up from the best price outwards """
+    depth = book.cumulative_depth(2)
+    assert depth["bids"] == [(3500.0, 30, 30), (3499.5, 40, 70)]
+    assert depth["asks"] == [(3501.0, 20, 20), (3502.0, 10, 30)]
+
+def test_partial_replaces_book(book):
+    """ A new partial throws away the old levels """
+    book.apply("partial", [_row(7, "Sell", 1, 4000.0)])
+    assert book.best_bid() is None
+    assert book.best_ask()["price"] == 4000.0
+    assert book.spread() is None
+
+def test_rows_handed_out_do_not_change(book):
+    """ Updates replace rows, so the result of top() stays as it was """
+    top = book.top(1)
+    book.apply("update", [{"id": 3, "side": "Buy", "size": 99}])
+    assert top["bids"][0]["size"] == 30
+    assert book.best_bid()["size"] == 99
+
+def test_grouping(book):
+    """ Levels are summed into price buckets, bids rounded down and asks up """
+    top = book.top(grouping=5)
+    assert top["bids"] == [{"price": 3500, "size": 30}, {"price": 3495, "size": 90}]
+    assert top["asks"] == [{"price": 3505, "size": 30}]
+    assert book.top(depth=1, grouping=5)["bids"] == [{"price": 3500, "size": 30}]
+    assert book.top(grouping=0.1)["bids"][1] == {"price": 3499.5, "size": 40}
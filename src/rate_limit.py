@@ -0,0 +1,165 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import OrderedDict
+import requests
+
+
+"""
+Client side rate limiting of the calls to the BitMEX REST API. Every API key
+has a token bucket that follows the limit BitMEX reports in the
+x-ratelimit-* headers of its responses, and calls waiting for a token are let
+through by priority, cancels first.
+
+"""
+
+# priorities of the calls, lower goes first
+CANCEL = 0
+ORDER = 1
+OTHER = 2
+LANES = {CANCEL: "cancel", ORDER: "order", OTHER: "other"}
+
+
+class RateLimited(requests.RequestException):
+    """ Raised when a call would have to wait for its turn longer than it is
+        allowed to. retry_after is the number of seconds until it could go.
+    """
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """ The calls one API key can still make. Holds at most capacity tokens
+        and gains rate of them a second.
+    """
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+        # set when BitMEX has said no more calls are allowed until then
+        self.blocked_until = 0
+        # heap of the (priority, sequence) of the calls waiting for a token
+        self.waiters = []
+
+    def delay(self, now):
+        """ Seconds until a token is available """
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """ Token buckets of the API keys. Callers take a token with acquire()
+        before a call and pass the response to update() after it. limit is
+        the number of calls a key can make in a minute until BitMEX tells
+        otherwise. Buckets of at most max_keys keys are kept, the idle ones
+        that have been used least recently are dropped first.
+    """
+
+    def __init__(self, limit=60, max_keys=10000, clock=time.monotonic):
+        self.limit = limit
+        self.max_keys = max_keys
+        self.clock = clock
+        self._buckets = OrderedDict()
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._waits = {lane: {"calls": 0, "rejected": 0, "total_wait": 0.0, "max_wait": 0.0}
+                       for lane in LANES.values()}
+
+    def acquire(self, key, priority=OTHER, timeout=None):
+        """ Blocks until the key has a token and no call of a higher
+            priority waits for one, then takes it. Raises RateLimited if that
+            would take longer than timeout seconds.
+        """
+        start = self.clock()
+        deadline = None if timeout is None else start + timeout
+        lane = self._waits[LANES[priority]]
+        with self._condition:
+            bucket = self._bucket(key, start)
+            entry = (priority, next(self._sequence))
+            heapq.heappush(bucket.waiters, entry)
+            try:
+                while True:
+                    now = self.clock()
+                    first = bucket.waiters[0] == entry
+                    delay = bucket.delay(now) if first else None
+                    if first and delay <= 0:
+                        bucket.tokens -= 1
+                        break
+                    if deadline is not None and (now >= deadline or (first and now + delay > deadline)):
+                        lane["rejected"] += 1
+                        retry_after = delay if first else max(bucket.delay(now), 1 / bucket.rate)
+                        raise RateLimited("Rate limit of BitMEX reached, retry in {:.1f} seconds".format(retry_after),
+                                          retry_after)
+                    # the first waiter sleeps until its token, the others until the first is through
+                    wait = delay
+                    if deadline is not None:
+                        wait = deadline - now if wait is None else min(wait, deadline - now)
+                    self._condition.wait(wait)
+            finally:
+                bucket.waiters.remove(entry)
+                heapq.heapify(bucket.waiters)
+                self._condition.notify_all()
+            waited = self.clock() - start
+            lane["calls"] += 1
+            lane["total_wait"] += waited
+            lane["max_wait"] = max(lane["max_wait"], waited)
+
+    def update(self, key, response):
+        """ Corrects the bucket of the key with the x-ratelimit-* headers of a
+            response, a 429 blocks the key for as long as its Retry-After says
+        """
+        headers = response.headers
+        with self._condition:
+            now = self.clock()
+            bucket = self._bucket(key, now)
+            bucket.delay(now)
+            try:
+                if "x-ratelimit-limit" in headers:
+                    bucket.capacity = int(headers["x-ratelimit-limit"])
+                    bucket.rate = bucket.capacity / 60
+                if "x-ratelimit-remaining" in headers:
+                    # calls still on their way are already taken out of the local count
+                    bucket.tokens = min(bucket.tokens, int(headers["x-ratelimit-remaining"]))
+                    if bucket.tokens < 1 and "x-ratelimit-reset" in headers:
+                        # the reset is wall clock time, the bucket runs on the clock of the limiter
+                        reset = float(headers["x-ratelimit-reset"]) - time.time()
+                        bucket.blocked_until = max(bucket.blocked_until, now + reset)
+                if response.status_code == 429:
+                    bucket.tokens = 0
+                    bucket.blocked_until = max(bucket.blocked_until, now + float(headers.get("Retry-After", 1)))
+            except ValueError:
+                pass
+            self._condition.notify_all()
+
+    def stats(self):
+        """ Returns the calls that waited, were rejected and how long they
+            waited per priority, and the number of calls waiting now
+        """
+        with self._condition:
+            lanes = {}
+            for name, lane in self._waits.items():
+                lanes[name] = dict(lane, mean_wait=lane["total_wait"] / lane["calls"] if lane["calls"] else 0.0)
+            waiting = sum(len(bucket.waiters) for bucket in self._buckets.values())
+            return {"keys": len(self._buckets), "waiting": waiting, "lanes": lanes}
+
+    def _bucket(self, key, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.limit / 60, self.limit, now)
+            for old in list(self._buckets):
+                if len(self._buckets) <= self.max_keys:
+                    break
+                if old != key and not self._buckets[old].waiters:
+                    del self._buckets[old]
+        self._buckets.move_to_end(key)
+        return bucket
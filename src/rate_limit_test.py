@@ -0,0 +1,77 @@
+import threading
+import time
+import pytest
+from rate_limit import RateLimiter, RateLimited, CANCEL, ORDER, OTHER
+
+
+"""
+Tests for the rate limiter of the calls to BitMEX
+
+"""
+
+class FakeResponse(object):
+    def __init__(self, status_code=200, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+def _exhausted(limit, reset_in):
+    """ Response of a call after which no calls are left for reset_in seconds """
+    return FakeResponse(headers={"x-ratelimit-limit": str(limit), "x-ratelimit-remaining": "0",
+                                 "x-ratelimit-reset": str(time.time() + reset_in)})
+
+def test_burst_then_rate():
+    """ A fresh key has a full minute of calls, after that they come at the rate """
+    limiter = RateLimiter(limit=600)
+    start = time.monotonic()
+    for _ in range(600):
+        limiter.acquire("key")
+    assert time.monotonic() - start < 0.5
+    limiter.acquire("key")
+    assert time.monotonic() - start >= 0.09
+
+def test_priority():
+    """ Waiting cancels go before orders and those before other calls """
+    limiter = RateLimiter()
+    limiter.update("key", _exhausted(600, 0.2))
+    done = []
+    def call(priority):
+        limiter.acquire("key", priority)
+        done.append(priority)
+    threads = []
+    for priority in (OTHER, ORDER, CANCEL):
+        threads.append(threading.Thread(target=call, args=(priority,)))
+        threads[-1].start()
+        time.sleep(0.02)
+    assert limiter.stats()["waiting"] == 3
+    for thread in threads:
+        thread.join(5)
+    assert done == [CANCEL, ORDER, OTHER]
+    lanes = limiter.stats()["lanes"]
+    assert lanes["other"]["max_wait"] > lanes["cancel"]["max_wait"] > 0.1
+
+def test_timeout():
+    """ A call that would wait too long is refused right away """
+    limiter = RateLimiter()
+    limiter.update("key", _exhausted(60, 30))
+    start = time.monotonic()
+    with pytest.raises(RateLimited) as e:
+        limiter.acquire("key", ORDER, timeout=1)
+    assert time.monotonic() - start < 0.5
+    assert 25 < e.value.retry_after <= 30
+    assert limiter.stats()["lanes"]["order"]["rejected"] == 1
+    limiter.acquire("other", ORDER, timeout=1)
+
+def test_retry_after():
+    """ A 429 holds the key back for as long as BitMEX asks """
+    limiter = RateLimiter()
+    limiter.update("key", FakeResponse(429, {"Retry-After": "0.2"}))
+    start = time.monotonic()
+    limiter.acquire("key")
+    assert time.monotonic() - start >= 0.19
+
+def test_idle_keys_are_dropped():
+    """ At most max_keys buckets are kept """
+    limiter = RateLimiter(max_keys=2)
+    for key in ("a", "b", "c"):
+        limiter.acquire(key)
+    assert limiter.stats()["keys"] == 2
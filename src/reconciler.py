@@ -0,0 +1,177 @@
+import logging
+import threading
+import time
+from contextlib import nullcontext
+from flask import has_app_context
+from database import db, User, Orders
+
+
+"""
+Keeps the Orders table in step with the order table of the account
+websockets, so fills and cancels made on the exchange show up in the orders
+of the API without asking BitMEX.
+
+"""
+
+def order_values(row):
+    """ Turns the fields of an order row of the websocket into the columns of
+        Orders they update. Update rows only have the fields that changed.
+    """
+    values = {}
+    if "ordStatus" in row:
+        values["order_status"] = row["ordStatus"]
+    if "cumQty" in row:
+        values["filled_qty"] = row["cumQty"]
+    if "leavesQty" in row:
+        values["leaves_qty"] = row["leavesQty"]
+    if row.get("orderQty") is not None:
+        values["order_size"] = row["orderQty"]
+    if row.get("price") is not None:
+        values["order_price"] = row["price"]
+    return values
+
+
+class OrderReconciler:
+    """ Collects the order updates of account websockets and writes them
+        behind to the database every interval seconds. The updates of an
+        order are merged while they wait, so a burst of partial fills costs
+        one row update, and each flush is a single transaction.
+
+        Only orders that are in the database are updated. An update can
+        arrive before the request that placed the order has stored it, so
+        the updates of unknown orders are kept for grace seconds before they
+        are dropped. With versions, the ("orders", user_id) key of every
+        account whose orders were written is bumped after the commit.
+    """
+
+    def __init__(self, app, interval=0.2, grace=5, versions=None):
+        self.app = app
+        self.versions = versions
+        self.interval = interval
+        self.grace = grace
+        self.logger = logging.getLogger(__name__)
+        self.received = 0
+        self.written = 0
+        self.flushes = 0
+        # (user_id, order_id) -> [first seen, column values]
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def attach(self, ws):
+        """ Starts following the orders of an account websocket, beginning
+            with the ones it already has
+        """
+        with self._context():
+            user = User.query.filter_by(api_public=ws.api_key).first()
+            if user is None:
+                return
+            user_id = user.id
+
+        def on_orders(action, rows):
+            if action in ("partial", "insert", "update"):
+                self.add(user_id, rows)
+        if "order" in ws.data:
+            self.add(user_id, ws.snapshot("order", ws.ALL_SYMBOLS))
+        ws.add_listener("order", on_orders)
+        self._start()
+
+    def add(self, user_id, rows):
+        """ Queues order rows of an account for the next flush """
+        now = time.monotonic()
+        with self._lock:
+            for row in rows:
+                values = order_values(row)
+                if "orderID" not in row or not values:
+                    continue
+                self.received += 1
+                pending = self._pending.setdefault((user_id, row["orderID"]), [now, {}])
+                pending[1].update(values)
+
+    def flush(self):
+        """ Writes the queued updates in one transaction, returns the number
+            of orders updated
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+            by_user = {}
+            for user_id, order_id in pending:
+                by_user.setdefault(user_id, []).append(order_id)
+            with self._context():
+                known = set()
+                for user_id, order_ids in by_user.items():
+                    query = db.session.query(Orders.order_id).filter(Orders.user_id == user_id,
+                                                                     Orders.order_id.in_(order_ids))
+                    known.update((user_id, order_id) for order_id, in query)
+                mappings = [dict(values, order_id=key[1]) for key, (_, values) in pending.items() if key in known]
+                if mappings:
+                    try:
+                        db.session.bulk_update_mappings(Orders, mappings)
+                        db.session.commit()
+                    except Exception:
+                        # kept for the next flush
+                        db.session.rollback()
+                        self._requeue(pending, set())
+                        raise
+            if self.versions is not None:
+                for user_id in {key[0] for key in known}:
+                    self.versions.bump(("orders", user_id))
+            self._requeue(pending, known)
+            self.flushes += 1
+            self.written += len(mappings)
+            return len(mappings)
+
+    def stats(self):
+        """ Returns the updates received, the rows written, the number of
+            flushes and the orders waiting for the next one
+        """
+        with self._lock:
+            return {"received": self.received, "written": self.written, "flushes": self.flushes,
+                    "pending": len(self._pending)}
+
+    def close(self):
+        """ Stops the flush thread after a last flush """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _requeue(self, pending, known):
+        """ Puts the updates of orders that aren't stored yet back, merged
+            under the ones that came in meanwhile
+        """
+        now = time.monotonic()
+        with self._lock:
+            for key, (seen, values) in pending.items():
+                if key in known or now - seen > self.grace:
+                    continue
+                newer = self._pending.get(key)
+                if newer is not None:
+                    values = dict(values, **newer[1])
+                self._pending[key] = [seen, values]
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="order-reconciler")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                self.logger.exception("Writing order updates failed")
+
+    def _context(self):
+        # see ExecutionRecorder._context
+        return nullcontext() if has_app_context() else self.app.app_context()
@@ -0,0 +1,84 @@
+import json
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from util.api_key import generate_nonce, generate_signature
+from rate_limit import CANCEL, ORDER, OTHER
+
+
+"""
+Client of the BitMEX REST API. Keeps connections alive in a pool that is
+shared by all threads, so an order does not pay for a TCP and TLS handshake.
+
+"""
+
+def generate_headers(api_secret, api_public, url, method, data):
+    """ Signs a request, url is the path of the request and data its JSON body """
+    nonce = generate_nonce()
+    headers = {
+            "api-nonce" : str(nonce),
+            "api-signature" :  generate_signature(api_secret, method, url, nonce, json.dumps(data)),
+            "api-key" : api_public
+        }
+    return headers
+
+
+class BitMEXRestClient:
+    """ Signed requests to the BitMEX REST API over pooled keep-alive
+        connections. Every thread gets its own requests.Session, which is
+        not safe to share, but they all use the same HTTPAdapter and with it
+        the same pool of at most pool_size connections per host. With a
+        RateLimiter every call first waits for its turn in it, at most
+        max_wait seconds.
+    """
+
+    def __init__(self, base_url="https://testnet.bitmex.com", pool_size=10, connect_timeout=3.05, read_timeout=10,
+                 limiter=None, max_wait=None):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.limiter = limiter
+        self.max_wait = max_wait
+        # pool_block makes threads wait for a free connection instead of
+        # opening ones that would be thrown away after the request
+        self.adapter = HTTPAdapter(pool_maxsize=pool_size, pool_block=True)
+        self._local = threading.local()
+
+    @property
+    def session(self):
+        """ The session of the calling thread """
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+            session.mount("http://", self.adapter)
+            session.mount("https://", self.adapter)
+        return session
+
+    def request(self, method, path, data, api_key, api_secret, priority=None):
+        """ Sends a signed request with data as its JSON body and returns the
+            requests.Response. Raises requests.RequestException on timeouts
+            and connection errors, and RateLimited if the call can't get its
+            turn in time. Cancels go before new orders and those before other
+            calls unless priority says otherwise.
+        """
+        if self.limiter is not None:
+            if priority is None:
+                priority = CANCEL if method == "DELETE" else ORDER if path.startswith("/api/v1/order") else OTHER
+            self.limiter.acquire(api_key, priority, self.max_wait)
+        # signed only now, a call that waited for its turn must not carry a stale nonce
+        headers = generate_headers(api_secret, api_key, path, method, data)
+        headers["Content-Type"] = "application/json"
+        # the body has to be the exact JSON that was signed
+        res = self.session.request(method, self.base_url + path, data=json.dumps(data), headers=headers,
+                                   timeout=self.timeout)
+        if self.limiter is not None:
+            self.limiter.update(api_key, res)
+        return res
+
+    def post(self, path, data, api_key, api_secret):
+        return self.request("POST", path, data, api_key, api_secret)
+
+    def delete(self, path, data, api_key, api_secret):
+        return self.request("DELETE", path, data, api_key, api_secret)
+
+    def close(self):
+        self.adapter.close()
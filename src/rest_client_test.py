@@ -0,0 +1,128 @@
+import json
+import threading
+import time
+import pytest
+import requests
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from rest_client import BitMEXRestClient
+from rate_limit import RateLimiter, RateLimited
+from util.api_key import generate_signature
+
+
+"""
+Tests for the BitMEX REST client. A local HTTP server plays the part of
+BitMEX.
+
+"""
+
+class StubBitMEX(object):
+    """ Local stand-in for the BitMEX REST API. Replies come from
+        handlers[(method, path)], a function of the JSON body that returns
+        (status, body) or (status, body, headers). Records the requests and
+        counts the connections.
+    """
+
+    def __init__(self):
+        self.handlers = {}
+        self.requests = []
+        self.connections = 0
+        self.delay = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                stub.connections += 1
+                BaseHTTPRequestHandler.setup(self)
+
+            def handle_request(self):
+                raw = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                stub.requests.append((self.command, self.path, dict(self.headers), raw))
+                time.sleep(stub.delay)
+                handler = stub.handlers.get((self.command, self.path), lambda data: (200, {}))
+                status, body, *headers = handler(json.loads(raw or b"null"))
+                payload = json.dumps(body).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(payload)))
+                    for name, value in (headers[0] if headers else {}).items():
+                        self.send_header(name, value)
+                    self.end_headers()
+                    self.wfile.write(payload)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client gave up, e.g. after its read timeout
+                    self.close_connection = True
+
+            do_POST = do_DELETE = do_PUT = do_GET = handle_request
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = "http://127.0.0.1:{}".format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub():
+    stub = StubBitMEX()
+    yield stub
+    stub.close()
+
+def test_requests_are_signed(stub):
+    """ The body that is sent is the one that was signed """
+    client = BitMEXRestClient(stub.url)
+    client.post("/api/v1/order", {"symbol": "XBTUSD", "orderQty": 1}, "key", "secret")
+    method, path, headers, raw = stub.requests[0]
+    assert (method, path) == ("POST", "/api/v1/order")
+    assert headers["api-key"] == "key"
+    assert headers["api-signature"] == generate_signature("secret", "POST", "/api/v1/order",
+                                                          int(headers["api-nonce"]), raw.decode())
+
+def test_connections_are_reused(stub):
+    """ Calls share keep-alive connections, also across threads """
+    client = BitMEXRestClient(stub.url, pool_size=2)
+    for _ in range(10):
+        assert client.delete("/api/v1/order", {"orderID": "a"}, "key", "secret").status_code == 200
+    assert stub.connections == 1
+
+    def work():
+        for _ in range(5):
+            client.post("/api/v1/order", {}, "key", "secret")
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(stub.requests) == 30
+    assert stub.connections <= 2
+
+def test_rate_limit(stub):
+    """ The limiter learns from the responses and holds calls back """
+    stub.handlers[("POST", "/api/v1/order")] = lambda data: (200, {}, {
+        "x-ratelimit-limit": "60", "x-ratelimit-remaining": "0", "x-ratelimit-reset": str(int(time.time()) + 60)})
+    client = BitMEXRestClient(stub.url, limiter=RateLimiter(), max_wait=0.1)
+    client.post("/api/v1/order", {}, "key", "secret")
+    with pytest.raises(RateLimited) as e:
+        client.post("/api/v1/order", {}, "key", "secret")
+    assert e.value.retry_after > 50
+    assert len(stub.requests) == 1
+    # other keys have their own limit
+    client.post("/api/v1/order", {}, "other", "secret")
+    assert len(stub.requests) == 2
+
+def test_read_timeout(stub):
+    """ A slow upstream raises instead of holding the request forever """
+    stub.delay = 0.5
+    client = BitMEXRestClient(stub.url, read_timeout=0.1)
+    with pytest.raises(requests.Timeout):
+        client.post("/api/v1/order", {}, "key", "secret")
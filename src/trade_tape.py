@@ -0,0 +1,197 @@
+import mmap
+import os
+import re
+import struct
+import threading
+import uuid
+from utils import parse_timestamp, format_timestamp
+
+
+"""
+Append-only file of every trade received from the BitMEX websocket, one file
+per symbol. Records have a fixed width so the n-th trade is at a known
+offset, and the files are read through mmap with a binary search on the
+timestamp, so a time range is found without reading the trades before it.
+
+"""
+
+# timestamp in ms, price, size, trade id, side
+RECORD = struct.Struct("<qdq16sc")
+SIDES = {"Buy": b"B", "Sell": b"S"}
+SIDE_NAMES = {code: name for name, code in SIDES.items()}
+# symbols end up in file names, anything else is refused
+SYMBOL = re.compile(r"^\.?[A-Za-z0-9_]+$")
+
+
+def encode_trade(row):
+    """ Packs a trade row of the websocket into a record """
+    try:
+        trade_id = uuid.UUID(row["trdMatchID"]).bytes
+    except (KeyError, ValueError):
+        trade_id = str(row.get("trdMatchID", "")).encode()[:16].ljust(16, b"\0")
+    return RECORD.pack(int(round(parse_timestamp(row["timestamp"]) * 1000)), row["price"], row["size"],
+                       trade_id, SIDES.get(row["side"], b"?"))
+
+
+def decode_trade(symbol, record):
+    """ Turns the fields of a record back into a trade row """
+    timestamp, price, size, trade_id, side = record
+    return {"timestamp": format_timestamp(timestamp / 1000), "symbol": symbol, "side": SIDE_NAMES.get(side),
+            "size": size, "price": price, "trdMatchID": str(uuid.UUID(bytes=trade_id))}
+
+
+class TapeFile:
+    """ The trades of one symbol """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "ab")
+        self._map = None
+        self._lock = threading.Lock()
+        # Trades come in timestamp order. The newest timestamp and the ids
+        # written with it are kept to drop trades that are seen twice, e.g.
+        # in the partial after a reconnect.
+        self.last_timestamp = None
+        self.last_ids = set()
+        count = len(self)
+        if count:
+            last = self.record(count - 1)
+            self.last_timestamp = last[0]
+            for i in range(self.bisect(last[0]), count):
+                self.last_ids.add(self.record(i)[3])
+
+    def append(self, records):
+        """ Writes packed records, skipping the ones already in the file """
+        data = []
+        for record in records:
+            timestamp = RECORD.unpack_from(record)[0]
+            trade_id = record[24:40]
+            if self.last_timestamp is not None:
+                if timestamp < self.last_timestamp or (timestamp == self.last_timestamp and trade_id in self.last_ids):
+                    continue
+            if timestamp != self.last_timestamp:
+                self.last_timestamp = timestamp
+                self.last_ids = set()
+            self.last_ids.add(trade_id)
+            data.append(record)
+        if data:
+            self._file.write(b"".join(data))
+            self._file.flush()
+        return len(data)
+
+    def __len__(self):
+        return os.path.getsize(self.path) // RECORD.size
+
+    def record(self, index):
+        """ Unpacks the record at index straight from the map """
+        return RECORD.unpack_from(self._mapped(index + 1), index * RECORD.size)
+
+    def records(self, first, stop):
+        """ Yields the unpacked records from first up to stop """
+        if stop <= first:
+            return
+        view = self._mapped(stop)
+        for offset in range(first * RECORD.size, stop * RECORD.size, RECORD.size):
+            yield RECORD.unpack_from(view, offset)
+
+    def bisect(self, timestamp, right=False):
+        """ Index of the first trade at or after timestamp (ms), or after it
+            with right
+        """
+        count = len(self)
+        if not count:
+            return 0
+        view = self._mapped(count)
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            value = struct.unpack_from("<q", view, middle * RECORD.size)[0]
+            if value < timestamp or (right and value == timestamp):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def close(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+        self._file.close()
+
+    def _mapped(self, count):
+        """ Returns a map that covers at least count records, remapping the
+            file when it has grown past the current one
+        """
+        with self._lock:
+            if self._map is None or len(self._map) < count * RECORD.size:
+                # the old map is left to the readers still using it, it is closed once they let go
+                with open(self.path, "rb") as file:
+                    self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            return self._map
+
+
+class TradeTape:
+    """ Trade files of all symbols in a directory. attach() hooks it to the
+        trade table of a websocket, trades() reads a time range back.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def attach(self, ws):
+        """ Starts writing the trades of a websocket, beginning with the ones
+            it already has
+        """
+        for symbol in ws.symbols:
+            if symbol:
+                self.on_trades("partial", ws.recent_trades(symbol))
+        ws.add_listener("trade", self.on_trades)
+
+    def on_trades(self, action, rows):
+        """ Listener of the trade table """
+        if action not in ("partial", "insert"):
+            return
+        by_symbol = {}
+        for row in rows:
+            by_symbol.setdefault(row["symbol"], []).append(encode_trade(row))
+        for symbol, records in by_symbol.items():
+            self.file(symbol).append(records)
+
+    def file(self, symbol, create=True):
+        """ Returns the TapeFile of a symbol, or None if it has none and
+            create is false. Raises ValueError for malformed symbols.
+        """
+        if not SYMBOL.match(symbol):
+            raise ValueError("Invalid symbol: %r" % symbol)
+        with self._lock:
+            if symbol not in self._files:
+                path = os.path.join(self.directory, symbol + ".tape")
+                if not create and not os.path.exists(path):
+                    return None
+                os.makedirs(self.directory, exist_ok=True)
+                self._files[symbol] = TapeFile(path)
+            return self._files[symbol]
+
+    def trades(self, symbol, start=None, end=None, count=None):
+        """ Yields the trades of a symbol between start and end (seconds
+            since the epoch, both included) as dicts, oldest first. With
+            count at most that many are returned.
+        """
+        tape = self.file(symbol, create=False)
+        if tape is None:
+            return
+        first = 0 if start is None else tape.bisect(int(round(start * 1000)))
+        stop = len(tape) if end is None else tape.bisect(int(round(end * 1000)), right=True)
+        if count is not None:
+            stop = min(stop, first + count)
+        for record in tape.records(first, stop):
+            yield decode_trade(symbol, record)
+
+    def close(self):
+        with self._lock:
+            for tape in self._files.values():
+                tape.close()
+            self._files = {}
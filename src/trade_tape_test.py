@@ -0,0 +1,52 @@
+import pytest
+from trade_tape import TradeTape, RECORD
+from utils import parse_timestamp
+
+
+"""
+Tests for the append-only trade files
+
+"""
+
+def _trade(second, price, id, side="Buy", symbol="XBTUSD"):
+    return {"timestamp": "2019-03-14T12:00:{:02d}.000Z".format(second), "symbol": symbol, "side": side,
+            "size": 10, "price": price, "trdMatchID": "00000000-0000-0000-0000-{:012d}".format(id)}
+
+@pytest.fixture
+def tape(tmp_path):
+    tape = TradeTape(str(tmp_path))
+    tape.on_trades("partial", [_trade(0, 3500.0, 1), _trade(1, 3501.0, 2), _trade(1, 3502.0, 3, side="Sell")])
+    tape.on_trades("insert", [_trade(5, 3505.0, 4), _trade(5, 100.0, 5, symbol="ETHUSD")])
+    yield tape
+    tape.close()
+
+def test_trades_round_trip(tape):
+    """ Trades are read back as they were written """
+    trades = list(tape.trades("XBTUSD"))
+    assert trades == [_trade(0, 3500.0, 1), _trade(1, 3501.0, 2), _trade(1, 3502.0, 3, side="Sell"),
+                      _trade(5, 3505.0, 4)]
+    assert [t["price"] for t in tape.trades("ETHUSD")] == [100.0]
+    assert list(tape.trades("NOPE")) == []
+
+def test_time_range(tape):
+    """ Ranges include both ends and count limits the result """
+    start = parse_timestamp("2019-03-14T12:00:01Z")
+    assert [t["price"] for t in tape.trades("XBTUSD", start=start)] == [3501.0, 3502.0, 3505.0]
+    assert [t["price"] for t in tape.trades("XBTUSD", end=start)] == [3500.0, 3501.0, 3502.0]
+    assert [t["price"] for t in tape.trades("XBTUSD", start=start, end=start, count=1)] == [3501.0]
+    assert list(tape.trades("XBTUSD", start=start + 100)) == []
+
+def test_duplicates_are_skipped(tape, tmp_path):
+    """ Replayed trades are not written again, also after a restart """
+    tape.on_trades("partial", [_trade(1, 3502.0, 3, side="Sell"), _trade(5, 3505.0, 4), _trade(6, 3506.0, 6)])
+    tape.close()
+    reopened = TradeTape(str(tmp_path))
+    reopened.on_trades("insert", [_trade(6, 3506.0, 6), _trade(6, 3507.0, 7)])
+    assert [t["price"] for t in reopened.trades("XBTUSD")][-3:] == [3505.0, 3506.0, 3507.0]
+    assert (tmp_path / "XBTUSD.tape").stat().st_size == 6 * RECORD.size
+    reopened.close()
+
+def test_symbol_is_checked(tape):
+    """ Symbols that are not plain names don't reach the file system """
+    with pytest.raises(ValueError):
+        list(tape.trades("../XBTUSD"))
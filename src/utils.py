@@ -1,3 +1,8 @@
+import re
+from datetime import datetime, timezone
+from flask import _request_ctx_stack
+
+
 class MasonBuilder(dict):
     """
     A convenience class for managing dictionaries that represent Mason
@@ -61,3 +66,84 @@ class MasonBuilder(dict):
 
         self["@controls"][ctrl_name] = kwargs
         self["@controls"][ctrl_name]["href"] = href
+
+
+def parse_timestamp(value):
+    """
+    Turns a BitMEX timestamp such as "2019-03-14T12:34:56.789Z" into seconds
+    since the epoch. Numbers are taken to be seconds since the epoch already.
+    Timestamps without a timezone are taken to be UTC.
+
+    : param value: ISO 8601 string or number
+    : raises ValueError: if the value is not a timestamp
+    """
+
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def format_timestamp(seconds):
+    """
+    Turns seconds since the epoch into a timestamp in the BitMEX format.
+
+    : param float seconds: seconds since the epoch
+    """
+
+    return datetime.fromtimestamp(seconds, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+class HrefTemplates:
+    """
+    Stand-in for Api.url_for when building the hrefs of hypermedia controls.
+    The URL of a resource is built with Werkzeug once, with markers in place
+    of its variables, and every later href is made by putting the values in
+    place of the markers. The values are quoted by the converters of the
+    route, the same way a full URL build does, except for values that have
+    nothing to quote. Only path variables can be given; query strings are
+    appended by the callers.
+
+    : param api: the flask_restful.Api the resources are added to
+    """
+
+    MARKER = re.compile(r"(hrefvar\d+x)")
+    # characters that URL quoting always leaves as they are
+    UNQUOTED = re.compile(r"[A-Za-z0-9._~-]*").fullmatch
+
+    def __init__(self, api):
+        self.api = api
+        self._templates = {}
+
+    def __call__(self, resource, **values):
+        # the application root can differ per request when the app is mounted
+        ctx = _request_ctx_stack.top
+        key = (resource, ctx.request.script_root if ctx is not None else "")
+        template = self._templates.get(key)
+        if template is None:
+            template = self._templates[key] = self._compile(resource)
+        href, variables = template
+        for name, converter, literal in variables:
+            value = values[name]
+            if type(value) is not str or not self.UNQUOTED(value):
+                value = converter.to_url(value)
+            href += value + literal
+        return href
+
+    def _compile(self, resource):
+        """ Returns the text before the first variable and the name,
+            converter and following text of every variable
+        """
+        rule = next(self.api.app.url_map.iter_rules(resource.endpoint))
+        markers = {"hrefvar{}x".format(i): name for i, name in enumerate(sorted(rule.arguments))}
+        url = self.api.url_for(resource, **{name: marker for marker, name in markers.items()})
+        parts = self.MARKER.split(url)
+        variables = [(markers[parts[i]], rule._converters[markers[parts[i]]], parts[i + 1])
+                     for i in range(1, len(parts), 2)]
+        return parts[0], variables
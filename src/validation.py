@@ -0,0 +1,81 @@
+from jsonschema import validators
+from jsonschema.exceptions import best_match
+
+
+"""
+Compiled validators of the JSON request bodies. jsonschema.validate checks
+the schema and creates a validator on every call, SchemaValidator does that
+once, and bodies of simple schemas are checked by a plain function before
+falling back to jsonschema for the error message.
+
+"""
+
+# exact types a value of a JSON type can have, bool is not a number here
+TYPES = {"string": (str,), "integer": (int,), "number": (int, float), "boolean": (bool,),
+         "object": (dict,), "array": (list,)}
+ANNOTATIONS = {"description", "title"}
+
+
+def fast_check(schema):
+    """ Returns a function that tells whether an instance is valid against
+        schema, or None if the schema uses keywords it doesn't know. The
+        function may turn down valid instances, e.g. 1.0 for an integer,
+        but never passes an invalid one.
+    """
+    keys = set(schema) - ANNOTATIONS
+    kind = schema.get("type")
+    if kind == "object" and keys <= {"type", "required", "properties"}:
+        required = tuple(schema.get("required", ()))
+        properties = []
+        for name, prop in schema.get("properties", {}).items():
+            if set(prop) - ANNOTATIONS != {"type"} or prop["type"] not in TYPES:
+                return None
+            properties.append((name, TYPES[prop["type"]]))
+
+        def check(instance):
+            if type(instance) is not dict:
+                return False
+            for name in required:
+                if name not in instance:
+                    return False
+            for name, types in properties:
+                if name in instance and type(instance[name]) not in types:
+                    return False
+            return True
+        return check
+    if kind == "array" and keys <= {"type", "items", "minItems", "maxItems"}:
+        item_check = fast_check(schema["items"]) if "items" in schema else (lambda item: True)
+        if item_check is None:
+            return None
+        least = schema.get("minItems", 0)
+        most = schema.get("maxItems")
+
+        def check(instance):
+            if type(instance) is not list or len(instance) < least or (most is not None and len(instance) > most):
+                return False
+            for item in instance:
+                if not item_check(item):
+                    return False
+            return True
+        return check
+    return None
+
+
+class SchemaValidator:
+    """ Validates instances against a schema that is checked once. Raises
+        the same ValidationError jsonschema.validate would.
+    """
+
+    def __init__(self, schema):
+        cls = validators.validator_for(schema)
+        cls.check_schema(schema)
+        self.schema = schema
+        self.validator = cls(schema)
+        self.fast = fast_check(schema)
+
+    def validate(self, instance):
+        if self.fast is not None and self.fast(instance):
+            return
+        error = best_match(self.validator.iter_errors(instance))
+        if error is not None:
+            raise error
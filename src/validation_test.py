@@ -0,0 +1,51 @@
+import pytest
+from jsonschema import validate, ValidationError
+from app import MasonControls
+from validation import SchemaValidator, fast_check
+
+
+"""
+Tests for the compiled validators of the request bodies
+
+"""
+
+ORDER = {"symbol": "XBTUSD", "size": 20, "price": 3837.5, "side": "Buy"}
+INVALID_ORDERS = [dict(ORDER, size="20"), dict(ORDER, size=True), dict(ORDER, price=None), {"symbol": "XBTUSD"},
+                  dict(ORDER, size=20.5), [ORDER], "order"]
+
+def _error(schema, instance):
+    """ Message of the error jsonschema.validate raises, None if valid """
+    try:
+        validate(instance, schema)
+    except ValidationError as e:
+        return e.message
+    return None
+
+def test_same_as_jsonschema():
+    """ Valid and invalid bodies get the same outcome as with jsonschema """
+    for schema, instances in [
+            (MasonControls.order_schema(), [ORDER, dict(ORDER, size=20.0), dict(ORDER, extra=1)] + INVALID_ORDERS),
+            (MasonControls.bulk_order_schema(), [[ORDER] * 3, [], [ORDER] * 1000, [ORDER, dict(ORDER, size="1")],
+                                                 ORDER]),
+            (MasonControls.position_schema(), [{"leverage": 2}, {"leverage": 2.5}, {"leverage": "2"}, {}]),
+            (MasonControls.account_schema(), [{"accountname": "a", "api_public": "b", "api_secret": "c"},
+                                              {"accountname": "a", "api_public": 1, "api_secret": "c"}])]:
+        validator = SchemaValidator(schema)
+        for instance in instances:
+            expected = _error(schema, instance)
+            if expected is None:
+                validator.validate(instance)
+            else:
+                with pytest.raises(ValidationError) as e:
+                    validator.validate(instance)
+                assert e.value.message == expected
+
+def test_fast_check():
+    """ The fast check passes plain valid bodies and nothing invalid """
+    check = fast_check(MasonControls.order_schema())
+    assert check(ORDER)
+    assert not any(check(order) for order in INVALID_ORDERS)
+    # valid, but left to jsonschema
+    assert not check(dict(ORDER, size=20.0))
+    assert fast_check(MasonControls.bulk_order_schema())([ORDER] * 100)
+    assert fast_check({"type": "object", "properties": {"side": {"enum": ["Buy", "Sell"]}}}) is None
@@ -0,0 +1,151 @@
+import threading
+import time
+import logging
+from contextlib import contextmanager
+from bitmex_websocket import BitMEXWebsocket
+
+
+class _Connection:
+    """ Book-keeping for one shared websocket """
+
+    def __init__(self):
+        self.ws = None
+        self.refs = 0
+        self.last_used = time.monotonic()
+        # held while the websocket is being (re)connected so that concurrent
+        # requests for the same key wait for it instead of opening their own
+        self.lock = threading.Lock()
+
+
+class WebsocketManager:
+    """ Keeps one long-lived BitMEXWebsocket per (endpoint, symbol, account)
+        and hands the same connection to every resource that asks for it.
+        Connections are reference counted and the ones nobody has used for
+        idle_timeout seconds are closed by a background timer. Hooks added
+        with add_connect_hook are called with every new websocket.
+    """
+
+    def __init__(self, factory=BitMEXWebsocket, idle_timeout=60, reap_interval=10):
+        self.logger = logging.getLogger(__name__)
+        self.factory = factory
+        self.idle_timeout = idle_timeout
+        self.reap_interval = reap_interval
+        self._connections = {}
+        # id of every websocket handed out -> [websocket, key, connection, references]
+        self._issued = {}
+        self._lock = threading.Lock()
+        self._timer = None
+        self._connect_hooks = []
+
+    def acquire(self, endpoint, symbol, api_key=None, api_secret=None):
+        """ Returns a connected websocket for the given key, connecting it
+            first if needed. Every acquire must be paired with release.
+        """
+        key = (endpoint, symbol, api_key)
+        with self._lock:
+            conn = self._connections.get(key)
+            if conn is None:
+                conn = self._connections[key] = _Connection()
+            conn.refs += 1
+            self._start_reaper()
+
+        try:
+            with conn.lock:
+                if conn.ws is None or conn.ws.exited:
+                    self.logger.info("Opening shared websocket for %s", key)
+                    conn.ws = self.factory(endpoint=endpoint, symbol=symbol,
+                                           api_key=api_key, api_secret=api_secret)
+                    for hook in self._connect_hooks:
+                        hook(conn.ws)
+                ws = conn.ws
+        except Exception:
+            self._release(key, conn)
+            raise
+        with self._lock:
+            issued = self._issued.setdefault(id(ws), [ws, key, conn, 0])
+            issued[3] += 1
+        return ws
+
+    def add_connect_hook(self, hook):
+        """ Calls hook(ws) for every websocket opened from now on """
+        self._connect_hooks.append(hook)
+
+    def release(self, ws):
+        """ Gives back a websocket received from acquire, also one that has
+            been replaced by a reconnect since
+        """
+        with self._lock:
+            issued = self._issued.get(id(ws))
+            if issued is None or issued[0] is not ws:
+                return
+            issued[3] -= 1
+            if issued[3] == 0:
+                del self._issued[id(ws)]
+        self._release(issued[1], issued[2])
+
+    @contextmanager
+    def connection(self, endpoint, symbol, api_key=None, api_secret=None):
+        """ acquire/release as a context manager """
+        ws = self.acquire(endpoint, symbol, api_key, api_secret)
+        try:
+            yield ws
+        finally:
+            self.release(ws)
+
+    def reap(self):
+        """ Closes connections that have not been used for idle_timeout seconds """
+        now = time.monotonic()
+        idle = []
+        with self._lock:
+            for key, conn in list(self._connections.items()):
+                if conn.refs == 0 and now - conn.last_used >= self.idle_timeout:
+                    idle.append(self._connections.pop(key))
+        for conn in idle:
+            self._close(conn)
+        return len(idle)
+
+    def close_all(self):
+        """ Closes every connection and stops the reaper """
+        with self._lock:
+            conns = list(self._connections.values())
+            self._connections.clear()
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        for conn in conns:
+            self._close(conn)
+
+    def stats(self):
+        """ Returns the open connections and their reference counts """
+        with self._lock:
+            return {key: conn.refs for key, conn in self._connections.items()}
+
+    def _release(self, key, conn):
+        with self._lock:
+            conn.refs -= 1
+            conn.last_used = time.monotonic()
+            # drop entries whose connect attempt failed so they are retried
+            if conn.refs == 0 and conn.ws is None and self._connections.get(key) is conn:
+                del self._connections[key]
+
+    def _close(self, conn):
+        if conn.ws is not None and not conn.ws.exited:
+            self.logger.info("Closing idle websocket for %s", conn.ws.symbol)
+            try:
+                conn.ws.exit()
+            except Exception:
+                self.logger.exception("Failed to close websocket")
+
+    def _start_reaper(self):
+        # must be called with self._lock held
+        if self._timer is None:
+            self._timer = threading.Timer(self.reap_interval, self._run_reaper)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _run_reaper(self):
+        self.reap()
+        with self._lock:
+            self._timer = None
+            if self._connections:
+                self._start_reaper()
@@ -0,0 +1,112 @@
+import threading
+import pytest
+from ws_manager import WebsocketManager
+
+
+"""
+Tests for the shared websocket manager. The real BitMEXWebsocket is replaced
+with a fake so that no network connection is needed.
+
+"""
+
+class FakeWebsocket(object):
+    """ Stands in for BitMEXWebsocket, counts how many have been created """
+    created = 0
+
+    def __init__(self, endpoint, symbol, api_key=None, api_secret=None):
+        FakeWebsocket.created += 1
+        self.endpoint = endpoint
+        self.symbol = symbol
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.exited = False
+
+    def exit(self):
+        self.exited = True
+
+
+@pytest.fixture
+def manager():
+    FakeWebsocket.created = 0
+    manager = WebsocketManager(factory=FakeWebsocket, idle_timeout=0, reap_interval=60)
+    yield manager
+    manager.close_all()
+
+def test_connection_is_shared(manager):
+    """ Same key gives the same connection, other keys get their own """
+    first = manager.acquire("endpoint", "XBTUSD")
+    second = manager.acquire("endpoint", "XBTUSD")
+    other = manager.acquire("endpoint", "XBTUSD", api_key="key", api_secret="secret")
+    assert first is second
+    assert other is not first
+    assert FakeWebsocket.created == 2
+    assert manager.stats()[("endpoint", "XBTUSD", None)] == 2
+
+def test_reap_closes_only_idle(manager):
+    """ Connections still in use survive reaping, released ones are closed """
+    with manager.connection("endpoint", "XBTUSD") as ws:
+        assert manager.reap() == 0
+        assert not ws.exited
+    assert manager.reap() == 1
+    assert ws.exited
+    assert manager.stats() == {}
+
+    # next request reconnects
+    with manager.connection("endpoint", "XBTUSD") as again:
+        assert again is not ws
+    assert FakeWebsocket.created == 2
+
+def test_reconnects_closed(manager):
+    """ A connection that has been closed by the server is replaced """
+    ws = manager.acquire("endpoint", "XBTUSD")
+    manager.release(ws)
+    ws.exited = True
+    assert manager.acquire("endpoint", "XBTUSD") is not ws
+
+def test_connect_hooks(manager):
+    """ Hooks see every new connection once """
+    opened = []
+    manager.add_connect_hook(opened.append)
+    first = manager.acquire("endpoint", "XBTUSD")
+    manager.acquire("endpoint", "XBTUSD")
+    second = manager.acquire("endpoint", "ETHUSD")
+    assert opened == [first, second]
+
+def test_failed_connect_is_not_cached(manager):
+    """ A failing factory does not leave a reference behind """
+    def failing(**kwargs):
+        raise ValueError("no connection")
+    manager.factory = failing
+    with pytest.raises(ValueError):
+        manager.acquire("endpoint", "XBTUSD")
+    assert manager.stats() == {}
+
+def test_concurrent_acquire_connects_once(manager):
+    """ Threads asking for the same key at once share one connection """
+    results = []
+    def worker():
+        results.append(manager.acquire("endpoint", "XBTUSD"))
+    threads = [threading.Thread(target=worker) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert FakeWebsocket.created == 1
+    assert len(set(id(ws) for ws in results)) == 1
+
+def test_release_after_reconnect(manager):
+    """ A websocket released after it has been replaced still gives its
+        reference back, so the connection can be reaped
+    """
+    first = manager.acquire("endpoint", "XBTUSD")
+    first.exited = True
+    second = manager.acquire("endpoint", "XBTUSD")
+    assert second is not first
+    manager.release(first)
+    manager.release(second)
+    assert manager.stats()[("endpoint", "XBTUSD", None)] == 0
+    assert manager.reap() == 1
+    assert second.exited
+    # a second release of the same websocket is ignored
+    manager.release(first)
+    assert manager.stats() == {}
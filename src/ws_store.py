@@ -0,0 +1,352 @@
+import math
+import threading
+import uuid
+from ws_tables import KeyedTable, RingBuffer
+from orderbook import OrderBook
+
+
+class TableStore:
+    """ The tables of a BitMEX realtime connection and the public getters on
+        them. Shared by the threaded BitMEXWebsocket and the asyncio
+        AsyncBitMEXWebsocket, which only differ in how the messages arrive.
+        Subclasses set self.logger.
+
+        One connection can cover several symbols. The symbol scoped tables are
+        partitioned per symbol: self.data[table][symbol] holds the rows of one
+        symbol, while account wide tables such as margin are stored directly
+        in self.data[table]. The getters take a symbol argument and default
+        to the first symbol.
+
+        The feed thread changes the tables while request threads read them.
+        Changes are made under self.lock and bump the version of the table.
+        Readers get tuples of rows from snapshot(), built under the lock the
+        first time a version is read and shared until the next change. Rows
+        are replaced instead of updated in place, so a snapshot never changes
+        after it was taken.
+    """
+
+    # Don't grow a table larger than this amount. Helps cap memory usage.
+    MAX_TABLE_LEN = 200
+
+    # Append-only tables are kept in ring buffers of this many rows.
+    TABLE_CAPACITY = {'trade': MAX_TABLE_LEN, 'quote': MAX_TABLE_LEN, 'execution': MAX_TABLE_LEN}
+
+    # Tables that are subscribed per symbol, and the ones that are not
+    SYMBOL_TABLES = ("execution", "instrument", "order", "orderBookL2", "position", "quote", "trade")
+    GENERIC_TABLES = ("margin",)
+
+    # Tables whose partials have to arrive before the data can be used
+    MARKET_TABLES = frozenset(['instrument', 'trade', 'quote'])
+    ACCOUNT_TABLES = frozenset(['margin', 'position', 'order', 'orderBookL2'])
+
+    # symbol argument of snapshot() for the rows of every symbol
+    ALL_SYMBOLS = '*'
+
+    def __init__(self, symbol, table_capacity=None):
+        self.symbols = [symbol] if isinstance(symbol, str) else list(symbol)
+        # The default symbol of the getters
+        self.symbol = self.symbols[0] if self.symbols else ''
+        self.data = {}
+        self.keys = {}
+        # (table, symbol) of every partial received, symbol is '' for account wide tables
+        self.partials = set()
+        # Per table ring buffer capacities, table_capacity overrides the defaults
+        self.table_capacity = dict(TableStore.TABLE_CAPACITY, **(table_capacity or {}))
+        # symbol -> OrderBook, kept up to date from orderBookL2
+        self.books = {}
+        # Held while the tables change and while snapshots are taken
+        self.lock = threading.Lock()
+        # table -> number of changes applied to it
+        self.versions = {}
+        # Tells the versions of this store apart from those of the stores before it, e.g. in ETags
+        self.epoch = uuid.uuid4().hex
+        # (table, symbol) -> (version, rows)
+        self._snapshots = {}
+        # table -> callbacks called with (action, rows) after every change
+        self.listeners = {}
+
+    def get_instrument(self, symbol=None):
+        '''Get the raw instrument data for a symbol.'''
+        # Turn the 'tickSize' into 'tickLog' for use in rounding
+        instrument = dict(self.snapshot('instrument', symbol)[0])
+        instrument['tickLog'] = int(math.fabs(math.log10(instrument['tickSize'])))
+        return instrument
+
+    def get_ticker(self, symbol=None):
+        '''Return a ticker object. Generated from quote and trade.'''
+        lastQuote = self.snapshot('quote', symbol)[-1]
+        lastTrade = self.snapshot('trade', symbol)[-1]
+        ticker = {
+            "last": lastTrade['price'],
+            "buy": lastQuote['bidPrice'],
+            "sell": lastQuote['askPrice'],
+            "mid": (float(lastQuote['bidPrice'] or 0) + float(lastQuote['askPrice'] or 0)) / 2
+        }
+
+        # The instrument has a tickSize. Use it to round values.
+        instrument = self.get_instrument(symbol)
+        return {k: round(float(v or 0), instrument['tickLog']) for k, v in ticker.items()}
+
+    def funds(self):
+        '''Get your margin details.'''
+        return self.snapshot('margin')[0]
+
+    def positions(self, symbol=None):
+        '''Get your positions, of all symbols unless one is given. This has been added by Juuso.'''
+        return list(self.snapshot('position', self.ALL_SYMBOLS if symbol is None else symbol))
+
+    def market_depth(self, symbol=None, depth=None, grouping=None):
+        '''Get market depth (orderbook). Returns the bids and asks, best price first.
+        All levels are returned unless depth is given, grouping sums them into price buckets.'''
+        book = self.order_book(symbol)
+        with self.lock:
+            return book.top(depth, grouping)
+
+    def order_book(self, symbol=None):
+        '''Get the price ordered OrderBook of a symbol.'''
+        symbol = self.symbol if symbol is None else symbol
+        if symbol not in self.books:
+            self.books[symbol] = OrderBook(symbol)
+        return self.books[symbol]
+
+    def open_orders(self, clOrdIDPrefix, symbol=None):
+        '''Get all your open orders, of all symbols unless one is given.'''
+        orders = self.snapshot('order', self.ALL_SYMBOLS if symbol is None else symbol)
+        # Filter to only open orders (leavesQty > 0) and those that we actually placed
+        return [o for o in orders if str(o['clOrdID']).startswith(clOrdIDPrefix) and o['leavesQty'] > 0]
+
+    def recent_trades(self, symbol=None):
+        '''Get recent trades, oldest first.'''
+        return list(self.snapshot('trade', symbol))
+
+    def snapshot(self, table, symbol=None):
+        '''Get an immutable view of a table as a tuple of rows. For symbol scoped tables the rows of
+        one symbol, or of all of them with ALL_SYMBOLS.'''
+        key = (table, symbol)
+        cached = self._snapshots.get(key)
+        # Versions are bumped after a change is complete, so a snapshot of the current version is
+        # consistent even while the next change is being applied.
+        if cached is not None and cached[0] == self.versions.get(table, 0):
+            return cached[1]
+        with self.lock:
+            version = self.versions.get(table, 0)
+            if symbol == self.ALL_SYMBOLS and table in self.SYMBOL_TABLES:
+                rows = tuple(row for partition in self.data[table].values() for row in partition)
+            else:
+                rows = tuple(self.table(table, symbol))
+        self._snapshots[key] = (version, rows)
+        return rows
+
+    def version(self, table):
+        '''Number of changes applied to a table so far. Only ever increases.'''
+        return self.versions.get(table, 0)
+
+    def add_listener(self, table, callback):
+        '''Call callback(action, rows) from the feed after every change to a table.'''
+        self.listeners.setdefault(table, []).append(callback)
+
+    def remove_listener(self, table, callback):
+        if callback in self.listeners.get(table, []):
+            self.listeners[table].remove(callback)
+
+    def table(self, table, symbol=None):
+        '''Get the live rows of a table, for symbol scoped tables those of one symbol. These change
+        while being read, use snapshot() outside of the feed.'''
+        if table not in self.SYMBOL_TABLES:
+            return self.data[table]
+        return self.data[table][self.symbol if symbol is None else symbol]
+
+    def is_ready(self, account=False):
+        '''True once the partials of the market tables of every symbol, and of the account tables
+        if asked, are in.'''
+        for symbol in self.symbols:
+            if any((table, symbol) not in self.partials for table in self.MARKET_TABLES):
+                return False
+        return not account or self.ACCOUNT_TABLES <= set(self.keys)
+
+    def topics(self, symbols):
+        '''Subscription topics of the symbol scoped tables for the given symbols.'''
+        return [table + ':' + symbol for symbol in symbols for table in self.SYMBOL_TABLES]
+
+    def add_symbol(self, symbol):
+        if symbol not in self.symbols:
+            self.symbols.append(symbol)
+
+    def drop_symbol(self, symbol):
+        '''Forget a symbol and everything stored for it.'''
+        with self.lock:
+            if symbol in self.symbols:
+                self.symbols.remove(symbol)
+            for table in self.SYMBOL_TABLES:
+                if table in self.data and self.data[table].pop(symbol, None) is not None:
+                    self.versions[table] = self.versions.get(table, 0) + 1
+                self.partials.discard((table, symbol))
+            self.books.pop(symbol, None)
+
+    def apply(self, message):
+        '''Apply a decoded table message. Returns the table and action it applied or None if the
+        message was not a table message.'''
+        table = message['table'] if 'table' in message else None
+        action = message['action'] if 'action' in message else None
+        if not action:
+            return None
+        with self.lock:
+            self.__apply(table, action, message)
+            self.versions[table] = self.versions.get(table, 0) + 1
+        for callback in self.listeners.get(table, ()):
+            callback(action, message['data'])
+        return table, action
+
+    def __apply(self, table, action, message):
+        '''Apply a table message, called with the lock held.'''
+        rows = message['data']
+        filterSymbol = message.get('filter', {}).get('symbol')
+
+        if action == 'partial':
+            self.logger.debug("%s: partial", table)
+            # Keys are communicated on partials to let you know how to uniquely identify
+            # an item. We use it for updates.
+            self.keys[table] = message['keys']
+        elif action not in ('insert', 'update', 'delete'):
+            raise Exception("Unknown action: %s" % action)
+        else:
+            self.logger.debug('%s: %s %s', table, action, rows)
+
+        if table == 'orderBookL2':
+            # The order book is kept in price order in its own structure instead of a table.
+            self.__update_books(action, rows, filterSymbol)
+        elif table in self.SYMBOL_TABLES:
+            if table not in self.data:
+                self.data[table] = {}
+            partitions = self.data[table]
+            bySymbol = {}
+            if action == 'partial':
+                # A partial replaces the partitions it was filtered to
+                for symbol in [filterSymbol] if filterSymbol else list(partitions):
+                    bySymbol[symbol] = []
+            for row in rows:
+                bySymbol.setdefault(row.get('symbol'), []).append(row)
+            for symbol, symbolRows in bySymbol.items():
+                if symbol is None:
+                    # updates that don't carry the symbol, look for the row in every partition
+                    self.__change(table, action, list(partitions.values()), symbolRows)
+                    continue
+                if action == 'partial' or symbol not in partitions:
+                    partitions[symbol] = self.__new_table(table)
+                self.__change(table, action, [partitions[symbol]], symbolRows)
+        else:
+            if table not in self.data or action == 'partial':
+                self.data[table] = self.__new_table(table)
+            self.__change(table, action, [self.data[table]], rows)
+
+        if action == 'partial':
+            self.partials.add((table, filterSymbol or ''))
+
+    def __new_table(self, table):
+        '''Create the container a table is stored in.'''
+        if table in self.table_capacity:
+            return RingBuffer(self.table_capacity[table])
+        if self.keys.get(table):
+            # Index keyed tables so that updates and deletes can find their row
+            # without scanning the table.
+            return KeyedTable(self.keys[table])
+        return []
+
+    def __change(self, table, action, containers, rows):
+        '''Apply rows of a message to the containers they may belong to.'''
+        # There are four possible actions from the WS:
+        # 'partial' - full table image
+        # 'insert'  - new row
+        # 'update'  - update row
+        # 'delete'  - delete row
+        if action in ('partial', 'insert'):
+            # Inserts always come with the symbol, so there is exactly one container.
+            # Ring buffers evict their oldest rows by themselves.
+            rowsTable = containers[0]
+            rowsTable.extend(rows)
+
+            # Limit the max length of the other tables to avoid excessive memory usage.
+            # Don't trim orders because we'll lose valuable state if we do.
+            overflow = len(rowsTable) - TableStore.MAX_TABLE_LEN
+            if table != 'order' and overflow > 0 and not isinstance(rowsTable, RingBuffer):
+                if isinstance(rowsTable, KeyedTable):
+                    rowsTable.discard_oldest(overflow)
+                else:
+                    del rowsTable[:overflow]
+        elif action == 'update':
+            # Locate the item in the collection and update it.
+            for updateData in rows:
+                rowsTable, item = self.__find_item(table, containers, updateData)
+                if not item:
+                    continue  # No item found to update. Could happen before push
+                # Replace the row instead of updating it, snapshots may still hold the old one
+                newItem = dict(item)
+                newItem.update(updateData)
+                # Remove cancelled / filled orders
+                if table == 'order' and newItem['leavesQty'] <= 0:
+                    self.__remove_item(rowsTable, item)
+                else:
+                    self.__replace_item(rowsTable, item, newItem)
+        elif action == 'delete':
+            # Locate the item in the collection and remove it.
+            for deleteData in rows:
+                rowsTable, item = self.__find_item(table, containers, deleteData)
+                if item:
+                    self.__remove_item(rowsTable, item)
+
+    def __update_books(self, action, rows, filterSymbol=None):
+        '''Apply orderBookL2 rows to the book of their symbol.'''
+        bySymbol = {}
+        if action == 'partial':
+            # A partial replaces the books it was filtered to, even if it has no rows for them
+            for symbol in [filterSymbol] if filterSymbol else list(self.books):
+                bySymbol[symbol] = []
+        for row in rows:
+            bySymbol.setdefault(row['symbol'], []).append(row)
+        for symbol, symbolRows in bySymbol.items():
+            if symbol not in self.books:
+                self.books[symbol] = OrderBook(symbol)
+            self.books[symbol].apply(action, symbolRows)
+
+    def __find_item(self, table, containers, matchData):
+        '''Find the stored row that matchData refers to and the container it is in.'''
+        for rows in containers:
+            if isinstance(rows, KeyedTable):
+                item = rows.get(matchData)
+            else:
+                item = findItemByKeys(self.keys.get(table, []), rows, matchData)
+            if item:
+                return rows, item
+        return None, None
+
+    def __replace_item(self, rows, item, newItem):
+        '''Put newItem in the place of a row found with __find_item.'''
+        if isinstance(rows, KeyedTable):
+            rows.extend([newItem])
+        elif isinstance(rows, RingBuffer):
+            rows.replace(item, newItem)
+        else:
+            rows[next(i for i, row in enumerate(rows) if row is item)] = newItem
+
+    def __remove_item(self, rows, item):
+        '''Remove a row found with __find_item.'''
+        if isinstance(rows, KeyedTable):
+            rows.pop(item)
+        else:
+            rows.remove(item)
+
+
+# Utility method for finding an item in the store.
+# When an update comes through on the websocket, we need to figure out which item in the array it is
+# in order to match that item.
+#
+# Helpfully, on a data push (or on an HTTP hit to /api/v1/schema), we have a "keys" array. These are the
+# fields we can use to uniquely identify an item. Sometimes there is more than one, so we iterate through all
+# provided keys.
+#
+# Keyed tables are stored in a KeyedTable which does this lookup through a hash index. This linear
+# scan is only used for tables that came without keys.
+def findItemByKeys(keys, table, matchData):
+    for item in table:
+        if all(item[key] == matchData[key] for key in keys):
+            return item
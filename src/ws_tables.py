@@ -0,0 +1,140 @@
+from collections import OrderedDict
+
+
+"""
+Containers for the tables received from the BitMEX websocket.
+
+"""
+
+class KeyedTable:
+    """ Table whose rows are uniquely identified by the keys BitMEX sends with
+        the partial. Rows are kept in arrival order in a hash map keyed on the
+        tuple of key values, so finding, updating and removing a row takes
+        constant time instead of a scan through the whole table.
+        Behaves like a read-only list of rows for the readers.
+    """
+
+    def __init__(self, keys, rows=()):
+        self.keys = tuple(keys)
+        self._rows = OrderedDict()
+        self.extend(rows)
+
+    def key_of(self, row):
+        """ Returns the index key of a row or None if it lacks a key field """
+        try:
+            return tuple(row[key] for key in self.keys)
+        except KeyError:
+            return None
+
+    def extend(self, rows):
+        """ Adds rows, replacing any row that has the same keys """
+        for row in rows:
+            self._rows[self.key_of(row)] = row
+
+    def get(self, match):
+        """ Returns the row that has the same keys as match, or None """
+        return self._rows.get(self.key_of(match))
+
+    def pop(self, match):
+        """ Removes and returns the row that has the same keys as match """
+        return self._rows.pop(self.key_of(match), None)
+
+    def discard_oldest(self, count):
+        """ Drops the count oldest rows """
+        for _ in range(min(count, len(self._rows))):
+            self._rows.popitem(last=False)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __iter__(self):
+        return iter(self._rows.values())
+
+    def __getitem__(self, index):
+        if isinstance(index, int):
+            # first and last row are the common cases, don't copy for them
+            if index == 0 and self._rows:
+                return next(iter(self._rows.values()))
+            if index == -1 and self._rows:
+                return self._rows[next(reversed(self._rows))]
+        return list(self._rows.values())[index]
+
+    def __repr__(self):
+        return "KeyedTable({!r}, {!r})".format(self.keys, list(self))
+
+
+class RingBuffer:
+    """ Fixed capacity table for append-only streams such as trades. The
+        slots are allocated up front and the oldest row is overwritten once
+        the buffer is full, so appending and evicting are O(1) and memory use
+        does not depend on how busy the feed is. Iterating and indexing
+        return the rows oldest first.
+    """
+
+    def __init__(self, capacity, rows=()):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.capacity = capacity
+        self._slots = [None] * capacity
+        self._start = 0
+        self._len = 0
+        self.extend(rows)
+
+    def append(self, row):
+        if self._len < self.capacity:
+            self._slots[(self._start + self._len) % self.capacity] = row
+            self._len += 1
+        else:
+            self._slots[self._start] = row
+            self._start = (self._start + 1) % self.capacity
+
+    def extend(self, rows):
+        # only the newest rows could survive anyway
+        rows = list(rows)[-self.capacity:]
+        for row in rows:
+            self.append(row)
+
+    def replace(self, row, new):
+        """ Puts new in the slot of row. O(n) like remove """
+        for i in range(self._len):
+            slot = (self._start + i) % self.capacity
+            if self._slots[slot] is row:
+                self._slots[slot] = new
+                return
+        raise ValueError("row is not in the RingBuffer")
+
+    def remove(self, row):
+        """ Removes a row. O(n), the streams stored here are never deleted
+            from in normal operation.
+        """
+        rows = list(self)
+        rows.remove(row)
+        self.clear()
+        self.extend(rows)
+
+    def clear(self):
+        self._slots = [None] * self.capacity
+        self._start = 0
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        slots = self._slots
+        start = self._start
+        capacity = self.capacity
+        for i in range(self._len):
+            yield slots[(start + i) % capacity]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._len))]
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError("RingBuffer index out of range")
+        return self._slots[(self._start + index) % self.capacity]
+
+    def __repr__(self):
+        return "RingBuffer({}, {!r})".format(self.capacity, list(self))
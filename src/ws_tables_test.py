@@ -0,0 +1,53 @@
+import pytest
+from ws_tables import KeyedTable, RingBuffer
+
+
+"""
+Tests for the websocket table containers
+
+"""
+
+def test_keyed_table():
+    """ Rows are found and removed by their keys and keep arrival order """
+    table = KeyedTable(["id"], [{"id": 1, "v": "a"}, {"id": 2, "v": "b"}])
+    table.extend([{"id": 3, "v": "c"}, {"id": 1, "v": "d"}])
+    assert [row["v"] for row in table] == ["d", "b", "c"]
+    assert table.get({"id": 2})["v"] == "b"
+    assert table.get({"other": 2}) is None
+    assert table.pop({"id": 2})["v"] == "b"
+    assert table.pop({"id": 2}) is None
+    table.discard_oldest(1)
+    assert table[0]["id"] == 3
+    assert table[-1]["id"] == 3
+    assert len(table) == 1
+
+def test_ring_buffer_wraps():
+    """ The oldest rows are overwritten once the buffer is full """
+    ring = RingBuffer(3)
+    for i in range(5):
+        ring.append(i)
+    assert list(ring) == [2, 3, 4]
+    assert ring[0] == 2
+    assert ring[-1] == 4
+    assert ring[1:] == [3, 4]
+    with pytest.raises(IndexError):
+        ring[3]
+
+def test_ring_buffer_extend_and_remove():
+    """ Extending with more rows than fit keeps the newest ones """
+    ring = RingBuffer(3, [1, 2])
+    ring.extend(range(10, 20))
+    assert list(ring) == [17, 18, 19]
+    ring.remove(18)
+    assert list(ring) == [17, 19]
+    ring.append(20)
+    assert list(ring) == [17, 19, 20]
+    assert len(ring) == 3
+
+def test_ring_buffer_replace():
+    """ A row can be swapped for a new one in place """
+    ring = RingBuffer(2, [{"v": 1}, {"v": 2}, {"v": 3}])
+    ring.replace(ring[0], {"v": 20})
+    assert [row["v"] for row in ring] == [20, 3]
+    with pytest.raises(ValueError):
+        ring.replace({"v": 1}, {"v": 10})